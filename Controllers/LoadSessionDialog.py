@@ -1,10 +1,15 @@
 from ui.LoadSessionWindow_v7 import Ui_Dialog as Ui_LoadSessionWindow
-from PyQt6.QtWidgets import QDialog, QLineEdit, QTableWidgetItem, QDateEdit
-from PyQt6.QtCore import QSettings
+from PyQt6.QtWidgets import QDialog, QLineEdit, QDateEdit, QTableView, QHeaderView, QAbstractItemView, QMessageBox
+from PyQt6.QtCore import (QSettings, QThread, QObject, QAbstractTableModel, QModelIndex, Qt, pyqtSignal, pyqtSlot)
 from pathlib import Path
-import pandas as pd
+import threading
 from main_v2.file_managerv2 import FileManager
-from main_v2.supplementary_classes import DatasetConstraints, QueryMethodConfig, GridConfig
+from main_v2.series_catalog import SeriesCatalog
+from main_v2.series_search_index import SeriesSearchIndex
+from main_v2.supplementary_classes import DatasetConstraints, QueryMethodConfig, GridConfig, StorageConfig
+
+# Loader threads of closed dialogs, referenced until they have finished their last request and deleted themselves
+_closing_loaders = set()
 
 # ...turb_data\datasets\channel\channel__xs=0_xe=8_nx=20__ys=0_ye=1_ny=6__zs=0_ze=3_nz=9__ts=1_te=10_nt=2__hash=d7991bc8
 
@@ -23,11 +28,23 @@ class LoadSessionDialog(QDialog):
         self.ui.lineEdit_RootDirectory.setText(str(self.data_dir))
         self.ui.lineEdit_RootDirectory.setEnabled(True)
 
-        # Instantiate input and search managers
+        # Instantiate input and search managers. The search manager stays empty until the loader has read the catalog.
         self.init_input_manager()
         self.search_manager = SearchManager(data_dir=self.data_dir)
+        self.filtered_results = []
+        self.sort_field, self.sort_descending = None, False
         # self.search_manager.format_search_results()
 
+        # Catalog loading and sorting run on a worker thread, so the dialog shows before the catalog is read
+        self._qthread = QThread(self)
+        self.loader = SeriesLoader()
+        self.loader.moveToThread(self._qthread)
+        self.loader.seriesLoaded.connect(self._on_series_loaded)
+        self.loader.error.connect(self._on_load_error)
+        self.loader.resultsSorted.connect(self._on_results_sorted)
+        self._qthread.finished.connect(self.loader.deleteLater)
+        self._qthread.start()
+
         # Auto-populate saved data directory into line edit
         # self.populate_data_directory()
 
@@ -37,19 +54,18 @@ class LoadSessionDialog(QDialog):
         self.ui.dateEdit_LastModified.setEnabled(False)
         # self.input_manager.toggle_secondary_inputs(set_enable=False)
 
-        # Initial settings for table widget
-        self.filtered_results = self.search_manager.filter_search_results()
-        self.ui.tableWidget_SearchResultsTable.setHorizontalHeaderLabels(
-            ["Custom Tag", "Hash", "Dataset", "Variable", "Grid", "Date Created", "Date Last Modified"]
-        )
-        self.update_display_table()
+        # Initial settings for table view
+        self.results_model = SeriesResultsModel(self)
+        self.results_model.sortRequested.connect(self.sort_requested)
+        self.init_results_view()
+        self.load_series()
 
         "Signals"
         self.ui.lineEdit_RootDirectory.textChanged.connect(self.root_dir_updated)
         self.ui.checkBox_CreatedToggle.checkStateChanged.connect(self.date_created_checkbox_updated)
         self.ui.checkBox_LastLoadedToggle.checkStateChanged.connect(self.date_last_loaded_checkbox_updated)
 
-        self.ui.tableWidget_SearchResultsTable.cellClicked.connect(self.cell_was_clicked)
+        self.ui.tableView_SearchResultsTable.clicked.connect(self.cell_was_clicked)
 
         self.ui.pushButton_LoadSession.clicked.connect(self.load_session_button_clicked)
 
@@ -65,14 +81,9 @@ class LoadSessionDialog(QDialog):
     Dispatcher Functions ---------------------------------------------------------------------------------------------------
     """
     def root_dir_updated(self):
-        print(self.filtered_results)
-        root_dir = Path(self.ui.lineEdit_RootDirectory.text())
-        if Path.is_dir(root_dir):
-            self.data_dir = root_dir
-            self.init_input_manager()
-            self.search_manager = SearchManager(data_dir=self.data_dir)
-            self.ui.tableWidget_SearchResultsTable.setRowCount(0)
-            # self.update_display_table()
+        # Checking the directory may block on a network mount, so the loader does it. Until a directory with a catalog
+        # has loaded, the table keeps showing the previous one.
+        self.load_series(Path(self.ui.lineEdit_RootDirectory.text()))
 
 
 
@@ -81,7 +92,6 @@ class LoadSessionDialog(QDialog):
             date_created_enabled=self.ui.checkBox_CreatedToggle.isChecked(),
             date_opened_enabled=self.ui.checkBox_LastLoadedToggle.isChecked()
         )
-        self.filtered_results = self.search_manager.filter_search_results(self.input_manager.search_params)
         self.update_display_table()
 
 
@@ -103,9 +113,16 @@ class LoadSessionDialog(QDialog):
             self.ui.dateEdit_LastModified.setEnabled(False)
 
 
-    def cell_was_clicked(self, row, col):
+    def sort_requested(self, column, order):
+        "Header clicked. The loader orders every row by the column, later searches keep that order."
+        self.sort_field = SeriesResultsModel.SORT_FIELDS[column] if column >= 0 else None
+        self.sort_descending = order == Qt.SortOrder.DescendingOrder
+        self.sort_series()
+
+
+    def cell_was_clicked(self, model_index):
         # Selected entry inside of table
-        self.selected_entry = self.filtered_results[row]
+        self.selected_entry = self.filtered_results[model_index.row()]
 
         # Series dir belonging to selected entry
         selected_series_dir = self.selected_entry["series_dir"]
@@ -118,10 +135,10 @@ class LoadSessionDialog(QDialog):
     def load_session_button_clicked(self):
         self.init_file_manager(selected_entry=self.selected_entry)
 
-        hash_log = FileManager.load_hash_log(self.data_dir)
+        entry = self.file_manager.get_catalog().get(self.file_manager.hash_str)
 
-        if self.file_manager.hash_str in hash_log:
-            md_path = hash_log[self.file_manager.hash_str]["dataset_metadata_filepath"]
+        if entry is not None:
+            md_path = entry["dataset_metadata_filepath"]
             self.file_manager.set_dataset_metadata_path(md_path)
         else:
             print(f"Warning: no metadata path for hash {self.file_manager.hash_str}")
@@ -129,30 +146,78 @@ class LoadSessionDialog(QDialog):
         self.accept()
 
 
+    def done(self, result):
+        # A running load may be blocked on a slow mount, so the dialog closes without waiting for it. The thread is
+        # detached from the dialog, finishes its current request in the background and then deletes itself.
+        self.loader.cancel()
+        for signal in (self.loader.seriesLoaded, self.loader.resultsSorted, self.loader.error):
+            signal.disconnect()
+
+        qthread, loader = self._qthread, self.loader
+        qthread.setParent(None)
+        _closing_loaders.add((qthread, loader))
+        qthread.finished.connect(qthread.deleteLater)
+        qthread.destroyed.connect(lambda: _closing_loaders.discard((qthread, loader)))
+        qthread.quit()
+        super().done(result)
+
+
+    @pyqtSlot(int, object)
+    def _on_series_loaded(self, generation, search_manager):
+        if generation != self.loader.load_generation:
+            return  # A newer load was requested since
+        self.setWindowTitle("Load Session")
+        if search_manager is None:
+            return  # Not a data directory
+
+        self.data_dir = search_manager.data_dir
+        self.init_input_manager()
+        self.search_manager = search_manager
+        self.search_params_updated()
+        if self.sort_field is not None:
+            self.sort_series()
+
+
+    @pyqtSlot(int, str)
+    def _on_load_error(self, generation, msg):
+        if generation != self.loader.load_generation:
+            return
+        self.setWindowTitle("Load Session")
+        QMessageBox.warning(self, "Load Session", msg)
+
+
+    @pyqtSlot(int, object, object, int)
+    def _on_results_sorted(self, generation, search_manager, sort_order, version):
+        if generation != self.loader.sort_generation or search_manager is not self.search_manager:
+            return
+        # A sort of rows a later refresh changed is dropped. The refresh requests a new one.
+        if self.search_manager.set_sort_order(sort_order, version):
+            self.update_display_table()
+
+
 
 
     """
     Update Environment Functions ---------------------------------------------------------------------------------------
     """
     def update_display_table(self):
-        table = self.ui.tableWidget_SearchResultsTable
+        self.filtered_results = self.search_manager.filter_search_results(self.input_manager.search_params)
+        self.results_model.set_rows(self.filtered_results)
 
-        # Clear all previous entries
-        table.setRowCount(0)
 
-        # Set number of rows
-        table.setRowCount(len(self.filtered_results))
+    def load_series(self, data_dir=None):
+        "Loads the catalog of data_dir (default the current data directory) on the worker thread"
+        self.setWindowTitle("Load Session (loading series...)")
+        self.loader.request_load(data_dir if data_dir is not None else self.data_dir)
 
-        for ind in range(len(self.filtered_results)):
-            result = self.filtered_results[ind]
 
-            table.setItem(ind, 0, QTableWidgetItem(result["custom_tag"]))
-            table.setItem(ind, 1, QTableWidgetItem(result["hash"]))
-            table.setItem(ind, 2, QTableWidgetItem(result["dataset"]))
-            table.setItem(ind, 3, QTableWidgetItem(result["variable"]))
-            table.setItem(ind, 4, QTableWidgetItem(f"({result['nx']}x{result['ny']}x{result['nz']})x{result['nt']}"))
-            table.setItem(ind, 5, QTableWidgetItem(result["created"]))
-            table.setItem(ind, 6, QTableWidgetItem(result["last_loaded"]))
+    def sort_series(self):
+        if self.sort_field is None:
+            self.loader.cancel_sort()
+            self.search_manager.set_sort_order(None)
+            self.update_display_table()
+        else:
+            self.loader.request_sort(self.search_manager, self.sort_field, self.sort_descending)
 
 
 
@@ -190,6 +255,33 @@ class LoadSessionDialog(QDialog):
         pass
 
 
+    def init_results_view(self):
+        """
+        Replaces the table widget of the .ui file with a table view of results_model, which formats only the rows that
+        are shown and adds rows as the view scrolls to them
+        """
+        table = self.ui.tableWidget_SearchResultsTable
+        view = QTableView(parent=self.ui.groupBox)
+        view.setFont(table.font())
+        view.setFrameShape(table.frameShape())
+        view.setAlternatingRowColors(True)
+        view.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        view.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        view.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
+        view.setModel(self.results_model)
+        view.horizontalHeader().setStretchLastSection(True)
+        view.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+
+        # No sort column until a header is clicked, rows stay in catalog order
+        view.horizontalHeader().setSortIndicator(-1, Qt.SortOrder.AscendingOrder)
+        view.setSortingEnabled(True)
+
+        self.ui.gridLayout.replaceWidget(table, view)
+        table.deleteLater()
+        self.ui.tableWidget_SearchResultsTable = None
+        self.ui.tableView_SearchResultsTable = view
+
+
     def init_input_manager(self):
         self.input_manager = InputManager(
             lineEdit_RootDirectory=self.ui.lineEdit_RootDirectory,
@@ -212,6 +304,7 @@ class LoadSessionDialog(QDialog):
         dataset_constraints = DatasetConstraints(configs["dataset_constraints"])
         query_method_config = QueryMethodConfig(configs["query_method_config"])
         grid_config = GridConfig(configs["grid_config"])
+        storage_config = StorageConfig(configs.get("storage_config", StorageConfig.LEGACY))
 
         try:
             self.file_manager = FileManager(
@@ -221,7 +314,8 @@ class LoadSessionDialog(QDialog):
                 hash_str=selected_entry["hash"],
                 dataset_constraints=dataset_constraints,
                 query_method_config=query_method_config,
-                grid_config=grid_config
+                grid_config=grid_config,
+                storage_config=storage_config
             )
             self.file_manager.set_dataset_metadata_path(selected_entry["dataset_metadata_filepath"])
         except Exception as e:
@@ -244,8 +338,8 @@ class InputManager:
             "custom_tag": self.widgets["lineEdit_Name"].text().lower(),
             "dataset": self.widgets["lineEdit_DatasetTitle"].text().lower(),
             "variable": self.widgets["lineEdit_Variable"].text().lower(),
-            "last_loaded": self.widgets["dateEdit_LastModified"].text(),
-            "created": self.widgets["dateEdit_Created"].text(),
+            "last_loaded": self.widgets["dateEdit_LastModified"].date().toString("yyyy-MM-dd"),
+            "created": self.widgets["dateEdit_Created"].date().toString("yyyy-MM-dd"),
             "nx": self.widgets["lineEdit_nx"].text(),
             "ny": self.widgets["lineEdit_ny"].text(),
             "nz": self.widgets["lineEdit_nz"].text(),
@@ -279,78 +373,219 @@ class InputManager:
 
 
 class SearchManager:
+    """
+    Searches the series catalog of a data directory. The catalog is read once into a SeriesSearchIndex, so a search
+    (one per keystroke) only touches the rows its filters select. The index is empty until refresh() is called, which
+    SeriesLoader does on its thread. Later refreshes only re-index the series that changed in the catalog.
+
+    refresh() and set_sort_order() may run on another thread than the searches. The index is only changed while
+    holding the manager's lock, which searches take too.
+    """
     def __init__(self, data_dir: Path):
         self.data_dir = data_dir
+        self.index = SeriesSearchIndex()
+        self.sort_order = None  # Row ids of every row in display order, None for catalog order
+        self._sort_rank = None
+        self._lock = threading.Lock()
+
+
+    @property
+    def all_series_data(self):
+        with self._lock:
+            return self.index.search()
+
+
+    def refresh(self, cancelled=None):
+        """
+        Re-indexes the series that were added, changed or removed in the catalog since the last refresh
+
+        :param cancelled: optional callable checked between series, see SeriesSearchIndex.sync
+        :return: False if cancelled before the whole catalog was read
+        """
+        # Directories without turb_data/ (e.g. while a path is typed) have no catalog, and get none created.
+        # The catalog is read before taking the lock, searches only wait for the index updates.
+        entries = []
+        if (Path(self.data_dir) / "turb_data").is_dir():
+            for hash_str, entry in SeriesCatalog(self.data_dir).iter_entries():
+                if cancelled is not None and cancelled():
+                    return False
+                entries.append((hash_str, entry))
+
+        with self._lock:
+            version = self.index.version
+            synced = self.index.sync(entries, cancelled)
+            if self.index.version != version:
+                self.sort_order, self._sort_rank = None, None  # Holds row ids that changed
+        return synced
+
+
+    def set_sort_order(self, sort_order, version=None):
+        """
+        Row ids from SeriesSearchIndex.sorted_ids() to order later results by, None for catalog order
+
+        :param version: index.version the order was computed at. Orders of an index that changed since are dropped.
+        :return: False if the order was dropped
+        """
+        sort_rank = None if sort_order is None else {row_id: rank for rank, row_id in enumerate(sort_order)}
+        with self._lock:
+            if version is not None and version != self.index.version:
+                return False
+            self.sort_order, self._sort_rank = sort_order, sort_rank
+        return True
+
+
+    def filter_search_results(self, search_params=None):
+        with self._lock:
+            row_ids = self.index.search_ids(search_params)
+            if self.sort_order is not None:
+                if len(row_ids) == len(self.sort_order):
+                    row_ids = self.sort_order
+                else:
+                    row_ids = sorted(row_ids, key=self._sort_rank.__getitem__)
+            return [self.index.rows[row_id] for row_id in row_ids]
 
-        self.hash_log = FileManager.load_hash_log(self.data_dir)
-        # self.get_hash_log()
 
-        self.all_series_data = []
-        self.format_search_results()
 
+class SeriesLoader(QObject):
+    """
+    Reads the series catalog into a SearchManager, and sorts its rows, on a worker thread. Moved to a QThread by
+    LoadSessionDialog, which calls request_load() and request_sort() from the GUI thread.
 
+    Every request gets a generation number. A newer load cancels the running one between series, and the dialog drops
+    results whose generation is no longer the latest, so only the last requested directory and sort are shown.
 
-    def format_search_results(self):
-        self.all_series_data = []
-        for hash_ in self.hash_log.keys():
+    The SearchManager of every directory loaded is kept, so loading a directory again only syncs its index with the
+    catalog. Only this thread changes their indices.
+    """
+    seriesLoaded = pyqtSignal(int, object)  # generation, SearchManager, or None if the path is not a directory
+    resultsSorted = pyqtSignal(int, object, object, int)  # generation, SearchManager, sorted row ids, index version
+    error = pyqtSignal(int, str)  # generation, message of a catalog that could not be read
+    _loadRequested = pyqtSignal(int, object)
+    _sortRequested = pyqtSignal(int, object, str, bool)
 
-            series_data = self.hash_log[hash_]
+    def __init__(self):
+        super().__init__()
+        self.load_generation = 0
+        self.sort_generation = 0
+        self._search_managers = {}  # data_dir -> SearchManager
+        # Emitted on the GUI thread, received on the worker thread once moved there
+        self._loadRequested.connect(self._load)
+        self._sortRequested.connect(self._sort)
 
-            last_loaded_dict = series_data["last_loaded"]
 
-            for variable, last_loaded in last_loaded_dict.items():
+    # Called from the GUI thread
+    def request_load(self, data_dir):
+        self.load_generation += 1
+        self.cancel_sort()
+        self._loadRequested.emit(self.load_generation, Path(data_dir))
 
-                data = {
-                    "data_dir" : series_data["data_directory"],
-                    "hash" : hash_,
-                    "custom_tag" : series_data["custom_tag"].lower(),
-                    "dataset" : series_data["dataset"].lower(),
-                    "variable" : variable.lower(),
-                    "last_loaded" : last_loaded,
-                    "created" : series_data["created"],
-                    "nx" : series_data["config"]["grid_config"]["nx"],
-                    "ny" : series_data["config"]["grid_config"]["ny"],
-                    "nz" : series_data["config"]["grid_config"]["nz"],
-                    "nt" : series_data["config"]["grid_config"]["nt"],
-                    "series_dir" : series_data["series_directory"],
-                    "configs" : series_data["config"]
-                }
+    def request_sort(self, search_manager, field, descending):
+        self.sort_generation += 1
+        self._sortRequested.emit(self.sort_generation, search_manager, field, descending)
 
-                self.all_series_data.append(data)
+    def cancel(self):
+        self.load_generation += 1
+        self.cancel_sort()
 
+    def cancel_sort(self):
+        self.sort_generation += 1
 
-    def filter_search_results(self, search_params=None):
-        # search_params = {
-        #     "hash": "", "custom_tag": "", "dataset": "", "variable": "", "last_loaded": "", "created": "", "nx": "",
-        #     "ny": "", "nz": "", "nt": ""
-        # }
 
-        if search_params is None:
-            return self.all_series_data
+    @pyqtSlot(int, object)
+    def _load(self, generation, data_dir):
+        def cancelled():
+            return generation != self.load_generation
 
-        elif all([v in (None, "") for v in search_params.values()]):
-            return self.all_series_data
+        if cancelled():
+            return
+        if not data_dir.is_dir():
+            self.seriesLoaded.emit(generation, None)
+            return
 
-        else:
-            df = pd.DataFrame(self.all_series_data)
-            mask = pd.Series([True] * len(df))
-
-            # String-based filters
-            for key in ["hash", "custom_tag", "dataset", "variable", "last_loaded", "created"]:
-                value = search_params.get(key)
-                if value not in (None, ""):
-                    mask &= df[key].astype(str).str.contains(value, na=False)
-
-            # Numeric-based filters
-            for key in ["nx", "ny", "nz", "nt"]:
-                value = search_params.get(key)
-                if value not in (None, ""):
-                    try:
-                        mask &= df[key] == int(value)
-                    except ValueError:
-                        mask &= df[key].astype(str).str.contains(value, na=False)
-
-            return df[mask].to_dict(orient="records")
+        search_manager = self._search_managers.setdefault(data_dir, SearchManager(data_dir=data_dir))
+        try:
+            if not search_manager.refresh(cancelled):
+                return
+        except Exception as e:
+            self.error.emit(generation, f"Could not read the series catalog of {data_dir}\n{e}")
+            return
+        self.seriesLoaded.emit(generation, search_manager)
+
+
+    @pyqtSlot(int, object, str, bool)
+    def _sort(self, generation, search_manager, field, descending):
+        if generation != self.sort_generation:
+            return
+        # The index only changes on this thread, so it cannot change while it is sorted
+        version = search_manager.index.version
+        sort_order = search_manager.index.sorted_ids(field, descending)
+        self.resultsSorted.emit(generation, search_manager, sort_order, version)
+
+
+
+class SeriesResultsModel(QAbstractTableModel):
+    """
+    Table model of the load dialog's search results. Rows are formatted when the view draws them, and only
+    FETCH_BATCH rows are exposed at a time, more as the view scrolls down (canFetchMore / fetchMore), so showing tens of
+    thousands of results costs no more than showing a screenful. Sorting is left to the dialog, which sorts on the
+    loader's thread: sort() only emits sortRequested.
+    """
+    HEADERS = ["Custom Tag", "Hash", "Dataset", "Variable", "Grid", "Date Created", "Date Last Modified"]
+    SORT_FIELDS = ["custom_tag", "hash", "dataset", "variable", "grid", "created", "last_loaded"]
+    FETCH_BATCH = 256
+
+    sortRequested = pyqtSignal(int, Qt.SortOrder)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+        self._fetched = 0
+
+
+    def set_rows(self, rows):
+        self.beginResetModel()
+        self.rows = rows
+        self._fetched = min(len(rows), self.FETCH_BATCH)
+        self.endResetModel()
+
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self._fetched
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self._fetched < len(self.rows)
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return
+        count = min(self.FETCH_BATCH, len(self.rows) - self._fetched)
+        self.beginInsertRows(QModelIndex(), self._fetched, self._fetched + count - 1)
+        self._fetched += count
+        self.endInsertRows()
+
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if role != Qt.ItemDataRole.DisplayRole or not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        field = self.SORT_FIELDS[index.column()]
+        if field == "grid":
+            return f"({row['nx']}x{row['ny']}x{row['nz']})x{row['nt']}"
+        return str(row[field])
+
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.HEADERS[section]
+        return super().headerData(section, orientation, role)
+
+
+    def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+        self.sortRequested.emit(column, order)
 
 
 
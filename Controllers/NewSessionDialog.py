@@ -8,6 +8,7 @@ from pathlib import Path
 import numpy as np
 import json
 from main_v2.file_managerv2 import FileManager
+from main_v2.series_catalog import SeriesCatalog
 from main_v2.supplementary_classes import DatasetConstraints, QueryMethodConfig, GridConfig, InputManager
 
 
@@ -118,20 +119,9 @@ class NewSessionDialog(QDialog):
         #     self.hash_str, self.ui.comboBox_Input_Variable.currentText().lower())
         # self.file_manager.generate_directories()
         # self.file_manager.generate_files()
-        # Get new entry for hash log
 
-        new_entry = self.file_manager.get_new_hash_log_entry()
-        hash_log_path = self.file_manager.paths.files.hash_log_path
-
-        # Load existing hash log if it exists
-        hash_log = self.file_manager.load_hash_log(self.data_dir)
-
-        # Add new entry to hash log
-        hash_log[self.file_manager.hash_str] = new_entry
-
-        # Write updated hash_log back to file
-        with open(hash_log_path, "w") as f:
-            json.dump(hash_log, f, indent=4)
+        # Add the new series to the catalog of the data directory
+        self.file_manager.register_series()
 
         # Save data directory to QSettings
         self.settings.setValue("data_directory", self.data_dir)
@@ -438,9 +428,7 @@ class NewSessionDialog(QDialog):
 
 
     def hash_is_unique(self):
-        hash_log = FileManager.load_hash_log(self.data_dir)
-
-        return not FileManager.hash_exists(self.hash_str, hash_log)
+        return self.hash_str not in SeriesCatalog(self.data_dir)
 
 """
 INPUT MANAGER ----------------------------------------------------------------------------------------------------------
@@ -0,0 +1,420 @@
+"""
+End-to-end throughput benchmark of the query loop, run headlessly against MockJHTDBBackend.
+
+Every scenario runs the full session lifecycle in a fresh process, so peak RSS is measured per scenario:
+    1. create the series files through FileManager.generate_files
+    2. query the snapshots until resume_fraction of the points is saved, then stop
+    3. resume with a new QueryRunner (state + journal replay) and query every remaining snapshot
+    4. verify the snapshot output against the analytic field of the mock backend
+
+Scenarios are the product of grid sizes, chunk (query size) policies, compression settings and failure rates.
+Results are printed as a table and optionally saved as JSON, which --compare reads back to show the change in
+points/sec per scenario between two runs.
+
+Stage times are summed over every thread that ran the stage, so stages that run concurrently (query, write) can add
+up to more than the wall time.
+
+    Usage:
+            python benchmarks/benchmark_query_loop.py --output bench.json
+            python benchmarks/benchmark_query_loop.py --quick
+            python benchmarks/benchmark_query_loop.py --grids medium --failure-rates 0.1 --compare bench.json
+"""
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import argparse
+import contextlib
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import numpy as np
+
+
+GRIDS = {
+    "small": (32, 16, 16, 2),
+    "medium": (64, 32, 32, 2),
+    "large": (128, 64, 64, 2),
+}
+
+CHUNK_POLICIES = {
+    "pass_fail": {"query_limit_algorithm": "pass_fail", "starting_query_limit": 4096, "query_limit_range": [256, 8192]},
+    "throughput": {"query_limit_algorithm": "throughput", "starting_query_limit": 4096,
+                   "query_limit_range": [256, 8192]},
+    "fixed_1k": {"query_limit_algorithm": "pass_fail", "starting_query_limit": 1024, "query_limit_range": [1024, 1024]},
+}
+
+# StorageConfig of the series per compression setting. The plugin codecs need hdf5plugin, the directory store's
+# codecs other than gzip and none need numcodecs.
+COMPRESSION = {
+    "gzip": {"compression": "gzip"},
+    "none": {"compression": "none"},
+    "lzf": {"compression": "lzf"},
+    "lz4": {"compression": "lz4"},
+    "zstd": {"compression": "zstd"},
+    "blosc_lz4": {"compression": "blosc_lz4"},
+    "directory_gzip": {"compression": "gzip", "backend": "directory"},
+    "directory_none": {"compression": "none", "backend": "directory"},
+    "memmap": {"compression": "none", "backend": "memmap"},
+}
+
+FAILURE_RATES = [0.0, 0.1]
+
+# Shared by every scenario. Requests above soft_point_limit fail more often, which is what the chunk policies react to
+BACKEND_CONFIG = {
+    "base_latency": 0.02,
+    "latency_per_point": 5e-6,
+    "soft_point_limit": 4096,
+    "hard_point_limit": 16384,
+    "max_requests_per_second": 200,
+    "burst_size": 8,
+}
+
+# Channel flow constraints, as created by NewSessionDialog
+DATASET_CONSTRAINTS = {
+    "min_dt": 0.0065, "domain_x": [0, 8 * np.pi], "domain_y": [-1, 1], "domain_z": [0, 3 * np.pi],
+    "domain_t": [0, 25.9935], "max_res_x": 2048, "max_res_y": 512, "max_res_z": 1536,
+    "dataset_variables": ["velocity", "pressure"], "variable_components": {"velocity": 3, "pressure": 1},
+}
+QUERY_METHOD_CONFIG = {
+    "dataset_title": "channel", "temporal_method": "none", "spatial_method": "lag8", "spatial_operator": "field",
+}
+
+
+class StageTimer:
+    "Thread-safe totals of seconds spent and calls made per named stage"
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - t0)
+        return timed
+
+    def to_dict(self):
+        return {stage: {"seconds": round(self.seconds[stage], 6), "calls": self.calls[stage]}
+                for stage in sorted(self.seconds)}
+
+
+def peak_rss_mb():
+    "Peak resident set size of this process so far"
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def build_scenarios(grids, policies, compressions, failure_rates, variables):
+    scenarios = []
+    for grid, policy, compression, failure_rate in itertools.product(grids, policies, compressions, failure_rates):
+        scenarios.append({
+            "name": f"{grid}/{policy}/{compression}/fail={failure_rate:g}",
+            "grid": grid,
+            "grid_shape": list(GRIDS[grid]),
+            "chunk_policy": policy,
+            "compression": compression,
+            "failure_rate": failure_rate,
+            "variables": list(variables),
+        })
+    return scenarios
+
+
+def write_channel_yvals(app_dir):
+    """
+    QuerySession.init_points reads the channel y grid from ../JHUTDDatasets/channel/channel_yvals.txt relative to the
+    working directory. Writes a cosine-spaced stand-in with the dataset's 512 points and returns the directory to
+    run from.
+    """
+    yvals_dir = app_dir / "JHUTDDatasets" / "channel"
+    yvals_dir.mkdir(parents=True, exist_ok=True)
+    yvals = -np.cos(np.linspace(0, np.pi, DATASET_CONSTRAINTS["max_res_y"]))
+    np.savetxt(yvals_dir / "channel_yvals.txt", yvals)
+
+    run_dir = app_dir / "run"
+    run_dir.mkdir(exist_ok=True)
+    return run_dir
+
+
+def run_scenario(scenario, work_dir, resume_fraction=0.5, verify=True):
+    "Runs one scenario in the current process and returns its result dict"
+    from main_v2.file_managerv2 import FileManager
+    from main_v2.query_backends import MockJHTDBBackend
+    from main_v2.query_runner import QueryRunner, QueryEvents
+    from main_v2.supplementary_classes import (DatasetConstraints, QueryMethodConfig, GridConfig, RuntimeConfig,
+                                              StorageConfig)
+
+    rss_baseline = peak_rss_mb()
+    timer = StageTimer()
+
+    work_dir = Path(work_dir)
+    os.chdir(write_channel_yvals(work_dir))
+    data_dir = work_dir / "data"
+
+    nx, ny, nz, nt = scenario["grid_shape"]
+    dataset_constraints = DatasetConstraints(DATASET_CONSTRAINTS)
+    query_method_config = QueryMethodConfig(QUERY_METHOD_CONFIG)
+    grid_config = GridConfig({"nx": nx, "ny": ny, "nz": nz, "nt": nt, "t_bounds": [1, 2], "x_bounds": [0, 8],
+                              "y_bounds": [-0.9, 0.9], "z_bounds": [0, 3]})
+
+    "1. Create the series files"
+    t0 = time.perf_counter()
+    hash_str = FileManager.generate_hash(dataset_constraints, query_method_config, grid_config)
+    fm = FileManager(scenario["variables"][0], data_dir, work_dir, hash_str, dataset_constraints,
+                     query_method_config, grid_config, StorageConfig(COMPRESSION[scenario["compression"]]))
+    fm.set_custom_tag("benchmark")
+    fm.set_dataset_metadata_path(work_dir / "metadata.json")
+    fm.init_files_for_all_variables()
+    fm.set_new_variable(scenario["variables"][0])
+    fm.register_series()
+    timer.add("generate_files", time.perf_counter() - t0)
+
+    runtime_config = RuntimeConfig()
+    for key, val in CHUNK_POLICIES[scenario["chunk_policy"]].items():
+        setattr(runtime_config.tunable, key, val)
+    runtime_config.tunable.wait_range = [0.01, 0.5]
+
+    backend = MockJHTDBBackend(base_failure_rate=scenario["failure_rate"], seed=0, **BACKEND_CONFIG)
+    backend.get_data = timer.wrap("query", backend.get_data)
+
+    total_points = nx * ny * nz * nt * len(scenario["variables"])
+    progress = {"saved_points": 0}
+    buffer_pools = []  # ChunkBufferPool of every lane of both runs
+
+    def make_runner():
+        t_setup = time.perf_counter()
+        runner = QueryRunner(fm, runtime_config, "benchmark", scenario["variables"][0],
+                             variables=scenario["variables"], backend=backend)
+        timer.add("setup", time.perf_counter() - t_setup)
+
+        for lane in runner.lanes:
+            lane.session.save_chunk_data = timer.wrap("write", lane.session.save_chunk_data)
+            lane.session.flush_snapshot = timer.wrap("flush", lane.session.flush_snapshot)
+            lane.session.close_snapshot = timer.wrap("finalize", lane.session.close_snapshot)
+            lane.session.save_state = timer.wrap("save_state", lane.session.save_state)
+            lane.session.record_progress = timer.wrap("journal", lane.session.record_progress)
+            buffer_pools.append(lane.session.buffer_pool)
+        return runner
+
+    "2. Query until resume_fraction of the primary variable's points is saved, then stop"
+    runner = make_runner()
+    stop_at = resume_fraction * nx * ny * nz * nt
+
+    def on_chunk_saved(chunk_indices):
+        progress["saved_points"] += chunk_indices[1] - chunk_indices[0]
+        if progress["saved_points"] >= stop_at:
+            runner.stop()
+
+    runner.subscribe(QueryEvents.CHUNK_SAVED, on_chunk_saved)
+    errors = []
+    runner.subscribe(QueryEvents.ERROR, errors.append)
+
+    t_run = time.perf_counter()
+    runner.run()
+    first_run_seconds = time.perf_counter() - t_run
+    resumed_at = sum(lane.session.count_completed_points() + lane.state.resume_temporal_index * nx * ny * nz
+                     for lane in runner.lanes)
+
+    "3. Resume and finish"
+    t_resume = time.perf_counter()
+    runner = make_runner()
+    runner.subscribe(QueryEvents.ERROR, errors.append)
+    runner.run()
+    resume_run_seconds = time.perf_counter() - t_resume
+    timer.add("resume_run", resume_run_seconds)
+    timer.add("first_run", first_run_seconds)
+
+    total_seconds = first_run_seconds + resume_run_seconds
+
+    "4. Verify and measure the output"
+    output_bytes = 0
+    payload_bytes = 0
+    verified = verify
+    points = runner.session.grid.points
+    for lane in runner.lanes:
+        dims = lane.session.variable_dims
+        storage = lane.session.storage
+        payload_bytes += nx * ny * nz * nt * dims * np.dtype(np.float32).itemsize
+
+        # Every snapshot of a directory store lives in the same store
+        output_paths = {Path(storage.snapshot_path(lane.h5_dir, lane.variable, t)) for t in range(nt)}
+        for path in output_paths:
+            files = path.rglob("*") if path.is_dir() else [path]
+            output_bytes += sum(f.stat().st_size for f in files if f.is_file())
+
+        for time_index in range(nt) if verify else []:
+            expected = MockJHTDBBackend.field_values(lane.variable, points.materialize(),
+                                                     lane.session.grid.time_vector[time_index])
+            verified = (verified and storage.is_snapshot_complete(lane.h5_dir, lane.variable, time_index) and
+                        np.allclose(storage.read_snapshot(lane.h5_dir, lane.variable, time_index), expected))
+
+    "5. Result buffer allocations. Chunks reuse pooled buffers, so this should stay near the number in flight."
+    chunks = sum(pool.num_acquired for pool in buffer_pools)
+    buffer_allocations = sum(pool.num_allocations for pool in buffer_pools)
+
+    return {
+        **scenario,
+        "points": total_points,
+        "seconds": round(total_seconds, 6),
+        "points_per_sec": round(total_points / total_seconds, 3),
+        "bytes_per_sec": round(payload_bytes / total_seconds, 3),
+        "payload_bytes": payload_bytes,
+        "output_bytes": output_bytes,
+        "peak_rss_mb": round(peak_rss_mb(), 3),
+        "rss_baseline_mb": round(rss_baseline, 3),
+        "resumed_at_points": int(resumed_at),
+        "requests": backend.num_requests,
+        "failed_requests": backend.num_failed,
+        "rate_limited_requests": backend.num_rate_limited,
+        "chunks": chunks,
+        "buffer_allocations": buffer_allocations,
+        "buffer_allocations_per_chunk": round(buffer_allocations / max(chunks, 1), 6),
+        "buffer_bytes_allocated": sum(pool.bytes_allocated for pool in buffer_pools),
+        "stages": timer.to_dict(),
+        "errors": errors,
+        "verified": verified,
+    }
+
+
+def _run_scenario_in_child(args):
+    scenario, work_dir, resume_fraction, verify = args
+    try:
+        # The query loop prints every request. Keep the benchmark output readable.
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            return run_scenario(scenario, work_dir, resume_fraction=resume_fraction, verify=verify)
+    except Exception as e:
+        return {**scenario, "errors": [repr(e)]}
+
+
+def run_isolated(scenario, work_dir, resume_fraction=0.5, verify=True):
+    "Runs a scenario in a fresh process so its peak RSS is not inflated by earlier scenarios"
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes=1) as pool:
+        return pool.apply(_run_scenario_in_child, ((scenario, str(work_dir), resume_fraction, verify),))
+
+
+def environment_info():
+    import h5py
+    import pandas
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=Path(__file__).resolve().parents[1]).stdout.strip()
+    except OSError:
+        commit = ""
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pandas.__version__,
+        "h5py": h5py.__version__,
+        "git_commit": commit,
+    }
+
+
+def print_results(results, baseline=None):
+    baseline = {r["name"]: r for r in (baseline or {}).get("results", [])}
+
+    header = f"{'scenario':<40} {'points/s':>12} {'MB/s':>8} {'peak RSS MB':>12} {'reqs':>6} {'fail':>5} {'allocs/chunk':>12} {'ok':>4}"
+    if baseline:
+        header += f" {'vs base':>8}"
+    print(header)
+
+    for r in results:
+        if "points_per_sec" not in r:
+            print(f"{r['name']:<40} error: {r['errors']}")
+            continue
+
+        line = (f"{r['name']:<40} {r['points_per_sec']:>12.0f} {r['bytes_per_sec'] / 1e6:>8.2f} "
+                f"{r['peak_rss_mb']:>12.1f} {r['requests']:>6} {r['failed_requests']:>5} "
+                f"{r.get('buffer_allocations_per_chunk', float('nan')):>12.3f} {'yes' if r['verified'] else 'NO':>4}")
+        if r["name"] in baseline and baseline[r["name"]].get("points_per_sec"):
+            line += f" {r['points_per_sec'] / baseline[r['name']]['points_per_sec'] - 1:>+8.1%}"
+        print(line)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark of the query loop")
+    parser.add_argument("--grids", nargs="+", default=["small", "medium"], choices=sorted(GRIDS))
+    parser.add_argument("--policies", nargs="+", default=["pass_fail", "throughput"], choices=sorted(CHUNK_POLICIES))
+    parser.add_argument("--compression", nargs="+", default=["gzip", "none"], choices=sorted(COMPRESSION))
+    parser.add_argument("--failure-rates", nargs="+", type=float, default=FAILURE_RATES)
+    parser.add_argument("--variables", nargs="+", default=["velocity"])
+    parser.add_argument("--resume-fraction", type=float, default=0.5,
+                        help="Fraction of the primary variable's points saved before the run is stopped and resumed")
+    parser.add_argument("--quick", action="store_true", help="Only the small grid, gzip and the default policy")
+    parser.add_argument("--no-verify", action="store_true", help="Skip checking the output against the mock field")
+    parser.add_argument("--output", type=Path, help="Write the results to this JSON file")
+    parser.add_argument("--compare", type=Path, help="Results JSON of an earlier run to compare points/sec against")
+    parser.add_argument("--work-dir", type=Path, help="Directory for the series files. Defaults to a temp dir.")
+    parser.add_argument("--keep-files", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.quick:
+        args.grids, args.policies, args.compression = ["small"], ["pass_fail"], ["gzip"]
+
+    scenarios = build_scenarios(args.grids, args.policies, args.compression, args.failure_rates, args.variables)
+    root = args.work_dir or Path(tempfile.mkdtemp(prefix="tdm_bench_"))
+
+    results = []
+    try:
+        for i, scenario in enumerate(scenarios):
+            print(f"[{i + 1}/{len(scenarios)}] {scenario['name']}", flush=True)
+            scenario_dir = root / f"scenario_{i:03d}"
+            shutil.rmtree(scenario_dir, ignore_errors=True)
+            scenario_dir.mkdir(parents=True)
+            results.append(run_isolated(scenario, scenario_dir, resume_fraction=args.resume_fraction,
+                                        verify=not args.no_verify))
+    finally:
+        if not args.keep_files and args.work_dir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        "benchmark": "query_loop",
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": environment_info(),
+        "backend": BACKEND_CONFIG,
+        "results": results,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+
+    print()
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"\nResults written to {args.output}")
+
+    return 0 if all(r.get("verified") for r in results) or args.no_verify else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
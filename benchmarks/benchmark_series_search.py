@@ -0,0 +1,203 @@
+"""
+Per-keystroke latency of the load dialog's series search (main_v2.series_search_index.SeriesSearchIndex).
+
+A synthetic catalog of --series entries (two variables each, as in the channel dataset) is indexed, then queries are
+typed one character at a time, each keystroke running a full search with every filter typed so far, as
+LoadSessionDialog.search_params_updated does. With pandas installed the same keystrokes also run through the
+DataFrame filter the dialog used before the index ('dataframe'), and every result is checked against it.
+
+Typing sessions:
+    - hash:        the first 8 characters of a hash
+    - tag:         a custom tag
+    - tag+grid:    a custom tag, then nx
+    - date:        a creation date picked in the date edit, then a dataset
+    - incremental: search while a series is added to and removed from the index between keystrokes
+
+    Usage:
+            python benchmarks/benchmark_series_search.py
+            python benchmarks/benchmark_series_search.py --series 1000 10000 50000 --output search.json
+"""
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import argparse
+import json
+import time
+import numpy as np
+
+from main_v2.series_search_index import SeriesSearchIndex
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+
+DATASETS = ("channel", "isotropic1024coarse", "mhd1024", "transition_bl")
+TAGS = ("re550", "re1000", "baseline", "wall_resolved", "coarse", "validation", "ml_training", "spinup")
+SESSIONS = ("hash", "tag", "tag+grid", "date", "incremental")
+
+
+def make_entries(num_series, seed=0):
+    "Catalog entries in the hash_log.json format, keyed by hash"
+    rng = np.random.default_rng(seed)
+    entries = {}
+    for i in range(num_series):
+        hash_str = f"{rng.integers(0, 2**63):016x}{i:016x}"
+        dataset = DATASETS[i % len(DATASETS)]
+        created = f"{rng.integers(1, 13):02d}/{rng.integers(1, 29):02d}/{rng.integers(2023, 2027)}"
+        entries[hash_str] = {
+            "dataset": dataset,
+            "custom_tag": f"{TAGS[rng.integers(len(TAGS))]}_{i}",
+            "created": created,
+            "completed": {"velocity": False, "pressure": False},
+            "last_loaded": {"velocity": created if i % 3 == 0 else "", "pressure": ""},
+            "series_directory": f"/data/turb_data/{dataset}/series_{i}",
+            "data_directory": "/data",
+            "dataset_metadata_filepath": f"/data/metadata/{dataset}.json",
+            "config": {"grid_config": {"nx": int(rng.choice([64, 128, 256, 512])),
+                                       "ny": int(rng.choice([32, 64, 128])),
+                                       "nz": int(rng.choice([32, 64, 128])), "nt": int(rng.integers(1, 100))}},
+        }
+    return entries
+
+
+def typing_session(session, entries, rng):
+    "Search parameters after each keystroke of a typing session"
+    hash_str, entry = list(entries.items())[rng.integers(len(entries))]
+    steps = []
+    if session == "hash":
+        steps = [{"hash": hash_str[:n]} for n in range(1, 9)]
+    elif session in ("tag", "tag+grid", "incremental"):
+        steps = [{"custom_tag": entry["custom_tag"][:n]} for n in range(1, len(entry["custom_tag"]) + 1)]
+        if session == "tag+grid":
+            nx = str(entry["config"]["grid_config"]["nx"])
+            steps += [{**steps[-1], "nx": nx[:n]} for n in range(1, len(nx) + 1)]
+    elif session == "date":
+        month, day, year = entry["created"].split("/")
+        created = f"{year}-{month}-{day}"
+        steps = [{"created": created}]
+        steps += [{"created": created, "dataset": entry["dataset"][:n]} for n in range(1, len(entry["dataset"]) + 1)]
+    return steps
+
+
+def dataframe_search(rows, search_params):
+    "The DataFrame filter of the load dialog before SeriesSearchIndex, with dates as ISO days"
+    search_params = {**search_params}
+    df = pd.DataFrame(rows)
+    mask = pd.Series([True] * len(df))
+
+    for key in ["created", "last_loaded"]:
+        if search_params.get(key):
+            year, month, day = search_params.pop(key).split("-")
+            search_params[key] = f"{month}/{day}/{year}"
+
+    for key in ["hash", "custom_tag", "dataset", "variable", "last_loaded", "created"]:
+        value = search_params.get(key)
+        if value not in (None, ""):
+            mask &= df[key].astype(str).str.contains(value, na=False, regex=False)
+
+    for key in ["nx", "ny", "nz", "nt"]:
+        value = search_params.get(key)
+        if value not in (None, ""):
+            try:
+                mask &= df[key] == int(value)
+            except ValueError:
+                mask &= df[key].astype(str).str.contains(value, na=False, regex=False)
+
+    return df[mask].to_dict(orient="records")
+
+
+def run(num_series, num_sessions, seed=0):
+    rng = np.random.default_rng(seed)
+    entries = make_entries(num_series, seed)
+
+    t0 = time.perf_counter()
+    index = SeriesSearchIndex()
+    index.sync(entries)
+    build_seconds = time.perf_counter() - t0
+    rows = index.search()
+
+    extra_hash, extra_entry = next(iter(make_entries(1, seed + 1).items()))
+    results = {"series": num_series, "rows": len(rows), "build_seconds": round(build_seconds, 6), "sessions": {}}
+    verified = True
+
+    for session in SESSIONS:
+        latencies = {"index": [], "dataframe": []}
+        for _ in range(num_sessions):
+            for i, search_params in enumerate(typing_session(session, entries, rng)):
+                # Incremental sessions time the index update together with the search
+                t0 = time.perf_counter()
+                if session == "incremental" and i % 2 == 0:
+                    index.add_series(extra_hash, extra_entry)
+                elif session == "incremental":
+                    index.remove_series(extra_hash)
+                found = index.search(search_params)
+                latencies["index"].append(time.perf_counter() - t0)
+
+                if pd is not None:
+                    current_rows = index.search()
+                    t0 = time.perf_counter()
+                    expected = dataframe_search(current_rows, search_params)
+                    latencies["dataframe"].append(time.perf_counter() - t0)
+                    found_keys = [(row["hash"], row["variable"]) for row in found]
+                    if found_keys != [(row["hash"], row["variable"]) for row in expected]:
+                        verified = False
+
+        results["sessions"][session] = {
+            method: {"keystrokes": len(values), "median_ms": round(1e3 * float(np.median(values)), 4),
+                     "p95_ms": round(1e3 * float(np.percentile(values, 95)), 4),
+                     "max_ms": round(1e3 * float(np.max(values)), 4)}
+            for method, values in latencies.items() if values
+        }
+
+    index.remove_series(extra_hash)
+    results["verified"] = verified if pd is not None else None
+    return results
+
+
+def print_results(results):
+    print(f"{'series':>8} {'session':<12} {'method':<10} {'keys':>6} {'median ms':>10} {'p95 ms':>10} {'max ms':>10}")
+    for r in results:
+        for session, methods in r["sessions"].items():
+            for method, stats in methods.items():
+                print(f"{r['series']:>8} {session:<12} {method:<10} {stats['keystrokes']:>6} "
+                      f"{stats['median_ms']:>10.3f} {stats['p95_ms']:>10.3f} {stats['max_ms']:>10.3f}")
+        verified = {True: "yes", False: "NO", None: "-"}[r["verified"]]
+        print(f"{r['series']:>8} index built in {r['build_seconds'] * 1e3:.1f} ms, results match: {verified}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Per-keystroke latency of the series search")
+    parser.add_argument("--series", nargs="+", type=int, default=[1000, 10000], help="Catalog sizes")
+    parser.add_argument("--sessions", type=int, default=20, help="Typing sessions per kind")
+    parser.add_argument("--output", type=Path, help="Write the results to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if pd is None:
+        print("pandas is not installed, only the index is timed")
+
+    results = []
+    for num_series in args.series:
+        print(f"{num_series} series", flush=True)
+        results.append(run(num_series, args.sessions))
+
+    print()
+    print_results(results)
+
+    if args.output:
+        report = {"benchmark": "series_search", "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"\nResults written to {args.output}")
+
+    return 0 if all(r["verified"] is not False for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,312 @@
+"""
+Write and read throughput of the snapshot file layouts (StorageConfig.chunk_layout and snapshot_shape) and
+compression codecs.
+
+For every scenario one snapshot is written through SnapshotWriter in query-sized blocks, as the ChunkWriter thread
+does, using the chunk shape and chunk cache the StorageConfig gives a session. The file is then read back with
+the access patterns of downstream users:
+    - full:    the whole dataset at once
+    - blocks:  consecutive query-sized blocks
+    - y_plane: a few y-planes (planes of constant wall distance in the channel), z-line by z-line from flat datasets
+    - random:  query-sized blocks at random offsets
+    - patch:   16^3 point sub-volumes at random corners, as cut for ML training. Read from flat datasets as the
+               whole z-lines of one x-plane at a time.
+
+Compression ratios depend heavily on the field. The default 'spectral' field is a random-phase velocity field with
+a Kolmogorov (k^-5/3) energy spectrum, which compresses about as badly as real turbulence. 'mock' is the smooth
+analytic field of MockJHTDBBackend. --input uses the dataset and nx/ny/nz attributes of an existing snapshot file,
+e.g. a real download. Reads run right after the write, so the files are usually in the OS page cache and read times
+mostly measure chunk lookup and decompression.
+
+Codecs are given as name or name:level (see main_v2.compression.CODECS). LZ4, Zstd and Blosc need hdf5plugin.
+
+    Usage:
+            python benchmarks/benchmark_snapshot_layout.py --output layout.json
+            python benchmarks/benchmark_snapshot_layout.py --grids medium --layouts query y_plane --query-jitter 0.5
+            python benchmarks/benchmark_snapshot_layout.py --shapes grid --layouts query y_plane --compression zstd:1
+            python benchmarks/benchmark_snapshot_layout.py --compression gzip:1 gzip:6 zstd:1 zstd:9 blosc_lz4 none
+            python benchmarks/benchmark_snapshot_layout.py --input <series dir>/velocity/t=1_of_nt=10__hash=xxxx.h5
+"""
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import argparse
+import itertools
+import json
+import shutil
+import tempfile
+import time
+import numpy as np
+import h5py
+
+from main_v2 import compression
+from main_v2.query_backends import MockJHTDBBackend
+from main_v2.query_session_v2 import LazyPointGrid
+from main_v2.snapshot_writer import SnapshotWriter, read_flat_rows
+from main_v2.supplementary_classes import GridConfig, StorageConfig
+
+
+GRIDS = {
+    "small": (64, 32, 32),
+    "medium": (128, 64, 64),
+    "large": (256, 128, 128),
+}
+
+FIELDS = ("spectral", "mock")
+
+READ_PATTERNS = ("full", "blocks", "y_plane", "random", "patch")
+
+PATCH_SIZE = 16
+
+
+def mock_field(variable, nx, ny, nz):
+    "Analytic field of MockJHTDBBackend on a channel-like grid, shape (nx * ny * nz, dims)"
+    grid = LazyPointGrid(np.linspace(0, 8 * np.pi, nx), -np.cos(np.linspace(0, np.pi, ny)),
+                         np.linspace(0, 3 * np.pi, nz))
+    return MockJHTDBBackend.field_values(variable, grid.materialize(), 1.0)
+
+
+def spectral_field(variable, nx, ny, nz, seed=0):
+    """
+    Random-phase field with a Kolmogorov energy spectrum E(k) ~ k^-5/3, shape (nx * ny * nz, dims), in the point
+    order of LazyPointGrid. Each component is normalized to unit variance.
+    """
+    rng = np.random.default_rng(seed)
+    dims = len(MockJHTDBBackend.columns_of(variable))
+
+    kx = np.fft.fftfreq(nx) * nx
+    ky = np.fft.fftfreq(ny) * ny
+    kz = np.fft.rfftfreq(nz) * nz
+    k = np.sqrt(kx[:, None, None]**2 + ky[None, :, None]**2 + kz[None, None, :]**2)
+    k[0, 0, 0] = np.inf
+
+    # |u_k|^2 * k^2 ~ E(k) ~ k^-5/3 in 3D
+    amplitude = k**(-11 / 6)
+
+    components = []
+    for _ in range(dims):
+        phases = np.exp(2j * np.pi * rng.random(k.shape))
+        component = np.fft.irfftn(amplitude * phases, s=(nx, ny, nz))
+        components.append((component / component.std()).ravel())
+
+    return np.column_stack(components).astype(np.float32)
+
+
+def parse_codec(spec):
+    "'zstd:5' -> ('zstd', 5), 'gzip' -> ('gzip', None)"
+    name, _, level = spec.partition(":")
+    compression.get_codec(name)
+    return name, int(level) if level else None
+
+
+def default_codecs():
+    codecs = ["gzip", "lzf", "none"]
+    if compression.plugins_available():
+        codecs += ["lz4", "zstd:1", "zstd:5", "blosc_lz4", "blosc_zstd"]
+    return codecs
+
+
+def load_field(h5_path):
+    "Flat dataset and (nx, ny, nz) of an existing snapshot file"
+    with h5py.File(h5_path, "r") as h5:
+        name = next(key for key in h5.keys() if isinstance(h5[key], h5py.Dataset))
+        data = h5[name][:].astype(np.float32)
+        return name, data.reshape(-1, data.shape[-1]), (int(h5.attrs["nx"]), int(h5.attrs["ny"]), int(h5.attrs["nz"]))
+
+
+def query_blocks(num_points, query_rows, jitter, rng):
+    "[start, end) blocks covering the volume. jitter > 0 varies their sizes, like an adaptive query limit does."
+    start = 0
+    while start < num_points:
+        rows = query_rows if jitter <= 0 else int(query_rows * rng.uniform(1 - jitter, 1 + jitter))
+        end = min(start + max(rows, 1), num_points)
+        yield start, end
+        start = end
+
+
+def read_y_plane(dset, iy, nx, ny, nz):
+    "(nx, nz, dims) values of y-plane iy"
+    if dset.ndim == 4:
+        return dset[:, iy, :, :]
+    return np.stack([dset[(ix * ny + iy) * nz:(ix * ny + iy + 1) * nz] for ix in range(nx)])
+
+
+def read_patch(dset, corner, size, ny, nz):
+    "(sx, sy, sz, dims) values of the sub-volume at corner"
+    (ix, iy, iz), (sx, sy, sz) = corner, size
+    if dset.ndim == 4:
+        return dset[ix:ix + sx, iy:iy + sy, iz:iz + sz, :]
+    planes = [dset[(x * ny + iy) * nz:(x * ny + iy + sy) * nz].reshape(sy, nz, -1)[:, iz:iz + sz]
+              for x in range(ix, ix + sx)]
+    return np.stack(planes)
+
+
+def run_scenario(scenario, field, shape, work_dir, query_rows, jitter, seed=0):
+    nx, ny, nz = shape
+    num_points, dims = field.shape
+    payload_bytes = field.nbytes
+    rng = np.random.default_rng(seed)
+
+    grid_config = GridConfig({"nx": nx, "ny": ny, "nz": nz, "nt": 1, "t_bounds": [0, 0], "x_bounds": [0, 0],
+                              "y_bounds": [0, 0], "z_bounds": [0, 0]})
+    codec, level = parse_codec(scenario["compression"])
+    storage_config = StorageConfig({"chunk_layout": scenario["layout"], "compression": codec,
+                                    "compression_level": level, "snapshot_shape": scenario["shape"]})
+    chunks = storage_config.chunk_shape(grid_config, dims, query_rows)
+    max_query_rows = int(query_rows * (1 + max(jitter, 0)))
+    chunk_cache = storage_config.chunk_cache(chunks, max_query_rows, grid_config=grid_config)
+
+    h5_path = Path(work_dir) / f"{scenario['name'].replace('/', '_').replace(':', '-')}.h5"
+
+    "1. Write in query-sized blocks"
+    t0 = time.perf_counter()
+    writer = SnapshotWriter(h5_path, "field", 0, chunk_cache=chunk_cache)
+    writer.create(shape=storage_config.dataset_shape(grid_config, dims), attrs={"nx": nx, "ny": ny, "nz": nz, **storage_config.compression_attrs()},
+                  dtype=np.float32, chunks=chunks, **storage_config.filter_kwargs())
+    num_writes = 0
+    for start, end in query_blocks(num_points, query_rows, jitter, rng):
+        writer.write((start, end), field[start:end])
+        num_writes += 1
+    writer.close(final_attrs={"is_complete": True})
+    write_seconds = time.perf_counter() - t0
+
+    "2. Read back"
+    read_seconds = {}
+    read_bytes = {}
+    with h5py.File(h5_path, "r", **chunk_cache) as h5:
+        dset = h5["field"]
+        actual_chunks = dset.chunks
+
+        t0 = time.perf_counter()
+        data = dset[:]
+        read_seconds["full"], read_bytes["full"] = time.perf_counter() - t0, data.nbytes
+        verified = bool(np.array_equal(data.reshape(field.shape), field))
+
+        t0 = time.perf_counter()
+        nbytes = 0
+        for start, end in query_blocks(num_points, query_rows, 0, rng):
+            nbytes += read_flat_rows(dset, start, end).nbytes
+        read_seconds["blocks"], read_bytes["blocks"] = time.perf_counter() - t0, nbytes
+
+        t0 = time.perf_counter()
+        nbytes = 0
+        for iy in np.linspace(0, ny - 1, min(ny, 4)).astype(int):
+            nbytes += read_y_plane(dset, iy, nx, ny, nz).nbytes
+        read_seconds["y_plane"], read_bytes["y_plane"] = time.perf_counter() - t0, nbytes
+
+        t0 = time.perf_counter()
+        nbytes = 0
+        for start in rng.integers(0, max(num_points - query_rows, 1), size=64):
+            nbytes += read_flat_rows(dset, start, min(start + query_rows, num_points)).nbytes
+        read_seconds["random"], read_bytes["random"] = time.perf_counter() - t0, nbytes
+
+        t0 = time.perf_counter()
+        nbytes = 0
+        size = tuple(min(PATCH_SIZE, n) for n in (nx, ny, nz))
+        for corner in zip(*(rng.integers(0, n - s + 1, size=16) for n, s in zip((nx, ny, nz), size))):
+            nbytes += read_patch(dset, corner, size, ny, nz).nbytes
+        read_seconds["patch"], read_bytes["patch"] = time.perf_counter() - t0, nbytes
+
+    file_bytes = h5_path.stat().st_size
+    h5_path.unlink()
+
+    return {
+        **scenario,
+        "points": num_points,
+        "dims": dims,
+        "chunks": list(actual_chunks) if actual_chunks else None,
+        "chunk_cache": chunk_cache,
+        "writes": num_writes,
+        "payload_bytes": payload_bytes,
+        "file_bytes": file_bytes,
+        "compression_level": storage_config.compression_attrs()["compression_level"],
+        "compression_ratio": round(payload_bytes / max(file_bytes, 1), 4),
+        "write_seconds": round(write_seconds, 6),
+        "write_mb_per_sec": round(payload_bytes / write_seconds / 1e6, 3),
+        "read_mb_per_sec": {pattern: round(read_bytes[pattern] / read_seconds[pattern] / 1e6, 3)
+                            for pattern in READ_PATTERNS},
+        "verified": verified,
+    }
+
+
+def print_results(results):
+    header = f"{'scenario':<42} {'chunks':>12} {'ratio':>6} {'write MB/s':>11}"
+    header += "".join(f" {pattern + ' MB/s':>13}" for pattern in READ_PATTERNS) + f" {'ok':>4}"
+    print(header)
+
+    for r in results:
+        if "error" in r:
+            print(f"{r['name']:<42} error: {r['error']}")
+            continue
+
+        chunks = "x".join(str(c) for c in r["chunks"]) if r["chunks"] else "-"
+        line = f"{r['name']:<42} {chunks:>12} {r['compression_ratio']:>6.2f} {r['write_mb_per_sec']:>11.1f}"
+        line += "".join(f" {r['read_mb_per_sec'][pattern]:>13.1f}" for pattern in READ_PATTERNS)
+        print(line + f" {'yes' if r['verified'] else 'NO':>4}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Write and read throughput of the snapshot file layouts")
+    parser.add_argument("--grids", nargs="+", default=["small", "medium"], choices=sorted(GRIDS))
+    parser.add_argument("--layouts", nargs="+", default=list(StorageConfig.CHUNK_LAYOUTS),
+                        choices=StorageConfig.CHUNK_LAYOUTS)
+    parser.add_argument("--shapes", nargs="+", default=list(StorageConfig.SNAPSHOT_SHAPES),
+                        choices=StorageConfig.SNAPSHOT_SHAPES)
+    parser.add_argument("--compression", nargs="+", default=default_codecs(),
+                        help="Codecs as name or name:level. Defaults to every available codec.")
+    parser.add_argument("--field", default="spectral", choices=FIELDS)
+    parser.add_argument("--variable", default="velocity")
+    parser.add_argument("--input", type=Path, help="Snapshot file whose field is used instead of the mock field")
+    parser.add_argument("--query-rows", type=int, default=4000, help="Points per write, i.e. the query size")
+    parser.add_argument("--query-jitter", type=float, default=0.0,
+                        help="Vary write sizes by up to this fraction, like the adaptive query limit does")
+    parser.add_argument("--output", type=Path, help="Write the results to this JSON file")
+    parser.add_argument("--work-dir", type=Path, help="Directory for the snapshot files. Defaults to a temp dir.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.input:
+        name, field, shape = load_field(args.input)
+        fields = {f"{args.input.stem}:{name}": (field, shape)}
+    else:
+        make_field = spectral_field if args.field == "spectral" else mock_field
+        fields = {f"{grid}-{args.field}": (make_field(args.variable, *GRIDS[grid]), GRIDS[grid]) for grid in args.grids}
+
+    root = args.work_dir or Path(tempfile.mkdtemp(prefix="tdm_layout_"))
+    root.mkdir(parents=True, exist_ok=True)
+
+    results = []
+    try:
+        for (field_name, (field, shape)), snapshot_shape, layout, compression in itertools.product(
+                fields.items(), args.shapes, args.layouts, args.compression):
+            scenario = {"name": f"{field_name}/{snapshot_shape}/{layout}/{compression}", "field": field_name,
+                        "shape": snapshot_shape, "layout": layout, "compression": compression}
+            print(scenario["name"], flush=True)
+            try:
+                results.append(run_scenario(scenario, field, shape, root, args.query_rows, args.query_jitter))
+            except (ImportError, ValueError) as e:
+                results.append({**scenario, "error": str(e), "verified": False})
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print()
+    print_results(results)
+
+    if args.output:
+        report = {"benchmark": "snapshot_layout", "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "query_rows": args.query_rows, "query_jitter": args.query_jitter, "results": results}
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"\nResults written to {args.output}")
+
+    return 0 if all(r["verified"] for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+import threading
+import numpy as np
+
+
+class ChunkBufferPool:
+    """
+    Reusable float32 buffers of shape (capacity, dims) for queried chunks.
+
+    A buffer is acquired on the query thread, filled with one conversion from the getData response, written by the
+    ChunkWriter thread and then released back to the pool. Only a handful of buffers exist at any time (one per
+    chunk in flight or queued for writing), so steady-state querying allocates nothing per chunk. Capacities are
+    rounded up to a power of two so small changes of the query size still reuse the same buffers.
+
+        Usage:
+                pool = ChunkBufferPool(dims=3)
+                buffer = pool.acquire(num_rows)      # (capacity >= num_rows, 3) float32
+                buffer[:num_rows] = values
+                pool.release(buffer)
+    """
+    def __init__(self, dims, dtype=np.float32, max_idle_buffers=32):
+        self.dims = int(dims)
+        self.dtype = np.dtype(dtype)
+        self.max_idle_buffers = int(max_idle_buffers)
+
+        self._idle = []
+        self._lock = threading.Lock()
+
+        # Counters for benchmarks
+        self.num_acquired = 0
+        self.num_allocations = 0
+        self.bytes_allocated = 0
+
+
+    def acquire(self, num_rows):
+        "Returns an idle buffer with at least num_rows rows, allocating one only if none fits"
+        num_rows = max(int(num_rows), 1)
+
+        with self._lock:
+            self.num_acquired += 1
+
+            # Smallest idle buffer that fits
+            best = None
+            for i, buffer in enumerate(self._idle):
+                if buffer.shape[0] >= num_rows and (best is None or buffer.shape[0] < self._idle[best].shape[0]):
+                    best = i
+            if best is not None:
+                return self._idle.pop(best)
+
+            capacity = 1 << (num_rows - 1).bit_length()
+            self.num_allocations += 1
+            self.bytes_allocated += capacity * self.dims * self.dtype.itemsize
+
+        return np.empty((capacity, self.dims), dtype=self.dtype)
+
+
+    def release(self, buffer):
+        with self._lock:
+            self._idle.append(buffer)
+
+            # Keep the largest buffers when over the limit, they can hold any chunk the smaller ones could
+            if len(self._idle) > self.max_idle_buffers:
+                self._idle.remove(min(self._idle, key=lambda b: b.shape[0]))
+
+
+    def stats(self):
+        return {"acquired": self.num_acquired, "allocations": self.num_allocations,
+                "bytes_allocated": self.bytes_allocated, "idle": len(self._idle)}
+
+
+class ChunkResult:
+    """
+    Values of one queried chunk as a float32 (num_points, dims) view into a pooled buffer, plus the parts of the
+    getData response the snapshot attributes are built from.
+
+    from_response converts the response DataFrame straight into the buffer: one cast/copy per chunk, and the writer
+    writes the view without further copies. Call release() once the data has been written.
+    """
+    def __init__(self, data, axes, columns, source_dtype, pool=None, buffer=None):
+        self.data = data
+        self.axes = axes
+        self.columns = columns
+        self.source_dtype = source_dtype
+
+        self._pool = pool
+        self._buffer = buffer
+
+
+    @classmethod
+    def from_response(cls, response, pool=None):
+        """
+        :param response: getData result, i.e. a list holding one DataFrame. A bare DataFrame or array also works.
+        :param pool: ChunkBufferPool to take the buffer from. Without a pool a new buffer is allocated.
+        """
+        frame = response[0] if isinstance(response, (list, tuple)) else response
+
+        # A view of the DataFrame's block for single-dtype frames, so the copy below is the only one
+        values = frame.to_numpy(copy=False) if hasattr(frame, "to_numpy") else np.asarray(frame)
+        if values.ndim == 1:
+            values = values.reshape(-1, 1)
+        num_rows, dims = values.shape
+
+        if pool is not None and dims == pool.dims:
+            buffer = pool.acquire(num_rows)
+        else:
+            pool, buffer = None, np.empty((num_rows, dims), dtype=np.float32)
+
+        data = buffer[:num_rows]
+        try:
+            np.copyto(data, values, casting="same_kind")
+        except Exception:
+            if pool is not None:
+                pool.release(buffer)
+            raise
+
+        return cls(
+            data=data,
+            axes=[str(ax) for ax in frame.axes] if hasattr(frame, "axes") else [],
+            columns=[str(c) for c in frame.columns] if hasattr(frame, "columns") else [],
+            source_dtype=str(values.dtype),
+            pool=pool,
+            buffer=buffer
+        )
+
+
+    def release(self):
+        "Returns the buffer to its pool. The data must not be used afterwards."
+        if self._pool is not None and self._buffer is not None:
+            self._pool.release(self._buffer)
+        self._buffer = None
+        self.data = None
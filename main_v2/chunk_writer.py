@@ -0,0 +1,152 @@
+import queue
+import threading
+
+
+class ChunkWriter:
+    """
+    Writes queried chunks to their snapshot files on a dedicated thread so the query loop never waits on compression.
+
+    Chunks are handed over through a bounded queue. When the queue is full, submit() blocks until the writer catches
+    up, which keeps the number of results held in memory bounded. The snapshot file stays open between chunks and is
+    flushed whenever the queue runs dry or flush_interval chunks have been written. Chunks are reported back through
+    get_completed() only after that flush, so the caller can safely advance the state.
+
+        Usage:
+                writer = ChunkWriter(session, h5_dir, max_queue_size=8)
+                writer.start()
+                writer.submit(result, chunk_indices, time_index)
+                for chunk_indices, time_index, error in writer.get_completed():
+                    ...
+                writer.finalize_snapshot(time_index)
+                writer.close()
+    """
+    _WRITE = "write"
+    _FINALIZE = "finalize"
+
+    def __init__(self, session, h5_dir, max_queue_size=8, flush_interval=16, on_complete=None,
+                 on_snapshot_complete=None):
+        self.session = session
+        self.h5_dir = h5_dir
+        self.flush_interval = max(1, int(flush_interval))
+
+        # Called from the writer thread whenever completions are ready, e.g. to wake the query loop
+        self.on_complete = on_complete
+        # Called from the writer thread with the time index of every snapshot file it marks complete
+        self.on_snapshot_complete = on_snapshot_complete
+
+        self._tasks = queue.Queue(maxsize=max(1, int(max_queue_size)))
+        self._completed = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="chunk-writer", daemon=True)
+
+        # Chunks written since the last flush. Only touched from the writer thread.
+        self._unflushed = []
+
+        # (time_index, chunk_indices) handed to the writer but not yet reported back. Only touched from the
+        # submitting thread.
+        self.pending_ranges = set()
+
+
+    def start(self):
+        self._thread.start()
+
+
+    def submit(self, result, chunk_indices, time_index):
+        "Queues a chunk for writing. Blocks while the queue is full."
+        self.pending_ranges.add((time_index, tuple(chunk_indices)))
+        self._tasks.put((self._WRITE, (result, tuple(chunk_indices), time_index)))
+
+
+    def finalize_snapshot(self, time_index):
+        "Queues closing and marking complete the snapshot file of time_index, after every chunk already queued."
+        self._tasks.put((self._FINALIZE, time_index))
+
+
+    def get_completed(self, timeout=0.0):
+        """
+        Collects every chunk the writer has written and flushed since the last call.
+
+        :param timeout: [float] seconds to wait for the first completion if none is ready yet. 0 does not block.
+
+        :return: list of (chunk_indices, time_index, error) tuples. error is None if the write succeeded.
+                 chunk_indices is None for errors raised while finalizing a snapshot.
+        """
+        completed = []
+        try:
+            if timeout > 0:
+                completed.append(self._completed.get(timeout=timeout))
+            while True:
+                completed.append(self._completed.get_nowait())
+        except queue.Empty:
+            pass
+
+        for chunk_indices, time_index, _ in completed:
+            self.pending_ranges.discard((time_index, chunk_indices))
+
+        return completed
+
+
+    def close(self):
+        "Writes and flushes everything still queued, closes the open snapshot file, then stops the writer thread."
+        if self._thread.is_alive():
+            self._tasks.put(None)
+            self._thread.join()
+
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                self._flush()
+                self._close_snapshot()
+                break
+
+            kind, payload = task
+            if kind == self._FINALIZE:
+                self._flush()
+                self._close_snapshot(time_index=payload, is_complete=True)
+                continue
+
+            result, chunk_indices, time_index = payload
+            try:
+                self.session.save_chunk_data(result=result, chunk_indices=chunk_indices, h5_dir=self.h5_dir,
+                                             time_index=time_index)
+                self._unflushed.append((chunk_indices, time_index))
+            except Exception as e:
+                self._report([(chunk_indices, time_index, e)])
+
+            if self._tasks.empty() or len(self._unflushed) >= self.flush_interval:
+                self._flush()
+
+
+    def _flush(self):
+        "Flushes the open snapshot file and reports every chunk written since the last flush"
+        if not self._unflushed:
+            return
+
+        try:
+            self.session.flush_snapshot()
+            error = None
+        except Exception as e:
+            error = e
+
+        self._report([(chunk_indices, time_index, error) for chunk_indices, time_index in self._unflushed])
+        self._unflushed = []
+
+
+    def _close_snapshot(self, time_index=None, is_complete=False):
+        try:
+            self.session.close_snapshot(h5_dir=self.h5_dir, time_index=time_index, is_complete=is_complete)
+        except Exception as e:
+            self._report([(None, time_index, e)])
+            return
+
+        if is_complete and time_index is not None and self.on_snapshot_complete is not None:
+            self.on_snapshot_complete(time_index)
+
+
+    def _report(self, completions):
+        for completion in completions:
+            self._completed.put(completion)
+
+        if self.on_complete is not None:
+            self.on_complete()
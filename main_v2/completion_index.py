@@ -0,0 +1,293 @@
+"""
+Records of which point ranges of a snapshot were written, with a CRC-32 of the values of every range, updated together
+with the data. They let a resumed or finished series be checked against its state file from metadata alone, and every
+range's values be checked against their checksum without trusting the state at all.
+
+    - HDF5 snapshots keep a CompletionIndex inside the snapshot file: a "completion" group holding the [start, end,
+      crc32] records and a bitmap with one bit per storage chunk that is set once the chunk is fully written (per
+      block of DEFAULT_BLOCK_SIZE points for grid shaped snapshots, whose chunks are not point ranges). A flush of the
+      data appends the records added since the previous one and rewrites only the bitmap bytes they changed, so its
+      cost does not grow with the number of chunks written. Closing the snapshot compacts the records.
+    - The directory and memmap backends append the records to a CompletionLog per writer, so shards writing the same
+      snapshot never share a file. The index is rebuilt from the logs when it is read.
+
+    Usage:
+            index = CompletionIndex(n_points, block_size=chunk_rows)
+            index.add((start, end), data_array)
+            missing = index.missing_ranges(state_ranges)
+            corrupt = index.corrupt_ranges(read_rows, state_ranges)
+"""
+from bisect import bisect_right
+from pathlib import Path
+import numpy as np
+import struct
+import zlib
+
+
+class CompletionIndex:
+    """
+    Non-overlapping [start, end, crc32] records of the written ranges of one snapshot, ordered by start.
+
+    A range written again (e.g. re-queried after a resume) replaces the records it overlaps, whose checksums no
+    longer match the data. Indices built from chunk allocation instead of records (files written before the index
+    existed) have no checksums.
+
+    In a snapshot file the records are stored in the order they were added, so replaying them rebuilds the index,
+    including the replacements. The bits of the blocks a record touches are updated as it is added.
+    """
+    GROUP = "completion"
+    DEFAULT_BLOCK_SIZE = 4096
+
+    def __init__(self, n_points, block_size=DEFAULT_BLOCK_SIZE, records=(), has_checksums=True):
+        self.n_points = int(n_points)
+        self.block_size = max(1, int(block_size))
+        self.has_checksums = has_checksums
+        self.is_dirty = False
+
+        self._starts = []
+        self._records = []
+        self._bits = np.zeros(-(-self.n_points // self.block_size), dtype=bool)
+        self._reset_pending(0)
+        for start, end, crc in records:
+            self.add_record(start, end, crc)
+        self.is_dirty = False
+
+
+    @staticmethod
+    def checksum(data):
+        "CRC-32 of the values as stored, i.e. C ordered float32"
+        return zlib.crc32(np.ascontiguousarray(data, dtype=np.float32))
+
+
+    def add(self, chunk_indices, data):
+        self.add_record(chunk_indices[0], chunk_indices[1], self.checksum(data))
+
+
+    def add_record(self, start, end, crc):
+        start, end = int(start), int(end)
+        if end <= start:
+            return
+
+        i = bisect_right(self._starts, start)
+        lo = i - 1 if i > 0 and self._records[i - 1][1] > start else i
+        hi = i
+        while hi < len(self._records) and self._records[hi][0] < end:
+            hi += 1
+
+        # Replaced records may reach past the new one, the blocks they covered there are no longer complete
+        replaced_start = min([start] + [record[0] for record in self._records[lo:hi]])
+        replaced_end = max([end] + [record[1] for record in self._records[lo:hi]])
+
+        del self._starts[lo:hi]
+        del self._records[lo:hi]
+        self._starts.insert(lo, start)
+        self._records.insert(lo, (start, end, int(crc)))
+        self._pending.append((start, end, int(crc)))
+        self.is_dirty = True
+
+        self._update_bits(replaced_start, replaced_end)
+
+
+    def _update_bits(self, start, end):
+        "Recomputes the bits of the blocks overlapping [start, end)"
+        first, last = start // self.block_size, min(-(-end // self.block_size), len(self._bits))
+        for block in range(first, last):
+            block_start = block * self.block_size
+            self._bits[block] = self._is_covered(block_start, min(block_start + self.block_size, self.n_points))
+
+        if first < last:
+            self._dirty_blocks = (min(self._dirty_blocks[0], first), max(self._dirty_blocks[1], last))
+
+
+    def _is_covered(self, start, end):
+        "Whether the records cover [start, end). Only looks at the records overlapping it."
+        i = max(bisect_right(self._starts, start) - 1, 0)
+        covered_to = start
+        while i < len(self._records) and covered_to < end:
+            record_start, record_end, _ = self._records[i]
+            if record_start > covered_to:
+                return False
+            covered_to = max(covered_to, record_end)
+            i += 1
+        return covered_to >= end
+
+
+    def _reset_pending(self, num_written):
+        "Marks everything as written, with num_written records stored in the file"
+        self._pending = []
+        self._num_written = num_written
+        self._dirty_blocks = (len(self._bits), 0)
+        self.is_dirty = False
+
+
+    @property
+    def records(self):
+        "(k, 3) uint64 array of [start, end, crc32]"
+        return np.array(self._records, dtype=np.uint64).reshape(-1, 3)
+
+
+    def covered_ranges(self):
+        "Merged [start, end) ranges written so far"
+        merged = []
+        for start, end, _ in self._records:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
+
+
+    def missing_ranges(self, ranges):
+        "Parts of the [start, end) ranges that were never written"
+        covered = self.covered_ranges()
+        missing = []
+        for start, end in ranges:
+            for covered_start, covered_end in covered:
+                if covered_end <= start:
+                    continue
+                if covered_start >= end:
+                    break
+                if covered_start > start:
+                    missing.append([start, covered_start])
+                start = max(start, covered_end)
+            if start < end:
+                missing.append([start, end])
+        return missing
+
+
+    def is_complete(self, point_range=None):
+        return not self.missing_ranges([point_range or (0, self.n_points)])
+
+
+    def bitmap(self):
+        "One bit per block of block_size points (np.packbits order), set if the block is fully written"
+        return np.packbits(self._bits)
+
+
+    def corrupt_ranges(self, read_rows, ranges=None):
+        """
+        Records whose values no longer match their checksum. Reads (and decompresses) the data of every record.
+
+        :param read_rows: function (start, end) -> values of points [start, end) of the snapshot
+        :param ranges: Optional [start, end) ranges, only the records overlapping them are checked
+        :return: list of [start, end] of the corrupt records
+        """
+        if not self.has_checksums:
+            return []
+
+        corrupt = []
+        for start, end, crc in self._records:
+            if ranges is not None and not any(start < range_end and end > range_start
+                                              for range_start, range_end in ranges):
+                continue
+            if self.checksum(read_rows(start, end)) != crc:
+                corrupt.append([start, end])
+        return corrupt
+
+
+    @classmethod
+    def read_h5(cls, h5):
+        "The index kept in an open snapshot file, None if the file predates it"
+        group = h5.get(cls.GROUP)
+        if group is None:
+            return None
+        ranges = group["ranges"][:]
+        index = cls(group.attrs["n_points"], group.attrs["block_size"], ranges)
+        index._reset_pending(len(ranges))
+        return index
+
+    def write_h5(self, h5, compact=False):
+        """
+        Writes the records added since the last write, and the bitmap bytes they changed, into an open snapshot file
+
+        :param compact: rewrite all records instead, dropping the ones that were replaced (e.g. when closing the file)
+        """
+        group = h5.get(self.GROUP)
+        if group is None:
+            group = h5.create_group(self.GROUP)
+            group.attrs["n_points"] = self.n_points
+            group.attrs["block_size"] = self.block_size
+            group.create_dataset("ranges", shape=(0, 3), maxshape=(None, 3), dtype=np.uint64, chunks=(1024, 3))
+        ranges = group["ranges"]
+        if compact:
+            records = self.records
+            ranges.resize(len(records), axis=0)
+            if len(records):
+                ranges[:] = records
+            num_written = len(records)
+        else:
+            ranges.resize(self._num_written + len(self._pending), axis=0)
+            if self._pending:
+                ranges[self._num_written:] = np.array(self._pending, dtype=np.uint64)
+            num_written = self._num_written + len(self._pending)
+
+        if "bitmap" not in group:
+            group.create_dataset("bitmap", data=self.bitmap())
+        elif self._dirty_blocks[0] < self._dirty_blocks[1]:
+            # Whole bytes of the changed blocks
+            first_byte, last_byte = self._dirty_blocks[0] // 8, -(-self._dirty_blocks[1] // 8)
+            group["bitmap"][first_byte:last_byte] = np.packbits(self._bits[first_byte * 8:last_byte * 8])
+
+        self._reset_pending(num_written)
+
+
+    @classmethod
+    def from_logs(cls, n_points, block_size, log_paths):
+        "Index of every record of the logs. The logs of different writers cover disjoint ranges."
+        index = cls(n_points, block_size)
+        for log_path in log_paths:
+            for start, end, crc in CompletionLog.read_records(log_path):
+                index.add_record(start, end, crc)
+        index.is_dirty = False
+        return index
+
+
+class CompletionLog:
+    """
+    Append-only binary log of the ranges one writer wrote into a snapshot, in the format of ProgressJournal.
+
+    Record layout (little endian, 24 bytes):
+        int64 start | int64 end | uint32 crc32 of the range's values | uint32 crc32 of the preceding fields
+    """
+    _BODY = struct.Struct("<qqI")
+    _CRC = struct.Struct("<I")
+    RECORD_SIZE = _BODY.size + _CRC.size
+
+    def __init__(self, log_path):
+        self.log_path = Path(log_path)
+        self._f = None
+
+
+    def append(self, chunk_indices, data):
+        body = self._BODY.pack(int(chunk_indices[0]), int(chunk_indices[1]), CompletionIndex.checksum(data))
+
+        if self._f is None:
+            self.log_path.parent.mkdir(parents=True, exist_ok=True)
+            self._f = open(self.log_path, "ab")
+        self._f.write(body + self._CRC.pack(zlib.crc32(body)))
+        self._f.flush()
+
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+    @classmethod
+    def read_records(cls, log_path):
+        "Yields (start, end, crc32) of every intact record, stopping at the first torn one"
+        log_path = Path(log_path)
+        if not log_path.is_file():
+            return
+
+        with open(log_path, "rb") as f:
+            data = f.read()
+
+        for offset in range(0, len(data) - cls.RECORD_SIZE + 1, cls.RECORD_SIZE):
+            body = data[offset:offset + cls._BODY.size]
+            (crc,) = cls._CRC.unpack_from(data, offset + cls._BODY.size)
+            if zlib.crc32(body) != crc:
+                return
+
+            yield cls._BODY.unpack(body)
@@ -0,0 +1,100 @@
+"""
+Compression codecs of snapshot datasets.
+
+gzip, lzf and none are built into h5py. The LZ4, Zstd and Blosc codecs are HDF5 filter plugins shipped by the optional
+hdf5plugin package. They are registered once, when this module is imported: StorageConfig imports it, so every
+session, shard and series that opens snapshot files can also read files written with them.
+
+    Usage:
+            kwargs = filter_kwargs("zstd", level=5)     # {"compression": ..., "compression_opts": ..., "shuffle": True}
+            h5.create_dataset(name, shape, dtype, chunks=chunks, **kwargs)
+"""
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+
+class Codec:
+    def __init__(self, name, description, default_level=None, level_range=None, needs_plugin=False):
+        self.name = name
+        self.description = description
+        self.default_level = default_level
+        self.level_range = level_range
+        self.needs_plugin = needs_plugin
+
+
+CODECS = {
+    "none": Codec("none", "No compression"),
+    "gzip": Codec("gzip", "Deflate, portable but slow", default_level=4, level_range=(0, 9)),
+    "lzf": Codec("lzf", "Fast, but only readable through h5py"),
+    "lz4": Codec("lz4", "Byte shuffle + LZ4", needs_plugin=True),
+    "zstd": Codec("zstd", "Byte shuffle + Zstandard", default_level=3, level_range=(1, 22), needs_plugin=True),
+    "blosc_lz4": Codec("blosc_lz4", "Blosc with byte shuffle + LZ4", default_level=5, level_range=(0, 9),
+                       needs_plugin=True),
+    "blosc_zstd": Codec("blosc_zstd", "Blosc with byte shuffle + Zstandard", default_level=5, level_range=(0, 9),
+                        needs_plugin=True),
+}
+
+
+def plugins_available():
+    return hdf5plugin is not None
+
+
+def resolve_level(codec, level=None):
+    "Level used for codec: the given one clipped to the codec's range, its default, or None for levelless codecs"
+    codec = get_codec(codec)
+    if codec.level_range is None:
+        return None
+    if level is None:
+        return codec.default_level
+    return min(max(int(level), codec.level_range[0]), codec.level_range[1])
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown compression codec '{name}'. Choose from {tuple(CODECS)}")
+
+
+def filter_kwargs(codec, level=None):
+    """
+    Keyword arguments of h5py create_dataset for codec
+
+    :raises: ImportError if the codec is an HDF5 plugin and hdf5plugin is not installed
+    """
+    codec = get_codec(codec)
+    level = resolve_level(codec.name, level)
+
+    if codec.needs_plugin and hdf5plugin is None:
+        raise ImportError(f"Compression codec '{codec.name}' needs the hdf5plugin package: pip install hdf5plugin")
+
+    if codec.name == "none":
+        return {"compression": None, "compression_opts": None, "shuffle": False}
+    if codec.name == "gzip":
+        return {"compression": "gzip", "compression_opts": level, "shuffle": False}
+    if codec.name == "lzf":
+        return {"compression": "lzf", "compression_opts": None, "shuffle": True}
+
+    # Plugin filters, given as the compression/compression_opts mapping hdf5plugin builds
+    if codec.name == "lz4":
+        return {**hdf5plugin.LZ4(), "shuffle": True}
+    if codec.name == "zstd":
+        return {**hdf5plugin.Zstd(clevel=level), "shuffle": True}
+
+    cname = codec.name.split("_", 1)[1]
+    return {**hdf5plugin.Blosc(cname=cname, clevel=level, shuffle=hdf5plugin.Blosc.SHUFFLE), "shuffle": False}
+
+
+def filter_kwargs_of(dset):
+    """
+    Filter keyword arguments that recreate the compression of an existing dataset. Uses the codec recorded in the
+    snapshot attributes, since h5py does not report plugin filters in dset.compression.
+    """
+    attrs = dset.file.attrs
+    if "compression" in attrs:
+        level = attrs.get("compression_level", -1)
+        return filter_kwargs(str(attrs["compression"]), None if level < 0 else int(level))
+
+    return {"compression": dset.compression, "compression_opts": dset.compression_opts, "shuffle": dset.shuffle}
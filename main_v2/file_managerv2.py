@@ -1,15 +1,16 @@
-from main_v2.query_manager  import *
 import hashlib
 import json
 from datetime import datetime
-from main_v2.supplementary_classes import State, RuntimeConfig
+from main_v2.supplementary_classes import (State, RuntimeConfig, DatasetConstraints, QueryMethodConfig, GridConfig,
+                                          StorageConfig)
+from main_v2.series_catalog import SeriesCatalog
 from pathlib import Path
 
 
 
 class FileManager:
-    def __init__(self, variable, data_dir, app_dir, hash_str, dataset_constraints, query_method_config, grid_config):
-
+    def __init__(self, variable, data_dir, app_dir, hash_str, dataset_constraints, query_method_config, grid_config,
+                 storage_config=None):
 
         self.data_dir = data_dir
         self.app_dir = app_dir
@@ -17,6 +18,7 @@ class FileManager:
         self.dataset_constraints = dataset_constraints
         self.query_method_config = query_method_config
         self.grid_config = grid_config
+        self.storage_config = storage_config if storage_config is not None else StorageConfig()
 
         self.variable = variable
         self.paths = None
@@ -35,19 +37,8 @@ class FileManager:
 
     @staticmethod
     def load_hash_log(data_dir: Path):
-        hash_log_path = data_dir / "turb_data" / "hash_log.json"
-
-        if hash_log_path.exists():
-            try:
-                with open(hash_log_path, "r") as f:
-                    content = f.read().strip()
-                    if not content:
-                        return {}
-                    return json.loads(content)
-            except (json.JSONDecodeError, OSError):
-                return {}
-        else:
-            return {}
+        "Every series entry of the data directory's catalog keyed by hash, in the format of hash_log.json"
+        return SeriesCatalog(data_dir).entries()
 
 
     @staticmethod
@@ -133,6 +124,7 @@ class FileManager:
                 "grid_config": self.grid_config.__dict__,
                 "query_method_config": self.query_method_config.__dict__,
                 "dataset_constraints": self.dataset_constraints.__dict__,
+                "storage_config": self.storage_config.__dict__,
             }}
 
         return entry
@@ -159,6 +151,15 @@ class FileManager:
             return json.load(f)
 
 
+    def get_catalog(self):
+        return SeriesCatalog(self.data_dir)
+
+
+    def register_series(self):
+        "Adds the series' entry to the catalog of its data directory"
+        self.get_catalog().add(self.hash_str, self.get_new_hash_log_entry())
+
+
     def init_files_for_all_variables(self):
         "Initialize directories and state.json for every dataset variable"
         for var in self.dataset_constraints.dataset_variables:
@@ -175,12 +176,96 @@ class FileManager:
         self.paths.generate_new_session_log_filename(new_var)
 
 
+    def get_variable_paths(self, variable):
+        "SeriesPaths for any variable of the series, without changing the selected variable"
+        paths = SeriesPaths(self.data_dir, self.hash_str, self.query_method_config, self.grid_config)
+        paths.generate_variable_dependent_paths(self.hash_str, variable)
+        paths.files.dataset_metadata_path = self.paths.files.dataset_metadata_path
+
+        return paths
+
+
+    def get_shard_paths(self, variable, shard):
+        "SeriesPaths of one shard of the series. Its state, journal and snapshot files live in their own directory."
+        paths = self.get_variable_paths(variable)
+        paths.generate_shard_paths(self.hash_str, variable, shard.name)
+
+        return paths
+
+
+    def init_shard_files(self, variable, shard):
+        """
+        Creates the directory, spec and initial state of a shard, unless they exist already from an earlier run
+
+        :return: SeriesPaths of the shard
+        """
+        paths = self.get_shard_paths(variable, shard)
+        Path.mkdir(paths.dirs.series_var_dir, parents=True, exist_ok=True)
+
+        if not paths.files.shard_spec_path.exists():
+            FileManager._write_new_json(path=paths.files.shard_spec_path, _dict=shard.to_dict())
+
+        if not paths.files.state_path.exists():
+            state = State()
+            state.volume_start_index = shard.point_range[0]
+            state.resume_volume_index = shard.point_range[0]
+            state.resume_temporal_index = shard.time_range[0]
+            FileManager._write_new_json(path=paths.files.state_path, _dict=state.to_dict())
+
+        return paths
+
+
+    def mark_variable_complete(self, variable, completed=True):
+        "Sets completed[variable] of the series' catalog entry, or clears it if completed is False"
+        self.get_catalog().set_completed(self.hash_str, variable, completed)
+
+
+    def set_storage_config(self, storage_config):
+        "Replaces the storage config of the series, e.g. after its snapshots were converted to another backend"
+        self.storage_config = storage_config
+        self.get_catalog().update_config(self.hash_str, "storage_config", storage_config.__dict__)
+
+
 
 
 
     """
     Load Manager Sequence
     """
+    @classmethod
+    def load_from_hash_log(cls, data_dir: Path, hash_str, variable=None, app_dir=None):
+        """
+        Builds the FileManager of an existing series from its catalog entry, without any dialog
+
+        :param hash_str: full series hash, or a unique prefix of it (e.g. the 8 characters in the series directory name)
+        :param variable: selected variable. Defaults to the first dataset variable.
+        """
+        data_dir = Path(data_dir)
+        catalog = SeriesCatalog(data_dir)
+
+        matches = catalog.match_hash(hash_str)
+        if len(matches) != 1:
+            raise KeyError(f"{len(matches)} series in {catalog.path} match hash {hash_str}")
+
+        entry = catalog.get(matches[0])
+        configs = entry["config"]
+        dataset_constraints = DatasetConstraints(configs["dataset_constraints"])
+
+        self = cls(
+            variable=variable or dataset_constraints.dataset_variables[0],
+            data_dir=data_dir,
+            app_dir=app_dir or data_dir,
+            hash_str=matches[0],
+            dataset_constraints=dataset_constraints,
+            query_method_config=QueryMethodConfig(configs["query_method_config"]),
+            grid_config=GridConfig(configs["grid_config"]),
+            storage_config=StorageConfig(configs.get("storage_config", StorageConfig.LEGACY))
+        )
+        self.set_dataset_metadata_path(entry["dataset_metadata_filepath"])
+
+        return self
+
+
     # @classmethod
     # def load_file_manager(cls, variable, root_dir, hash_str, dataset_constraints, query_method_config, grid_config):
     #     # Instantiate self
@@ -212,12 +297,14 @@ class Files:
     def __init__(self):
         # Listed variables are listed for reference but compiled elsewhere
         self.hash_log_path = None
+        self.catalog_path = None
         self.series_config_path = None
         self.runtime_config_path = None
         self.state_path = None
         self.current_log_path = None
         self.dataset_metadata_path = None
         self.yvals_path = None
+        self.shard_spec_path = None
 
 class BlankSlates:
     def __init__(self):
@@ -239,6 +326,7 @@ class SeriesPaths:
         self.dirs.series_dir = data_dir / "turb_data" / qmc.dataset_title / self.series_filename
 
         self.files.hash_log_path = self.dirs.turb_data_dir / "hash_log.json"
+        self.files.catalog_path = self.dirs.turb_data_dir / SeriesCatalog.FILENAME
 
 
     @staticmethod
@@ -263,6 +351,16 @@ class SeriesPaths:
         self.files.state_path = self.dirs.series_var_dir / f"state__{variable}_{hash_str[:8]}.json"
 
 
+    def generate_shard_paths(self, hash_str:str, variable:str, shard_name:str):
+        "Points series_var_dir and state_path at a shard's own directory inside series_var_dir/shards"
+        self.dirs.shards_dir = self.dirs.series_dir / variable / "shards"
+        self.dirs.series_var_dir = self.dirs.shards_dir / shard_name
+        self.dirs.variable_log_dir = self.dirs.series_var_dir / "logs"
+
+        self.files.state_path = self.dirs.series_var_dir / f"state__{variable}_{hash_str[:8]}__{shard_name}.json"
+        self.files.shard_spec_path = self.dirs.series_var_dir / "shard.json"
+
+
     def generate_new_session_log_filename(self, variable):
         dt_now = datetime.now().strftime("%m_%d_%Y__%H_%M_%S")
         self.files.current_log_path = self.dirs.variable_log_dir / f"session_log__{dt_now}__{variable}__{self.hash_str[:8]}"
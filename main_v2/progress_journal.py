@@ -0,0 +1,83 @@
+from pathlib import Path
+import struct
+import zlib
+
+
+class ProgressJournal:
+    """
+    Append-only binary log of completed chunk ranges, written next to the state file.
+
+    Each saved chunk costs one fixed-size append instead of a full state.json rewrite. The journal is compacted
+    (truncated) whenever the full State is saved. State.load_from_json replays it on top of the last saved state.
+
+    Record layout (little endian, 32 bytes):
+        int32 time_index | int64 start | int64 end | float64 query_limit | uint32 crc32 of the preceding fields
+
+        Usage:
+                journal = ProgressJournal(ProgressJournal.path_for_state(state_path))
+                journal.append(time_index, (start, end), query_limit)
+                for time_index, start, end, query_limit in ProgressJournal.read_records(journal.journal_path):
+                    ...
+    """
+    _BODY = struct.Struct("<iqqd")
+    _CRC = struct.Struct("<I")
+    RECORD_SIZE = _BODY.size + _CRC.size
+
+    def __init__(self, journal_path):
+        self.journal_path = Path(journal_path)
+        self.num_records = 0
+        self._f = None
+
+
+    @staticmethod
+    def path_for_state(state_path):
+        return Path(state_path).with_suffix(".journal")
+
+
+    def append(self, time_index, chunk_indices, query_limit):
+        body = self._BODY.pack(int(time_index), int(chunk_indices[0]), int(chunk_indices[1]), float(query_limit))
+
+        self._open().write(body + self._CRC.pack(zlib.crc32(body)))
+        self._f.flush()
+        self.num_records += 1
+
+
+    def truncate(self):
+        "Drops every record. Only call once the State they describe has been saved."
+        self._open().truncate(0)
+        self._f.flush()
+        self.num_records = 0
+
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+    @classmethod
+    def read_records(cls, journal_path):
+        """
+        Yields (time_index, start, end, query_limit) for every intact record.
+        Stops at the first torn or corrupt record, e.g. one cut short by a crash.
+        """
+        journal_path = Path(journal_path)
+        if not journal_path.is_file():
+            return
+
+        with open(journal_path, "rb") as f:
+            data = f.read()
+
+        for offset in range(0, len(data) - cls.RECORD_SIZE + 1, cls.RECORD_SIZE):
+            body = data[offset:offset + cls._BODY.size]
+            (crc,) = cls._CRC.unpack_from(data, offset + cls._BODY.size)
+            if zlib.crc32(body) != crc:
+                return
+
+            yield cls._BODY.unpack(body)
+
+
+    def _open(self):
+        if self._f is None:
+            self._f = open(self.journal_path, "ab")
+        return self._f
@@ -0,0 +1,191 @@
+import numpy as np
+import pandas as pd
+import random
+import threading
+import time
+
+
+class JHTDBBackend:
+    """
+    Queries the live JHTDB service through givernylocal. Default backend of QuerySession.
+
+        Usage:
+                backend = JHTDBBackend()
+                turb_obj = backend.get_turbdata_object(dataset_title, output_path, auth_token)
+                result = backend.get_data(turb_obj, variable, time_val, temporal_method, spatial_method,
+                                          spatial_operator, points)
+    """
+    def __init__(self):
+        # Imported here, so the mock backend, run_headless --mock-backend and the benchmarks work without givernylocal
+        from givernylocal.turbulence_toolkit import getData, turb_dataset
+        self._get_data = getData
+        self._turb_dataset = turb_dataset
+
+    def get_turbdata_object(self, dataset_title, output_path, auth_token):
+        return self._turb_dataset(dataset_title=dataset_title, output_path=str(output_path), auth_token=auth_token)
+
+    def get_data(self, turbdata_object, variable, time_val, temporal_method, spatial_method, spatial_operator, points):
+        return self._get_data(turbdata_object, variable, time_val, temporal_method, spatial_method, spatial_operator,
+                              points)
+
+
+class MockTurbDataset:
+    "Stand-in for the turb_dataset object, returned by MockJHTDBBackend.get_turbdata_object"
+    def __init__(self, dataset_title, output_path, auth_token):
+        self.dataset_title = dataset_title
+        self.output_path = str(output_path)
+        self.auth_token = auth_token
+
+
+class MockQueryError(Exception):
+    pass
+
+
+class MockJHTDBBackend:
+    """
+    Local, simulated JHTDB for benchmarks and offline tests. Nothing is sent over the network.
+
+    Every request sleeps base_latency + latency_per_point * num_points seconds, then either fails or returns
+    analytic field values in the same form as getData: a list holding one float32 DataFrame with an 'index' axis and
+    the variable's component columns (e.g. ux, uy, uz). Results are deterministic in (points, time), so downloads can be
+    verified against MockJHTDBBackend.field_values.
+
+    Failures:
+        - each request fails with probability failure_probability(num_points): base_failure_rate below
+          soft_point_limit, rising linearly to 1 at hard_point_limit
+        - with max_requests_per_second set, requests beyond that rate (token bucket of burst_size) fail immediately,
+          like an HTTP 429
+
+    Sleeps can be scaled down with time_scale, e.g. 0.1 runs ten times faster than the modelled service.
+
+        Usage:
+                backend = MockJHTDBBackend(latency_per_point=2e-5, soft_point_limit=2000, hard_point_limit=8000)
+                runner = QueryRunner(file_manager, runtime_config, auth_token, variable, backend=backend)
+    """
+    VARIABLE_COLUMNS = {
+        "velocity": ["ux", "uy", "uz"],
+        "pressure": ["p"],
+        "magneticfield": ["bx", "by", "bz"],
+        "vectorpotential": ["ax", "ay", "az"],
+        "temperature": ["t"],
+        "density": ["rho"],
+    }
+
+    def __init__(self, base_latency=0.05, latency_per_point=2e-5, base_failure_rate=0.0, soft_point_limit=None,
+                 hard_point_limit=None, max_requests_per_second=None, burst_size=1, time_scale=1.0, seed=None):
+        self.base_latency = base_latency
+        self.latency_per_point = latency_per_point
+        self.base_failure_rate = base_failure_rate
+        self.soft_point_limit = soft_point_limit
+        self.hard_point_limit = hard_point_limit
+        self.max_requests_per_second = max_requests_per_second
+        self.burst_size = max(1, int(burst_size))
+        self.time_scale = time_scale
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst_size)
+        self._last_refill = time.monotonic()
+
+        # Counters of every request made, e.g. for benchmark reports
+        self.num_requests = 0
+        self.num_failed = 0
+        self.num_rate_limited = 0
+        self.num_points_returned = 0
+
+
+    def get_turbdata_object(self, dataset_title, output_path, auth_token):
+        return MockTurbDataset(dataset_title, output_path, auth_token)
+
+
+    def get_data(self, turbdata_object, variable, time_val, temporal_method, spatial_method, spatial_operator, points):
+        points = np.asarray(points, dtype=np.float64)
+        num_points = len(points)
+
+        with self._lock:
+            self.num_requests += 1
+            rate_limited = not self._take_token()
+            failed = rate_limited or self._rng.random() < self.failure_probability(num_points)
+            if rate_limited:
+                self.num_rate_limited += 1
+            if failed:
+                self.num_failed += 1
+
+        if rate_limited:
+            self._sleep(self.base_latency)
+            raise MockQueryError(f"HTTP Error 429.\nRate limit of {self.max_requests_per_second} requests/s exceeded")
+
+        self._sleep(self.base_latency + self.latency_per_point * num_points)
+        if failed:
+            raise MockQueryError(f"HTTP Error 500.\nSimulated failure for a request of {num_points} points")
+
+        values = self.field_values(variable, points, time_val)
+        df = pd.DataFrame(data=values, columns=self.columns_of(variable))
+        df.index.name = "index"
+
+        with self._lock:
+            self.num_points_returned += num_points
+
+        return [df]
+
+
+    def failure_probability(self, num_points):
+        p = self.base_failure_rate
+        if self.soft_point_limit is not None and num_points > self.soft_point_limit:
+            hard = self.hard_point_limit if self.hard_point_limit is not None else 2 * self.soft_point_limit
+            p += (num_points - self.soft_point_limit) / max(hard - self.soft_point_limit, 1)
+        elif self.hard_point_limit is not None and num_points > self.hard_point_limit:
+            p = 1.0
+
+        return min(max(p, 0.0), 1.0)
+
+
+    @classmethod
+    def columns_of(cls, variable):
+        return cls.VARIABLE_COLUMNS.get(variable.lower(), [variable.lower()])
+
+
+    @classmethod
+    def field_values(cls, variable, points, time_val):
+        """
+        Analytic field sampled at points, shape (num_points, num_components), float32. A divergence-free
+        Taylor-Green-like vortex for vector variables and a matching pressure-like field for scalars.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        x, y, z = points[:, 0], points[:, 1], points[:, 2]
+        decay = np.exp(-0.1 * float(time_val))
+
+        num_components = len(cls.columns_of(variable))
+        if num_components == 3:
+            values = np.column_stack([
+                decay * np.sin(x) * np.cos(y) * np.cos(z),
+                -decay * np.cos(x) * np.sin(y) * np.cos(z),
+                0.1 * decay * np.sin(x + y + z + time_val),
+            ])
+        else:
+            base = 0.25 * decay**2 * (np.cos(2 * x) + np.cos(2 * y)) * (np.cos(2 * z) + 2)
+            values = np.column_stack([base + i for i in range(num_components)])
+
+        return values.astype(np.float32)
+
+
+    def _take_token(self):
+        "Token bucket rate limit. Must be called with self._lock held."
+        if not self.max_requests_per_second:
+            return True
+
+        now = time.monotonic()
+        elapsed = (now - self._last_refill) / max(self.time_scale, 1e-9)
+        self._tokens = min(self.burst_size, self._tokens + elapsed * self.max_requests_per_second)
+        self._last_refill = now
+
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+
+    def _sleep(self, seconds):
+        seconds *= self.time_scale
+        if seconds > 0:
+            time.sleep(seconds)
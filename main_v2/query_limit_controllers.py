@@ -0,0 +1,89 @@
+import numpy as np
+
+
+class ThroughputQueryLimitController:
+    """
+    Picks the query size that delivers the most points per second, using the latency and outcome of every request.
+
+    The allowed range [qmin, qmax] is split into log-spaced bins. Each bin keeps exponentially decayed totals of
+    points delivered and seconds spent; failed requests add their time and the backoff wait they trigger, but no
+    points, so sizes that fail often score low. The controller mostly requests the best bin and regularly probes its
+    neighbours, so it follows the server as its sustainable request size drifts.
+
+        Usage:
+                controller = ThroughputQueryLimitController(query_limit_range=(100, 4000))
+                controller.record(num_points=4000, latency=2.3, query_passed=True)
+                controller.record(num_points=4000, latency=30.0, query_passed=False, wait=12.0)
+                query_limit = controller.next_query_limit()
+    """
+    def __init__(self, query_limit_range, num_bins=16, decay=0.9, min_samples=2, explore_every=5):
+        qmin, qmax = query_limit_range
+        self.qmin = max(1, int(qmin))
+        self.qmax = max(self.qmin, int(qmax))
+
+        self.num_bins = max(1, int(num_bins))
+        self.decay = decay
+        self.min_samples = min_samples
+        self.explore_every = max(2, int(explore_every))
+
+        self.edges = np.geomspace(self.qmin, self.qmax + 1, self.num_bins + 1)
+        self.centers = np.clip(np.sqrt(self.edges[:-1] * self.edges[1:]), self.qmin, self.qmax)
+
+        self.points = np.zeros(self.num_bins)
+        self.seconds = np.zeros(self.num_bins)
+        self.samples = np.zeros(self.num_bins, dtype=int)
+
+        self.num_decisions = 0
+
+
+    def record(self, num_points, latency, query_passed, wait=0):
+        """
+        :param wait: seconds of backoff the request triggered before the next attempt, charged to its bin
+        """
+        b = self._bin_of(num_points)
+        self.points[b] = self.decay * self.points[b] + (num_points if query_passed else 0)
+        self.seconds[b] = self.decay * self.seconds[b] + max(float(latency) + float(wait), 1e-6)
+        self.samples[b] += 1
+
+
+    def throughput(self):
+        "Estimated points per second of every bin. NaN for bins without samples."
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.samples > 0, self.points / self.seconds, np.nan)
+
+
+    def best_query_limit(self):
+        "Center of the bin with the highest estimated throughput, or None before any samples"
+        estimates = self.throughput()
+        if np.all(np.isnan(estimates)):
+            return None
+        return int(self.centers[int(np.nanargmax(estimates))])
+
+
+    def next_query_limit(self, current_query_limit=None):
+        self.num_decisions += 1
+        estimates = self.throughput()
+
+        if np.all(np.isnan(estimates)):
+            start = self.qmax if current_query_limit is None else current_query_limit
+            return int(min(max(start, self.qmin), self.qmax))
+
+        best = int(np.nanargmax(estimates))
+        neighbours = [b for b in (best - 1, best + 1) if 0 <= b < self.num_bins]
+
+        # Neighbours of the best bin need a few samples before the estimate can be trusted
+        under_sampled = [b for b in neighbours if self.samples[b] < self.min_samples]
+        if under_sampled:
+            return int(self.centers[under_sampled[0]])
+
+        # Re-probe a neighbour regularly so the estimate keeps up with changing server load
+        if neighbours and self.num_decisions % self.explore_every == 0:
+            probe = neighbours[(self.num_decisions // self.explore_every) % len(neighbours)]
+            return int(self.centers[probe])
+
+        return int(self.centers[best])
+
+
+    def _bin_of(self, num_points):
+        b = int(np.searchsorted(self.edges, num_points, side="right")) - 1
+        return min(max(b, 0), self.num_bins - 1)
@@ -0,0 +1,505 @@
+from main_v2.supplementary_classes import State
+from main_v2.query_session_v2 import QuerySession
+from main_v2.chunk_writer import ChunkWriter
+from main_v2.query_scheduler import QueryScheduler
+from main_v2.series_dataset import SeriesDataset
+from main_v2.series_verifier import SeriesVerifier
+from concurrent.futures import ThreadPoolExecutor
+import time
+import traceback, sys
+
+
+class Flags:
+    def __init__(self):
+        pass
+
+
+class VariableLane:
+    "Everything a QueryRunner keeps per variable: its session, state file, writer and finalized snapshots"
+    def __init__(self, variable, session, paths, data_dir=None):
+        """
+        :param data_dir: Optional directory the snapshots are written to. Defaults to the series_var_dir of paths.
+        """
+        self.variable = variable
+        self.session = session
+        self.state = session.state
+        self.paths = paths
+        self.data_dir = data_dir
+
+        self.writer = None
+        self.series_dataset = None
+        self.finalized_snapshots = set()
+        self.is_complete = False
+        # Bumped by every counted failure. Requests dispatched before it failed in the same outage.
+        self.failure_round = 0
+
+    @property
+    def state_path(self):
+        return self.paths.files.state_path
+
+    @property
+    def h5_dir(self):
+        return self.data_dir if self.data_dir is not None else self.paths.dirs.series_var_dir
+
+
+class QueryEvents:
+    """
+    Names of the events published by QueryRunner, with the arguments passed to their subscribers
+
+        Usage:
+                runner.subscribe(QueryEvents.SPATIAL_PROGRESS, lambda done, total: print(done, total))
+    """
+    SPATIAL_PROGRESS = "spatial_progress"       # (num_completed_points, total_points) of the primary variable
+    CHUNK_SAVED = "chunk_saved"                 # (chunk_indices,)
+    SNAPSHOT_COMPLETE = "snapshot_complete"     # (time_index,)
+    TEMPORAL_PROGRESS = "temporal_progress"     # (num_completed_snapshots, nt)
+    VARIABLE_COMPLETE = "variable_complete"     # (variable,)
+    SERIES_COMPLETE = "series_complete"         # ()
+    STATUS = "status"                           # (message,)
+    LOG_MESSAGE = "log_message"                 # (message,)
+    ERROR = "error"                             # (traceback_str,)
+
+
+class QueryRunner:
+    """
+    Runs the query loop of a series without any Qt dependency, e.g. on compute nodes without a display.
+
+    Progress is reported by calling the subscribers of each QueryEvents name from the thread that runs run().
+    pause(), resume() and stop() may be called from any thread.
+
+        Usage:
+                runner = QueryRunner(file_manager, runtime_config, auth_token, variable="velocity")
+                runner.subscribe(QueryEvents.STATUS, print)
+                runner.run()
+    """
+    def __init__(self, file_manager, runtime_config, auth_token, variable, executor=None, variables=None,
+                 backend=None, shard=None):
+        """
+        :param executor: Optional ThreadPoolExecutor shared by several sessions. A private pool sized to
+                         tunable.max_in_flight_queries is created (and shut down) by run() otherwise.
+        :param variables: Optional list of dataset variables to download in the same run. Every variable keeps its
+                          own state file and snapshot files, but they share the grid, the turb_dataset object, the
+                          thread pool and the retry scheduler. Progress events report on `variable`.
+        :param backend: Optional query backend shared by every variable, e.g. a MockJHTDBBackend for offline runs.
+                        Defaults to the live JHTDBBackend.
+        :param shard: Optional ShardSpec. The run then only queries the shard's spatial index range and time indices,
+                      keeping its state and snapshot files under series_var_dir/shards. Shards are assembled into the
+                      series' snapshot files by ShardMerger. With a storage backend that supports parallel writers
+                      (the directory store) the shard writes straight into the series' store instead.
+        """
+        self.fm = file_manager
+        self.runtime_config = runtime_config
+        self.auth_token = auth_token
+        self.variable = variable
+        self.variables = [variable] + [var for var in (variables or []) if var != variable]
+
+        self.flags = Flags()
+        self._subscribers = {}  # QueryEvents name -> list of callbacks
+
+        self.flags.stopped = False
+        self.flags.paused = False
+
+        self.shard = shard
+        self.executor = executor
+        self.scheduler = QueryScheduler()
+        self._dispatch_offset = 0
+
+        # The first session builds the grid and time vector. The other variables reuse them.
+        self.lanes = []
+        grid = None
+        for var in self.variables:
+            if shard is None:
+                paths = self.fm.get_variable_paths(var)
+            else:
+                paths = self.fm.init_shard_files(var, shard)
+
+            session = QuerySession(
+                dataset_constraints = self.fm.dataset_constraints,
+                query_method_config = self.fm.query_method_config,
+                grid_config = self.fm.grid_config,
+                runtime_config = self.runtime_config,
+                state = State.load_from_json(paths.files.state_path),
+                variable = var,
+                auth_token = self.auth_token,
+                hash_str=self.fm.hash_str,
+                grid=grid,
+                backend=backend,
+                point_range=shard.point_range if shard is not None else None,
+                time_range=shard.time_range if shard is not None else None,
+                storage_config=self.fm.storage_config
+            )
+            grid = session.grid
+
+            data_dir = None
+            if shard is not None and session.storage.supports_parallel_writers:
+                data_dir = self.fm.get_variable_paths(var).dirs.series_var_dir
+            self.lanes.append(VariableLane(variable=var, session=session, paths=paths, data_dir=data_dir))
+
+        # The primary variable's session, as used by the progress signals
+        self.session = self.lanes[0].session
+        self.state = self.lanes[0].state
+        # self.num_spatial_points = self.fm.grid_config.nx * self.fm.grid_config.ny * self.fm.grid_config.nz
+
+
+    def subscribe(self, event, callback):
+        "Registers callback for one of the QueryEvents names"
+        self._subscribers.setdefault(event, []).append(callback)
+
+    def unsubscribe(self, event, callback):
+        if callback in self._subscribers.get(event, []):
+            self._subscribers[event].remove(callback)
+
+    def _emit(self, event, *args):
+        for callback in list(self._subscribers.get(event, [])):
+            callback(*args)
+
+
+    def run(self):
+        """
+        Main loop for Querying
+
+        Up to runtime_config.tunable.max_in_flight_queries chunk requests are in flight at once, each covering a
+        disjoint index range of the current snapshot (or of the next tunable.snapshot_lookahead snapshots) of one
+        of the variables. Results are handed to each variable's ChunkWriter thread in the order they complete, and
+        a variable's state only advances once its writer reports a chunk as written.
+        """
+        in_flight = {}  # Future -> (lane, time_index, chunk_indices, lane.failure_round at dispatch)
+        executor, owns_executor = None, False
+        try:
+            "When a session is started, get:"
+            turb_obj = self.session.get_turbdata_object(
+                dataset_title=self.fm.query_method_config.dataset_title.lower(),
+                filepath=self.lanes[0].h5_dir,
+                auth_token=self.auth_token
+            )
+
+            total_points = self.session.num_range_points
+            # time_vector = self.session.grid.time_vector
+            nt = self.fm.grid_config.nt
+
+            self._emit(QueryEvents.SPATIAL_PROGRESS, self.session.count_completed_points(), total_points)
+            self._emit(QueryEvents.TEMPORAL_PROGRESS, self.state.resume_temporal_index, nt)
+
+            max_in_flight = max(1, int(self.runtime_config.tunable.max_in_flight_queries))
+
+            owns_executor = self.executor is None
+            executor = self.executor or ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="query")
+
+            for lane in self.lanes:
+                self._requeue_unsaved_ranges(lane)
+
+                # Start the query size from configs, then it will update throughout the loop
+                lane.state.current_query_limit = self.runtime_config.tunable.starting_query_limit
+                # series_is_complete is set as soon as the last range lands. A run stopped before the last snapshot
+                # was finalized still has to finalize it, which the loop below does.
+                lane.is_complete = (lane.state.flags.series_is_complete and
+                                    lane.state.resume_temporal_index >= lane.session.time_range[1])
+
+                lane.writer = ChunkWriter(session=lane.session, h5_dir=lane.h5_dir,
+                                          max_queue_size=self.runtime_config.tunable.writer_queue_size,
+                                          flush_interval=self.runtime_config.tunable.writer_flush_interval,
+                                          on_complete=self.scheduler.notify,
+                                          on_snapshot_complete=self._series_dataset_updater(lane))
+                lane.writer.start()
+
+            "Outer loop cycles through timesteps"
+            while not self.flags.stopped:
+                if self.scheduler.stopped:
+                    break
+
+                # A snapshot is complete once the watermark reaches the end, which implies every chunk is written
+                advanced = False
+                for lane in self.lanes:
+                    if not lane.is_complete and lane.session.is_snapshot_complete(lane.state.resume_temporal_index):
+                        self._on_snapshot_complete(lane)
+                        if lane.state.resume_temporal_index >= lane.session.time_range[1]:
+                            self._on_series_complete(lane)
+                        advanced = True
+
+                if all(lane.is_complete for lane in self.lanes):
+                    break
+                if advanced:
+                    continue
+
+                "1. Fill every free slot with the next unclaimed chunk, unless paused or backing off"
+                while self.scheduler.can_dispatch() and len(in_flight) < max_in_flight:
+                    next_chunk = self._get_next_dispatch(in_flight)
+                    if next_chunk is None:
+                        break
+
+                    lane, time_index, next_range = next_chunk
+                    time_val = lane.session.grid.time_vector[time_index]
+
+                    chunk_points, chunk_indices = lane.session.get_chunk(
+                        query_limit=lane.state.current_query_limit, resume_index=next_range[0],
+                        stop_index=next_range[1])
+
+                    "2. Query the chunk"
+                    self._emit(QueryEvents.STATUS,
+                               f"Querying {lane.variable} points {chunk_indices[0]}-{chunk_indices[1]} of "
+                               f"{total_points}\tSnapshot {time_index+1} of {nt}")
+
+                    future = executor.submit(self._timed_query, lane.session.query_points,
+                                             turbdata_object=turb_obj, chunk_points=chunk_points, time_val=time_val)
+                    in_flight[future] = (lane, time_index, chunk_indices, lane.failure_round)
+                    future.add_done_callback(lambda _: self.scheduler.notify())
+
+                done = [future for future in in_flight if future.done()]
+
+                for future in done:
+                    lane, time_index, chunk_indices, failure_round = in_flight.pop(future)
+
+                    result, query_error, latency = future.result()
+                    query_passed = query_error is None
+
+                    # Requests in flight together fail together. Only the first failure of a round raises the
+                    # backoff and shrinks the query size, the others are just re-queried after the same wait.
+                    if not query_passed and failure_round != lane.failure_round:
+                        print(f"Query failed during the current backoff, points {chunk_indices[0]}-{chunk_indices[1]} "
+                              f"will be queried again")
+                        continue
+
+                    if query_passed:
+                        print("Query passed")
+                        self._on_query_passed(lane, result, chunk_indices, time_index)
+                    else:
+                        print("Query failed")
+                        tb = traceback.format_exception(query_error)
+                        print("".join(tb), file=sys.stderr, flush=True)
+
+                    "3. Update query pass/fail history"
+                    lane.session.update_query_history(query_passed=query_passed)
+
+                    "4. Update wait time"
+                    new_wait_time = lane.session.update_wait_time(query_passed)
+
+                    "5. Update query size. A failed request also costs the wait before its retry."
+                    lane.session.record_query_observation(num_points=chunk_indices[1] - chunk_indices[0],
+                                                          latency=latency, query_passed=query_passed,
+                                                          wait=0 if query_passed else new_wait_time)
+                    new_query_size = lane.session.update_query_limit()
+                    lane.state.current_query_limit = new_query_size
+
+                    if not query_passed:
+                        self._on_query_failed(lane, new_wait_time)
+
+                "6. Advance the state over every chunk the writers have finished"
+                written = False
+                for lane in self.lanes:
+                    for chunk_indices, time_index, write_error in lane.writer.get_completed():
+                        if write_error is not None:
+                            raise write_error
+                        if chunk_indices is not None:
+                            self._on_chunk_written(lane, chunk_indices, time_index)
+                        written = True
+
+                "7. Sleep until a request or write completes, a retry is due, or pause/resume/stop is called"
+                if not done and not written:
+                    self.scheduler.wait()
+
+        except Exception:
+            tb = traceback.format_exc()
+            print(tb, file=sys.stderr, flush=True)
+            self._emit(QueryEvents.ERROR, tb)
+
+        finally:
+            self._shut_down(in_flight, executor, owns_executor)
+
+
+    def _shut_down(self, in_flight, executor, owns_executor):
+        """
+        Stops the run's requests and writer threads and saves every variable's state, whether the loop stopped or
+        raised. Each lane is guarded, so one writer that fails to close does not leave the others' files open.
+        """
+        # Ranges still in flight are simply re-queried on resume. Results already queried are written out first.
+        for future in in_flight:
+            future.cancel()
+        if owns_executor and executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        for lane in self.lanes:
+            try:
+                if lane.writer is not None:
+                    lane.writer.close()
+                    for chunk_indices, time_index, write_error in lane.writer.get_completed():
+                        if write_error is None and chunk_indices is not None:
+                            self._on_chunk_written(lane, chunk_indices, time_index)
+            except Exception:
+                print(traceback.format_exc(), file=sys.stderr, flush=True)
+
+            try:
+                lane.session.save_state(lane.state_path)
+            except Exception:
+                print(traceback.format_exc(), file=sys.stderr, flush=True)
+
+
+    @staticmethod
+    def _timed_query(query_fn, **kwargs):
+        "Runs on the query thread pool. Returns (result, error, latency in seconds) instead of raising."
+        t0 = time.perf_counter()
+        try:
+            result, error = query_fn(**kwargs), None
+        except Exception as e:
+            result, error = None, e
+
+        return result, error, time.perf_counter() - t0
+
+
+    # Called from other threads. The scheduler wakes the query loop so they take effect immediately.
+    def pause(self):
+        self.flags.paused = True
+        self.scheduler.pause()
+
+    def resume(self):
+        self.flags.paused = False
+        self.scheduler.resume()
+
+    def stop(self):
+        self.flags.stopped = True
+        self.scheduler.stop()
+
+
+    def _on_query_passed(self, lane, result, chunk_indices, time_index):
+        self._emit(QueryEvents.STATUS, "Saving chunk data...")
+
+        # Blocks while the writer queue is full
+        lane.writer.submit(result=result, chunk_indices=chunk_indices, time_index=time_index)
+
+    def _get_next_dispatch(self, in_flight):
+        """
+        Picks the next unclaimed chunk, taking the variables in turn. Within a variable the current snapshot is
+        filled first. With tunable.snapshot_lookahead > 0, the following snapshots are started while the current
+        one's last chunks are still in flight.
+
+        :return: (lane, time_index, (start, stop)) or None if nothing is left to dispatch
+        """
+        lookahead = max(0, int(getattr(self.runtime_config.tunable, "snapshot_lookahead", 0)))
+
+        num_lanes = len(self.lanes)
+        for i in range(num_lanes):
+            lane = self.lanes[(self._dispatch_offset + i) % num_lanes]
+            if lane.is_complete:
+                continue
+
+            current = lane.state.resume_temporal_index
+            last = min(lane.session.time_range[1], current + 1 + lookahead)
+
+            claimed = [(t, r) for l, t, r, _ in in_flight.values() if l is lane] + list(lane.writer.pending_ranges)
+
+            for time_index in range(current, last):
+                next_range = lane.session.get_next_chunk_range(
+                    query_limit=lane.state.current_query_limit,
+                    in_flight_ranges=[r for t, r in claimed if t == time_index],
+                    time_index=time_index)
+                if next_range is not None:
+                    self._dispatch_offset = (self._dispatch_offset + i + 1) % num_lanes
+                    return lane, time_index, next_range
+
+        return None
+
+    def _on_chunk_written(self, lane, chunk_indices, time_index):
+        snapshot_is_complete = lane.session.mark_range_complete(chunk_indices, time_index=time_index)
+        lane.session.record_progress(state_path=lane.state_path, chunk_indices=chunk_indices, time_index=time_index)
+
+        if time_index != lane.state.resume_temporal_index:
+            # A snapshot ahead of the current one is finalized as soon as its last range lands
+            if snapshot_is_complete:
+                self._finalize_snapshot(lane, time_index)
+            return
+
+        if lane.session is self.session:
+            self._emit(QueryEvents.CHUNK_SAVED, chunk_indices)
+            self._emit(QueryEvents.SPATIAL_PROGRESS, self.session.count_completed_points(),
+                       self.session.num_range_points)
+
+    def _requeue_unsaved_ranges(self, lane):
+        """
+        Re-queues the ranges the state records as saved that the snapshots in progress do not hold, e.g. after a crash
+        between writing a chunk and saving the state. Only reads the snapshots' completion indices.
+        """
+        state = lane.state
+        time_indices = [t for t in [state.resume_temporal_index] + sorted(int(t) for t in state.lookahead_ranges)
+                        if t < lane.session.time_range[1]]
+
+        verifier = SeriesVerifier(self.fm, lane.variable, shard=self.shard)
+        problems = verifier.verify(state=state, time_indices=time_indices)
+        if not problems:
+            return
+
+        for time_index, start, end, reason in problems:
+            self._emit(QueryEvents.LOG_MESSAGE, f"Points {start}-{end} of snapshot {time_index + 1} of {lane.variable} "
+                                                f"are {reason} from its snapshot file, querying them again")
+        verifier.requeue(problems, state=state, stats=lane.session.stats)
+        lane.session.save_state(lane.state_path)
+
+    def _finalize_snapshot(self, lane, time_index):
+        if lane.writer is not None and time_index not in lane.finalized_snapshots:
+            lane.writer.finalize_snapshot(time_index)
+            lane.finalized_snapshots.add(time_index)
+
+    def _series_dataset_updater(self, lane):
+        "Callback of the lane's ChunkWriter that maps each completed snapshot into the variable's series dataset"
+        # A shard's snapshot files only hold part of the volume. ShardMerger writes the series dataset after merging.
+        # The series dataset maps HDF5 files, a directory store already is one array per variable.
+        if self.shard is not None or not lane.session.storage.supports_series_dataset:
+            return None
+
+        grid = lane.session.grid
+        lane.series_dataset = SeriesDataset(
+            h5_dir=lane.h5_dir,
+            variable=lane.variable,
+            grid_config=self.fm.grid_config,
+            dims=lane.session.variable_dims,
+            hash_str=self.fm.hash_str,
+            coordinates={"t": grid.time_vector, "x": grid.points.x_points, "y": grid.points.y_points,
+                         "z": grid.points.z_points}
+        )
+
+        def update(time_index):
+            # Snapshots before resume_temporal_index are complete too. Adding them covers series whose files
+            # predate the series dataset.
+            try:
+                lane.series_dataset.add_snapshots(set(range(lane.state.resume_temporal_index)) | {time_index})
+            except Exception as e:
+                # The snapshot itself is complete, a stale series dataset must not stop the download
+                print(f"[WARNING] Could not update {lane.series_dataset.path}\n{e}")
+
+        return update
+
+    def _on_query_failed(self, lane, new_wait_time):
+        "Schedules the retry instead of sleeping, so pause/stop and other in-flight results are still handled"
+        lane.state.num_consecutive_fails += 1
+        lane.failure_round += 1
+        self.scheduler.schedule_retry(new_wait_time)
+        self._emit(QueryEvents.STATUS, f"Waiting for {time.strftime('%H:%M:%S', time.gmtime(new_wait_time))}")
+
+    def _on_snapshot_complete(self, lane):
+        self._finalize_snapshot(lane, lane.state.resume_temporal_index)
+        if lane.session is self.session:
+            self._emit(QueryEvents.SNAPSHOT_COMPLETE, lane.state.resume_temporal_index)
+            self._emit(QueryEvents.TEMPORAL_PROGRESS, lane.state.resume_temporal_index+1, self.fm.grid_config.nt)
+        lane.state.flags.is_first_chunk = True
+        lane.state.flags.snapshot_is_complete = False
+        lane.state.advance_snapshot()
+        lane.state.is_first_chunk = True
+        lane.session.save_state(lane.state_path)
+        if lane.session is self.session:
+            self._emit(QueryEvents.SPATIAL_PROGRESS, self.session.count_completed_points(),
+                       self.session.num_range_points)
+
+
+    def _on_series_complete(self, lane):
+        lane.state.flags.series_is_complete = True
+        lane.is_complete = True
+        # A shard only completes its part of the series. ShardMerger marks the variable complete after the merge.
+        if self.shard is None:
+            self.__update_hash_log(lane.variable)
+        lane.session.save_state(lane.state_path)
+        self._emit(QueryEvents.VARIABLE_COMPLETE, lane.variable)
+
+        if all(l.is_complete for l in self.lanes):
+            self.flags.stopped = True
+            self._emit(QueryEvents.SERIES_COMPLETE)
+
+    def __update_hash_log(self, variable):
+        self.fm.mark_variable_complete(variable)
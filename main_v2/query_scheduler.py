@@ -0,0 +1,108 @@
+import random
+import threading
+import time
+
+
+class QueryScheduler:
+    """
+    Decides when the query loop may dispatch new requests, and wakes the loop when something happens.
+
+    The loop blocks in wait() instead of sleeping or polling. It wakes as soon as a request or write completes
+    (notify()), when pause/resume/stop is called from another thread, or when a scheduled retry becomes due.
+    Requests already in flight keep running while new dispatches are held back by a backoff or a pause.
+
+        Usage:
+                scheduler = QueryScheduler()
+                future.add_done_callback(lambda _: scheduler.notify())
+                scheduler.schedule_retry(delay)
+                while not scheduler.stopped:
+                    if scheduler.can_dispatch():
+                        ...
+                    scheduler.wait()
+    """
+    def __init__(self, max_idle_wait=1.0):
+        self.max_idle_wait = max_idle_wait
+
+        self._cond = threading.Condition()
+        self._paused = False
+        self._stopped = False
+        self._retry_at = 0.0
+        self._has_events = False
+
+    @property
+    def paused(self):
+        return self._paused
+
+    @property
+    def stopped(self):
+        return self._stopped
+
+
+    def pause(self):
+        with self._cond:
+            self._paused = True
+            self._cond.notify_all()
+
+    def resume(self):
+        with self._cond:
+            self._paused = False
+            self._has_events = True
+            self._cond.notify_all()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def notify(self):
+        "Signals that there is work to process. Safe to call from any thread, e.g. a future's done callback."
+        with self._cond:
+            self._has_events = True
+            self._cond.notify_all()
+
+
+    def schedule_retry(self, delay):
+        "Holds back new dispatches for delay seconds. A later retry time replaces an earlier one."
+        with self._cond:
+            self._retry_at = max(self._retry_at, time.monotonic() + max(0.0, delay))
+            self._cond.notify_all()
+
+    def clear_retry(self):
+        with self._cond:
+            self._retry_at = 0.0
+
+    def retry_remaining(self):
+        "Seconds until new requests may be dispatched again"
+        return max(0.0, self._retry_at - time.monotonic())
+
+
+    def can_dispatch(self):
+        return not self._paused and not self._stopped and self.retry_remaining() <= 0
+
+
+    def wait(self, timeout=None):
+        """
+        Blocks until notified, stopped, resumed or the pending retry becomes due.
+        Returns immediately if an event arrived since the last call.
+        """
+        with self._cond:
+            if not (self._has_events or self._stopped):
+                wait_for = self.max_idle_wait if timeout is None else timeout
+
+                remaining = self.retry_remaining()
+                if remaining > 0 and not self._paused:
+                    wait_for = min(wait_for, remaining)
+
+                self._cond.wait(timeout=wait_for)
+
+            self._has_events = False
+
+
+    @staticmethod
+    def jittered_delay(delay, jitter):
+        """
+        Scales delay by a random factor in [1 - jitter, 1] so that retries from concurrent requests
+        (or several sessions) do not hit the server in lockstep.
+        """
+        jitter = min(max(jitter, 0.0), 1.0)
+        return delay * (1.0 - jitter * random.random())
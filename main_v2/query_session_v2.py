@@ -1,10 +1,18 @@
-from givernylocal.turbulence_toolkit import *
 from main_v2.supplementary_classes import *
 from main_v2.query_set_exceptions import *
 import json
 import h5py
+import numpy as np
 from pathlib import *
 from main_v2.timing_helpers import *
+from main_v2.storage_backends import get_storage, HDF5Storage
+from main_v2.progress_journal import ProgressJournal
+from main_v2.query_limit_controllers import ThroughputQueryLimitController
+from main_v2.query_scheduler import QueryScheduler
+from main_v2.query_backends import JHTDBBackend
+from main_v2.chunk_buffers import ChunkBufferPool, ChunkResult
+from main_v2.streaming_stats import StatsAccumulator, series_stats_path, write_series_stats
+import os
 
 
 class Grid:
@@ -16,9 +24,85 @@ class Flags:
         pass
 
 
+class LazyPointGrid:
+    """
+    Stand-in for the (N, 3) array of grid points that computes coordinates on demand from the flat index.
+
+    Point ordering matches np.meshgrid(x, y, z, indexing='ij') raveled in C order, i.e. z varies fastest,
+    then y, then x. Only the requested rows are ever allocated.
+
+        Usage:
+                grid = LazyPointGrid(x_points, y_points, z_points)
+                chunk_points = grid.get_points(start_index, end_index)
+    """
+    def __init__(self, x_points, y_points, z_points):
+        self.x_points = np.asarray(x_points, dtype=np.float64)
+        self.y_points = np.asarray(y_points, dtype=np.float64)
+        self.z_points = np.asarray(z_points, dtype=np.float64)
+
+        self.axes_shape = (len(self.x_points), len(self.y_points), len(self.z_points))
+        self.num_points = int(np.prod(self.axes_shape))
+
+    @property
+    def shape(self):
+        return self.num_points, 3
+
+    def __len__(self):
+        return self.num_points
+
+    def get_points(self, start_index, end_index):
+        """
+        :param start_index: [int] First flat index of the range (inclusive)
+        :param end_index: [int] Last flat index of the range (exclusive)
+
+        :return: np.ndarray of shape (end_index - start_index, 3)
+        """
+        start_index = max(int(start_index), 0)
+        end_index = min(int(end_index), self.num_points)
+
+        flat_indices = np.arange(start_index, max(end_index, start_index), dtype=np.int64)
+        ix, iy, iz = np.unravel_index(flat_indices, self.axes_shape)
+
+        points = np.empty((len(flat_indices), 3), dtype=np.float64)
+        points[:, 0] = self.x_points[ix]
+        points[:, 1] = self.y_points[iy]
+        points[:, 2] = self.z_points[iz]
+
+        return points
+
+    def __getitem__(self, key):
+        "Supports the indexing used on the old materialized array, e.g. points[a:b, :] or points[i]"
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(self.num_points)
+            if step != 1:
+                raise IndexError("LazyPointGrid only supports contiguous row slices")
+            return self.get_points(start, stop)[:, cols]
+
+        index = int(rows) + self.num_points if int(rows) < 0 else int(rows)
+        if not 0 <= index < self.num_points:
+            raise IndexError(f"Point index {rows} out of range for grid of {self.num_points} points")
+        return self.get_points(index, index + 1)[0, cols]
+
+    def materialize(self):
+        "Builds the full (N, 3) array. Only intended for small grids, e.g. plotting or verification"
+        return self.get_points(0, self.num_points)
+
+
 class QuerySession:
     def __init__(self, dataset_constraints, query_method_config, grid_config, runtime_config, state, variable,
-                 auth_token, hash_str):
+                 auth_token, hash_str, grid=None, backend=None, point_range=None, time_range=None, storage_config=None):
+        """
+        :param grid: Optional Grid of another session over the same series (e.g. another variable). Its points and
+                     time vector are reused instead of being built again.
+        :param backend: Optional query backend, e.g. a MockJHTDBBackend. Defaults to the live JHTDBBackend.
+        :param point_range: Optional [start, end) flat index range of the volume this session queries, e.g. a shard.
+                            Defaults to the whole volume.
+        :param time_range: Optional [start, end) range of time indices this session queries. Defaults to all of nt.
+        :param storage_config: Optional StorageConfig of the series. Defaults to the h5py-chosen (legacy) layout in
+                               HDF5 files.
+        """
 
         self.dataset_constraints = dataset_constraints
         self.query_method_config = query_method_config
@@ -28,21 +112,38 @@ class QuerySession:
         self.variable = variable
         self.auth_token = auth_token
         self.hash_str = hash_str
+        self.backend = backend if backend is not None else JHTDBBackend()
 
-        self.grid = Grid()
         self.flags = Flags()
 
-        self.grid.num_spatial_points = self.grid_config.nx * self.grid_config.ny * self.grid_config.nz
-        self.grid.points = self.init_points()
-        self.grid.time_vector = self.init_time_vector()
+        if grid is None:
+            self.grid = Grid()
+            self.grid.num_spatial_points = self.grid_config.nx * self.grid_config.ny * self.grid_config.nz
+            self.grid.points = self.init_points()
+            self.grid.time_vector = self.init_time_vector()
+        else:
+            self.grid = grid
         self.variable_dims = self.dataset_constraints.variable_components[self.variable]
+
+        self.point_range = tuple(point_range) if point_range is not None else (0, self.grid.num_spatial_points)
+        self.time_range = tuple(time_range) if time_range is not None else (0, self.grid_config.nt)
         print(self.grid.num_spatial_points)
 
         n = self.runtime_config.tunable.query_history_length
         self.state.query_history = [0] * n
 
+        self.query_limit_controller = self.init_query_limit_controller()
+
         self.snapshot_h5_path = None
         self.snapshot_indices = None
+        self.snapshot_writers = {}  # time_index -> open writer of the storage backend
+        self.storage_config = storage_config if storage_config is not None else StorageConfig(StorageConfig.LEGACY)
+        self.storage = get_storage(self.storage_config, self.grid_config, self.hash_str)
+        self.storage.filter_kwargs()  # Raises now if the codec is unavailable, not on the writer thread later
+        self.buffer_pool = ChunkBufferPool(dims=self.variable_dims)  # float32 buffers that query results land in
+        # Statistics of the saved values, kept in the state so they survive a resume
+        self.stats = StatsAccumulator(self.variable_dims, self.grid_config.ny, self.grid_config.nz, self.state.stats)
+        self.journal = None
 
 
     """
@@ -56,7 +157,7 @@ class QuerySession:
         Initializes a 3D grid of spatial query points based on user-defined bounds and resolution.
         Validate spatial domain coverage and grid density against dataset limits.
 
-        :return: self.points -> np.ndarray of shape (N, 3)
+        :return: self.points -> LazyPointGrid behaving like an np.ndarray of shape (N, 3)
         :raises: SpatialResolutionError
         """
 
@@ -138,8 +239,9 @@ class QuerySession:
         z_points = np.linspace(self.grid_config.z_bounds[0], self.grid_config.z_bounds[1], self.grid_config.nz,
                                dtype=np.float64)
 
-        points = np.array([axis.ravel() for axis in np.meshgrid(x_points, y_points, z_points, indexing='ij')],
-                          dtype=np.float64).T
+        # Points are generated per chunk from the flat index. Materializing the full meshgrid does not fit in memory
+        # for large grids (2048x512x1536 is ~38 GB of float64)
+        points = LazyPointGrid(x_points, y_points, z_points)
 
         return points
 
@@ -199,12 +301,11 @@ class QuerySession:
 
         return time_vector[self.snapshot_indices]
 
-    @staticmethod
-    def get_turbdata_object(dataset_title, filepath, auth_token):
+    def get_turbdata_object(self, dataset_title, filepath, auth_token):
         try:
-            turbdata_obj = turb_dataset(dataset_title=dataset_title,
-                                        output_path=str(filepath),
-                                        auth_token=auth_token)
+            turbdata_obj = self.backend.get_turbdata_object(dataset_title=dataset_title,
+                                                            output_path=str(filepath),
+                                                            auth_token=auth_token)
         except Exception as e:
             raise TurbDatasetObjectFailError(f"Failed to instantiate turb_dataset object.\n{e}")
 
@@ -216,25 +317,30 @@ class QuerySession:
     ------------------------------------------ QUERY LOOP sequence -----------------------------------------------------
     --------------------------------------------------------------------------------------------------------------------
     """
-    def get_chunk(self, query_limit, resume_index):
+    def get_chunk(self, query_limit, resume_index, stop_index=None):
         """
         :param query_limit: [int] number of points allowed to query
         :param resume_index: [int] Last unfinished index position in self.points
+        :param stop_index: [int] Optional index the chunk may not extend past, e.g. the start of a completed range
 
         :return: np.ndarray: Array of shape (N,3) containing the next chunk's points
         """
         # Get the end index of the chunk. If the end index is passed the volume size, then change flag and adjust index
-        computed_end_index = resume_index + query_limit
+        computed_end_index = resume_index + int(query_limit)
 
         self.state.flags.is_last_chunk = False
 
-        if computed_end_index > self.grid.num_spatial_points:
-            end_index = self.grid.num_spatial_points
+        if computed_end_index >= self.point_range[1]:
+            end_index = self.point_range[1]
             self.state.flags.is_last_chunk = True
         else:
             end_index = computed_end_index
 
-        chunk_points = self.grid.points[resume_index:end_index, :]
+        if stop_index is not None and stop_index < end_index:
+            end_index = stop_index
+            self.state.flags.is_last_chunk = False
+
+        chunk_points = self.grid.points.get_points(resume_index, end_index)
         chunk_indices = (resume_index, end_index)
 
         # self.chunk_points = chunk_points
@@ -245,10 +351,90 @@ class QuerySession:
         return chunk_points, chunk_indices
 
 
+    def get_next_chunk_range(self, query_limit, in_flight_ranges=(), time_index=None):
+        """
+        Finds the lowest index range of a snapshot that is neither completed nor currently being queried.
+
+        :param query_limit: [int] number of points allowed to query
+        :param in_flight_ranges: iterable of (start, end) ranges of this snapshot that have been dispatched but
+                                 not yet saved
+        :param time_index: [int] snapshot to search. Defaults to the current snapshot
+
+        :return: (start, stop) of the next gap, or None if every range is completed or in flight
+        """
+        if time_index is None:
+            time_index = self.state.resume_temporal_index
+
+        occupied = sorted([tuple(r) for r in self.state.get_occupied_ranges(time_index)] +
+                          [tuple(r) for r in in_flight_ranges])
+
+        start_index = self.point_range[0]
+        for range_start, range_end in occupied:
+            if range_end <= start_index:
+                continue
+            if range_start <= start_index:
+                start_index = range_end
+                continue
+            return start_index, min(start_index + int(query_limit), range_start)
+
+        if start_index >= self.point_range[1]:
+            return None
+
+        return start_index, min(start_index + int(query_limit), self.point_range[1])
+
+
+    def mark_range_complete(self, chunk_indices, time_index=None):
+        """
+        Records a saved chunk. For the current snapshot, advances resume_volume_index over every contiguous
+        completed range and updates snapshot_is_complete / series_is_complete once it reaches the end of the volume.
+
+        :return: True if the snapshot the chunk belongs to is now complete
+        """
+        if time_index is None:
+            time_index = self.state.resume_temporal_index
+
+        self.state.add_completed_range(chunk_indices, time_index=time_index)
+
+        if time_index != self.state.resume_temporal_index:
+            return self.is_snapshot_complete(time_index)
+
+        if self.state.resume_volume_index >= self.point_range[1]:
+            self.state.flags.snapshot_is_complete = True
+
+            if self.state.resume_temporal_index + 1 == self.time_range[1]:
+                self.state.flags.series_is_complete = True
+
+        return self.state.flags.snapshot_is_complete
+
+
+    def is_snapshot_complete(self, time_index):
+        if time_index < self.state.resume_temporal_index:
+            return True
+        if time_index == self.state.resume_temporal_index:
+            return self.state.resume_volume_index >= self.point_range[1]
+
+        ranges = self.state.lookahead_ranges.get(str(time_index), [])
+        return len(ranges) == 1 and ranges[0][0] <= self.point_range[0] and ranges[0][1] >= self.point_range[1]
+
+
+    def count_completed_points(self):
+        "Number of saved points of point_range in the current snapshot, including ranges above the watermark"
+        return (self.state.resume_volume_index - self.point_range[0] +
+                sum(end - start for start, end in self.state.completed_ranges))
+
+
+    @property
+    def num_range_points(self):
+        "Number of spatial points this session queries per snapshot"
+        return self.point_range[1] - self.point_range[0]
+
+
     def query_points(self, turbdata_object, chunk_points, time_val):
         """
-        Request points from JHU Turbulence Database through API interface.
-        getData is imported from givernylocal.turbulence_toolkit
+        Request points from JHU Turbulence Database through the session's query backend
+        (givernylocal's getData unless another backend was given)
+
+        Runs on the query thread pool, so it must not modify self.state.
 
         :return: result - array of requested variable at select spatial points
         :raises: QueryFailedError
@@ -267,13 +453,13 @@ class QuerySession:
 
             # with LogDuration(self.log, "getData()", warn_if_over=2.0):
 
-                result = getData(turbdata_object,
-                                 self.variable,
-                                 time_val,
-                                 self.query_method_config.temporal_method.lower(),
-                                 self.query_method_config.spatial_method.lower(),
-                                 self.query_method_config.spatial_operator.lower(),
-                                 chunk_points)
+                result = self.backend.get_data(turbdata_object,
+                                               self.variable,
+                                               time_val,
+                                               self.query_method_config.temporal_method.lower(),
+                                               self.query_method_config.spatial_method.lower(),
+                                               self.query_method_config.spatial_operator.lower(),
+                                               chunk_points)
 
             # self.log.debug("Query was successful")
 
@@ -283,22 +469,47 @@ class QuerySession:
 
             raise QueryFailedError(f"Query failed\n{e}")
 
-        if self.state.flags.is_last_chunk:
-            # self.log.debug("Updating snapshot_is_complete flag")
-            # self.log.debug(self.state.__dict__)
-            self.state.flags.snapshot_is_complete = True
-            # self.state.resume_volume_index += 1
+        # Convert once, straight into a pooled float32 buffer. The writer stores it as is and releases it.
+        try:
+            result = ChunkResult.from_response(result, pool=self.buffer_pool)
+        except (TypeError, ValueError, IndexError) as e:
+            raise QueryFailedError(f"Unexpected query result\n{e}")
 
-        if self.state.flags.snapshot_is_complete and self.state.resume_temporal_index + 1 == self.grid_config.nt:
-            # self.log.debug("Updating series_is_complete flag")
-            # self.log.debug(self.state.__dict__)
-            self.state.flags.series_is_complete = True
+        # Snapshot/series completion flags are updated in mark_range_complete once the chunk is saved. Several
+        # queries may be in flight at once, so the chunk that finishes last is not necessarily the last chunk.
 
         # self.log.debug("ENDING QUERY_POINTS BLOCK")
 
         return result
 
 
+    def init_query_limit_controller(self):
+        """
+        Selects the query size algorithm from runtime_config.tunable.query_limit_algorithm.
+        'pass_fail' (default) uses the weighted pass/fail history in update_query_limit,
+        'throughput' uses a ThroughputQueryLimitController.
+        """
+        algorithm = getattr(self.runtime_config.tunable, "query_limit_algorithm", "pass_fail")
+
+        if algorithm == "throughput":
+            return ThroughputQueryLimitController(query_limit_range=self.runtime_config.tunable.query_limit_range)
+        elif algorithm == "pass_fail":
+            return None
+        else:
+            raise ValueError(f"Unknown query limit algorithm '{algorithm}'")
+
+
+    def record_query_observation(self, num_points, latency, query_passed:bool, wait=0):
+        """
+        Feeds the size, latency and outcome of a finished request to the query size controller
+
+        :param wait: seconds of backoff the request triggered before the next attempt
+        """
+        if self.query_limit_controller is not None:
+            self.query_limit_controller.record(num_points=num_points, latency=latency, query_passed=query_passed,
+                                               wait=wait)
+
+
     def update_query_history(self, query_passed:bool):
         self.state.query_history.append(query_passed)
         if len(self.state.query_history) > self.runtime_config.tunable.query_history_length:
@@ -311,7 +522,11 @@ class QuerySession:
 
         :return: self.query_limit
         """
-        if len(self.state.query_history) < 2:
+        if self.query_limit_controller is not None:
+            new_query_limit = self.query_limit_controller.next_query_limit(self.state.current_query_limit)
+            self.state.current_query_limit = new_query_limit
+
+        elif len(self.state.query_history) < 2:
             print("Not enough attempts in query history to update query limit")
             new_query_limit = self.state.current_query_limit
         else:
@@ -352,7 +567,11 @@ class QuerySession:
 
         new_wait_time = min_wait_time * (growth_factor ** (self.state.num_consecutive_fails - padding))
 
-        return min(new_wait_time, max_wait_time)
+        # Jitter spreads out retries of requests that failed together
+        jitter = getattr(self.runtime_config.tunable, "wait_jitter", 0.0)
+        new_wait_time = QueryScheduler.jittered_delay(min(new_wait_time, max_wait_time), jitter)
+
+        return max(new_wait_time, min_wait_time)
 
 
 
@@ -362,89 +581,188 @@ class QuerySession:
     --------------------------------------------------------------------------------------------------------------------
     """
     def save_state(self, state_path):
-        with open(state_path, "w") as f:
+        """
+        Writes the full state and compacts the progress journal into it.
+        The json is replaced atomically so a crash mid-write leaves the previous state and journal intact.
+        """
+        state_path = Path(state_path)
+        tmp_path = state_path.with_suffix(".json.tmp")
+        self.state.stats = self.stats.to_dict()
+        with open(tmp_path, "w") as f:
             json.dump(Helper.to_dict(self.state), f, indent=4)
+        os.replace(tmp_path, state_path)
+
+        self._get_journal(state_path).truncate()
+
+
+    def record_progress(self, state_path, chunk_indices, time_index=None):
+        "Appends a saved chunk to the progress journal. Compacts into the state file every few hundred records."
+        if time_index is None:
+            time_index = self.state.resume_temporal_index
+
+        journal = self._get_journal(state_path)
+        journal.append(time_index, chunk_indices, self.state.current_query_limit)
+
+        if journal.num_records >= self.runtime_config.tunable.journal_compaction_interval:
+            self.save_state(state_path)
 
 
-    def _init_snapshot_file(self, result):
+    def _get_journal(self, state_path):
+        if self.journal is None:
+            self.journal = ProgressJournal(ProgressJournal.path_for_state(state_path))
+        return self.journal
+
+
+    def _init_snapshot_file(self, writer, result, time_index):
 
         variable = self.variable
-        time_index = self.state.resume_temporal_index
         snapshot_time = self.grid.time_vector[time_index]
-        n_points = self.grid.num_spatial_points
         dims = self.variable_dims
-        h5_path = self.snapshot_h5_path
-
-        print(f"[DEBUG] Creating new snapshot file {h5_path} with dataset {variable}")
-        with h5py.File(h5_path, "w") as h5f:
-            h5f.create_dataset(
-                variable,
-                shape=(n_points, dims),
-                dtype=np.float32,
-                compression="gzip",
-                chunks=True
-            )
+        print(f"[DEBUG] Creating new snapshot in {writer.path} with dataset {variable}")
+        attrs = {
+            "snapshot_time": snapshot_time,
+            "axes": result.axes,
+            "columns": result.columns,
+            "nx": self.grid_config.nx,
+            "ny": self.grid_config.ny,
+            "nz": self.grid_config.nz,
+            "shape": self.storage_config.dataset_shape(self.grid_config, dims),
+            "min": result.data.min(),
+            "max": result.data.max(),
+            "dtype": result.source_dtype,
+            "dataset": self.query_method_config.dataset_title,
+            # "variable": self.runtime_config.variable,
+            "temporal_method": self.query_method_config.temporal_method,
+            "spatial_method": self.query_method_config.spatial_method,
+            "spatial_operator": self.query_method_config.spatial_operator,
+            "is_complete": False,
+            "chunk_layout": self.storage_config.chunk_layout,
+            **self.storage_config.compression_attrs(),
+        }
+
+        writer.create(shape=attrs["shape"], attrs=attrs, dtype=np.float32, chunks=self.get_snapshot_chunk_shape(),
+                      **self.storage.filter_kwargs())
+
+
+    def get_snapshot_chunk_shape(self):
+        return self.storage_config.chunk_shape(self.grid_config, self.variable_dims,
+                                               self.runtime_config.tunable.starting_query_limit)
+
+
+    def get_snapshot_chunk_cache(self):
+        return self.storage_config.chunk_cache(self.get_snapshot_chunk_shape(),
+                                               self.runtime_config.tunable.query_limit_range[1],
+                                               grid_config=self.grid_config)
+
+
+    def get_snapshot_h5_path(self, h5_dir, time_index):
+        "Path of the snapshot's file, or of the directory store holding it"
+        return self.storage.snapshot_path(h5_dir, self.variable, time_index)
 
-            h5f.attrs["snapshot_time"] = snapshot_time
-            h5f.attrs["axes"] = [str(ax) for ax in result[0].axes]
-            h5f.attrs["columns"] = [str(c) for c in result[0].columns]
-            h5f.attrs["nx"] = self.grid_config.nx
-            h5f.attrs["ny"] = self.grid_config.ny
-            h5f.attrs["nz"] = self.grid_config.nz
-            h5f.attrs["shape"] = (n_points, dims)
-            h5f.attrs["min"] = result[0].values.min()
-            h5f.attrs["max"] = result[0].values.max()
-            h5f.attrs["dtype"] = str(result[0].values.dtype)
-            h5f.attrs["dataset"] = self.query_method_config.dataset_title
-            # h5f.attrs["variable"] = self.runtime_config.variable
-            h5f.attrs["temporal_method"] = self.query_method_config.temporal_method
-            h5f.attrs["spatial_method"] = self.query_method_config.spatial_method
-            h5f.attrs["spatial_operator"] = self.query_method_config.spatial_operator
-            # print("[DEBUG] h5 file was created")
-
-
-    def save_chunk_data(self, result, chunk_indices, h5_dir):
 
-        variable = self.variable
-        time_index = self.state.resume_temporal_index
-        hash_str = self.hash_str
+    @staticmethod
+    def get_snapshot_h5_filename(time_index, nt, hash_str):
+        return HDF5Storage.snapshot_filename(time_index, nt, hash_str)
+
 
-        h5_filename = f"t={time_index + 1}_of_nt={self.grid_config.nt}__hash={hash_str[:8]}.h5"
-        h5_path = h5_dir / h5_filename
-        h5_path.parent.mkdir(parents=True, exist_ok=True)
+    def _get_storage_point_range(self):
+        "point_range for the storage writers, None if this session writes the whole volume"
+        return None if self.point_range == (0, self.grid.num_spatial_points) else self.point_range
 
-        self.snapshot_h5_path = h5_path
 
-        if h5_path.exists() and h5_path.is_dir():
-            raise IsADirectoryError(f"Expected file but found directory at: {h5_path}")
+    def _get_snapshot_writer(self, result, h5_dir, time_index):
+        "Returns the open writer of time_index, creating or opening its snapshot on first use"
+        writer = self.snapshot_writers.get(time_index)
+        if writer is not None:
+            return writer
 
-        if self.state.flags.is_first_chunk and not h5_path.exists():
-            if not hasattr(result[0], "values"):
-                raise TypeError(f"Result[0] does not have 'values' attribute. Type: {type(result[0])}")
+        writer = self.storage.create_writer(h5_dir, self.variable, time_index,
+                                            chunk_cache=self.get_snapshot_chunk_cache(),
+                                            point_range=self._get_storage_point_range())
 
-            self._init_snapshot_file(result)
+        if not self.storage.snapshot_exists(h5_dir, self.variable, time_index):
+            self._init_snapshot_file(writer, result, time_index)
+        else:
+            writer.open()
+
+        if time_index == self.state.resume_temporal_index:
             self.state.flags.is_first_chunk = False
 
-        # Save chunk data
-        try:
-            with h5py.File(h5_path, "a") as h5:
+        self.snapshot_writers[time_index] = writer
+        return writer
+
+
+    def save_chunk_data(self, result, chunk_indices, h5_dir, time_index=None):
+        """
+        Writes one queried chunk into its snapshot through the storage backend, creating the snapshot on the first
+        chunk. The writer stays open between chunks. Call flush_snapshot() before persisting state that covers the
+        chunk.
+        Called from the ChunkWriter thread, so the time index of the chunk is passed in explicitly.
+        """
+        if time_index is None:
+            time_index = self.state.resume_temporal_index
+
+        h5_dir = Path(h5_dir)
+        h5_dir.mkdir(parents=True, exist_ok=True)
 
-                data_array = result[0].values if hasattr(result[0], "values") else result
-                if not isinstance(data_array, np.ndarray):
-                    data_array = np.array(data_array)
-                dset = h5[variable]
+        self.snapshot_h5_path = self.get_snapshot_h5_path(h5_dir, time_index)
 
-                dset[chunk_indices[0]:chunk_indices[1], :] = data_array
+        # query_points already returns a ChunkResult, raw getData results are converted here
+        if not isinstance(result, ChunkResult):
+            result = ChunkResult.from_response(result)
 
-        except OSError as e:
-            # self.log.exception("Failed to open/write to %s", h5_path)
-            raise OSError(f"Failed to open/write to {h5_path}")
+        try:
+            writer = self._get_snapshot_writer(result, h5_dir, time_index)
+            writer.write(chunk_indices, result.data)
+            self.stats.add(time_index, chunk_indices, result.data)
+        finally:
+            result.release()
 
 
+    def flush_snapshot(self):
+        "Flushes every open snapshot file"
+        for writer in self.snapshot_writers.values():
+            writer.flush()
 
 
+    def close_snapshot(self, h5_dir=None, time_index=None, is_complete=False):
+        """
+        Closes the snapshot writer of time_index, or every open writer if time_index is None.
+        If is_complete, the snapshot is marked complete, reopening it first if it is not currently open, and its
+        statistics are written to its attributes and the series' statistics file.
+        """
+        if time_index is None:
+            writers = list(self.snapshot_writers.values())
+            self.snapshot_writers = {}
+            for writer in writers:
+                writer.close()
+            return
 
+        writer = self.snapshot_writers.pop(time_index, None)
 
+        if writer is None and is_complete:
+            if not self.storage.snapshot_exists(h5_dir, self.variable, time_index):
+                return
 
+            writer = self.storage.create_writer(h5_dir, self.variable, time_index,
+                                                point_range=self._get_storage_point_range())
+            writer.open()
 
+        if writer is None:
+            return
+        if not is_complete:
+            writer.close()
+            return
 
+        try:
+            snapshot_stats = self.stats.complete_snapshot(time_index, self.point_range,
+                                                          lambda start, end: writer.read((start, end)))
+        except Exception:
+            writer.close()
+            raise
+        writer.close(final_attrs={"is_complete": True, **snapshot_stats.to_attrs()})
+
+        # Shards only hold part of the series, ShardMerger writes their series statistics after merging
+        if self.point_range == (0, self.grid.num_spatial_points) and self.time_range == (0, self.grid_config.nt):
+            write_series_stats(series_stats_path(Path(h5_dir), self.hash_str), self.stats.series,
+                               self.stats.series_time_indices, self.grid_config.nt)
@@ -35,4 +35,7 @@ class TurbDatasetObjectFailError(Exception):
     pass
 
 class SeriesAlreadyCompletedError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class ShardCoverageError(Exception):
+    pass
@@ -0,0 +1,361 @@
+"""
+Headless query runner for machines without a display, e.g. cluster compute nodes.
+
+Loads an existing series from the series catalog (main_v2.series_catalog) and runs the same query loop as the GUI,
+printing progress to stdout.
+Neither PyQt6 nor any GUI package is imported.
+
+    Usage:
+            python -m main_v2.run_headless --data-dir /scratch/me --hash 1a2b3c4d --variable velocity pressure
+            JHTDB_AUTH_TOKEN=... python -m main_v2.run_headless --data-dir /scratch/me --hash 1a2b3c4d
+            python -m main_v2.run_headless --data-dir /tmp/dry_run --hash 1a2b3c4d --mock-backend '{"seed": 0}'
+
+    Sharded runs (one shard per process or node, then one merge):
+            python -m main_v2.run_headless --data-dir /scratch/me --hash 1a2b3c4d --shard 3/8
+            python -m main_v2.run_headless --data-dir /scratch/me --hash 1a2b3c4d --merge-shards
+            python -m main_v2.run_headless --data-dir /scratch/me --hash 1a2b3c4d --processes 4
+
+    Series written with the memmap storage backend, converted to HDF5 snapshot files afterwards:
+            python -m main_v2.run_headless --data-dir /nvme/me --hash 1a2b3c4d --convert-to-hdf5
+
+    Checking the snapshot files against the state files, re-queueing whatever is missing (or corrupt, --checksums):
+            python -m main_v2.run_headless --data-dir /scratch/me --hash 1a2b3c4d --verify --checksums
+
+    The series catalog imports turb_data/hash_log.json when it is first opened. Later imports and exports of the
+    hash_log.json format, e.g. for older versions of the app:
+            python -m main_v2.run_headless --data-dir /scratch/me --import-hash-log other/turb_data/hash_log.json
+            python -m main_v2.run_headless --data-dir /scratch/me --export-hash-log
+"""
+from main_v2.file_managerv2 import FileManager
+from main_v2.query_runner import QueryRunner, QueryEvents
+from main_v2.query_backends import MockJHTDBBackend
+from main_v2.shards import ShardSpec, ShardMerger
+from main_v2.series_verifier import SeriesVerifier
+from main_v2.series_dataset import SeriesDataset
+from main_v2.series_catalog import SeriesCatalog
+from main_v2.supplementary_classes import RuntimeConfig, StorageConfig
+from main_v2.storage_backends import get_storage
+from pathlib import Path
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+
+class ConsoleReporter:
+    "Subscriber that prints QueryRunner events, throttling spatial progress to one line every `interval` seconds"
+    def __init__(self, interval=5.0, verbose=False, stream=sys.stdout):
+        self.interval = interval
+        self.verbose = verbose
+        self.stream = stream
+
+        self._last_progress = 0.0
+        self.errors = []
+
+    def attach(self, runner):
+        runner.subscribe(QueryEvents.SPATIAL_PROGRESS, self.on_spatial_progress)
+        runner.subscribe(QueryEvents.TEMPORAL_PROGRESS, self.on_temporal_progress)
+        runner.subscribe(QueryEvents.SNAPSHOT_COMPLETE, self.on_snapshot_complete)
+        runner.subscribe(QueryEvents.VARIABLE_COMPLETE, self.on_variable_complete)
+        runner.subscribe(QueryEvents.SERIES_COMPLETE, self.on_series_complete)
+        runner.subscribe(QueryEvents.LOG_MESSAGE, self._print)
+        runner.subscribe(QueryEvents.ERROR, self.on_error)
+        if self.verbose:
+            runner.subscribe(QueryEvents.STATUS, self._print)
+
+    def on_spatial_progress(self, num_completed, total):
+        now = time.monotonic()
+        if now - self._last_progress >= self.interval or num_completed >= total:
+            self._last_progress = now
+            self._print(f"Points {num_completed}/{total} ({100 * num_completed / max(total, 1):.1f}%)")
+
+    def on_temporal_progress(self, num_completed, nt):
+        self._print(f"Snapshots {num_completed}/{nt}")
+
+    def on_snapshot_complete(self, time_index):
+        self._print(f"Snapshot {time_index + 1} complete")
+
+    def on_variable_complete(self, variable):
+        self._print(f"Variable {variable} complete")
+
+    def on_series_complete(self):
+        self._print("Series complete")
+
+    def on_error(self, tb):
+        self.errors.append(tb)
+        self._print(f"Error:\n{tb}")
+
+    def _print(self, message):
+        print(f"[{time.strftime('%H:%M:%S')}] {message}", file=self.stream, flush=True)
+
+
+def load_runtime_config(file_manager):
+    "Loads the last-used runtime settings of the series, falling back to the defaults"
+    rt_config_path = file_manager.paths.files.runtime_config_path
+    if not Path(rt_config_path).exists():
+        return RuntimeConfig()
+
+    with open(rt_config_path, "r") as f:
+        return RuntimeConfig.load_runtime_config(json.load(f))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m main_v2.run_headless",
+                                     description="Query an existing TDM series without the GUI.")
+    parser.add_argument("--data-dir", required=True, type=Path,
+                        help="Data directory that contains turb_data/")
+    parser.add_argument("--hash", help="Series hash, or a unique prefix of it. Required unless importing or exporting.")
+    parser.add_argument("--variable", nargs="+", default=None,
+                        help="Variable(s) to query. Defaults to the first variable of the dataset.")
+    parser.add_argument("--token", default=os.environ.get("JHTDB_AUTH_TOKEN"),
+                        help="JHTDB auth token. Defaults to the JHTDB_AUTH_TOKEN environment variable.")
+    parser.add_argument("--mock-backend", nargs="?", const="{}", default=None, metavar="JSON",
+                        help="Query a local MockJHTDBBackend instead of JHTDB. Optionally takes its keyword arguments "
+                             "as a JSON object, e.g. '{\"latency_per_point\": 1e-5, \"base_failure_rate\": 0.1}'")
+    parser.add_argument("--progress-interval", type=float, default=5.0,
+                        help="Seconds between spatial progress lines")
+    parser.add_argument("--verbose", action="store_true", help="Also print every status message")
+
+    parser.add_argument("--shard", metavar="I/N", help="Only query shard I of N (1-based) of the series")
+    parser.add_argument("--shard-by", choices=ShardSpec.SPLIT_MODES, default="space",
+                        help="Split shards by spatial index range (default) or by time index")
+    parser.add_argument("--merge-shards", action="store_true",
+                        help="Verify that the shards cover the series and assemble them into the snapshot files")
+    parser.add_argument("--keep-shards", action="store_true", help="Keep the shard directories after merging")
+    parser.add_argument("--processes", type=int, default=None, metavar="N",
+                        help="Run N shards as local processes, then merge them")
+    parser.add_argument("--series-dataset", action="store_true",
+                        help="Only rebuild the series dataset of each variable from its complete snapshot files")
+    parser.add_argument("--convert-to-hdf5", action="store_true",
+                        help="Only convert the snapshots of a memmap series into HDF5 snapshot files")
+    parser.add_argument("--remove-memmap", action="store_true",
+                        help="Delete the .npy files and their sidecars once converted")
+    parser.add_argument("--verify", action="store_true",
+                        help="Only check the snapshots of each variable (or of --shard) against the state file and "
+                             "re-queue the ranges that are missing from them")
+    parser.add_argument("--checksums", action="store_true",
+                        help="With --verify, also read every saved range and re-queue those that fail their checksum")
+    parser.add_argument("--report-only", action="store_true", help="With --verify, only report what would be re-queued")
+    parser.add_argument("--import-hash-log", type=Path, metavar="PATH",
+                        help="Only add the entries of a hash_log.json file to the series catalog, replacing entries "
+                             "of the same hash")
+    parser.add_argument("--export-hash-log", nargs="?", type=Path, const=True, default=None, metavar="PATH",
+                        help="Only write the series catalog in the hash_log.json format, by default to "
+                             "turb_data/hash_log.json")
+
+    args = parser.parse_args(argv)
+    if args.hash is None and args.import_hash_log is None and args.export_hash_log is None:
+        parser.error("--hash is required")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.import_hash_log is not None or args.export_hash_log is not None:
+        return import_export_catalog(args)
+    if args.series_dataset:
+        return build_series_datasets(args)
+    if args.convert_to_hdf5:
+        return convert_to_hdf5(args)
+    if args.verify:
+        return verify_series(args)
+
+    backend = None
+    if args.mock_backend is not None:
+        backend = MockJHTDBBackend(**json.loads(args.mock_backend))
+        args.token = args.token or "mock"
+
+    if not args.token:
+        print("An auth token is required (--token or JHTDB_AUTH_TOKEN)", file=sys.stderr)
+        return 2
+
+    variables = args.variable or [None]
+    file_manager = FileManager.load_from_hash_log(args.data_dir, args.hash, variable=variables[0])
+
+    if args.processes:
+        return run_shard_processes(args)
+    if args.merge_shards:
+        return merge_shards(file_manager, args.variable or [file_manager.selected_variable], args.keep_shards)
+
+    shard = None
+    if args.shard:
+        gc = file_manager.grid_config
+        shard = ShardSpec.parse(args.shard, gc.nx * gc.ny * gc.nz, gc.nt, split_by=args.shard_by)
+        print(f"Running {shard}", flush=True)
+
+    runner = QueryRunner(
+        file_manager=file_manager,
+        runtime_config=load_runtime_config(file_manager),
+        auth_token=args.token,
+        variable=file_manager.selected_variable,
+        variables=args.variable,
+        backend=backend,
+        shard=shard
+    )
+
+    reporter = ConsoleReporter(interval=args.progress_interval, verbose=args.verbose)
+    reporter.attach(runner)
+
+    # Ctrl+C / scheduler SIGTERM stop the run cleanly. In-flight chunks are re-queried on the next run.
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: runner.stop())
+
+    runner.run()
+
+    return 1 if reporter.errors else 0
+
+
+def merge_shards(file_manager, variables, keep_shards=False):
+    for variable in variables:
+        merger = ShardMerger(file_manager, variable)
+        problems = merger.verify()
+        if problems:
+            print(f"Shards of {variable} cannot be merged yet:", *problems, sep="\n  ", file=sys.stderr)
+            return 1
+
+        merged_paths = merger.merge(keep_shards=keep_shards)
+        print(f"Merged {len(merged_paths)} snapshots of {variable} into {merger.paths.dirs.series_var_dir}")
+
+    return 0
+
+
+def convert_to_hdf5(args):
+    """
+    Converts every snapshot of a memmap series into an HDF5 snapshot file with the series' compression and chunk
+    layout, then switches the series to the hdf5 backend so it resumes and loads like any other series
+    """
+    file_manager = FileManager.load_from_hash_log(args.data_dir, args.hash)
+    memmap_storage = get_storage(file_manager.storage_config, file_manager.grid_config, file_manager.hash_str)
+    if memmap_storage.name != "memmap":
+        print(f"The series uses the {memmap_storage.name} storage backend, not memmap", file=sys.stderr)
+        return 1
+
+    storage_config = StorageConfig({**file_manager.storage_config.__dict__, "backend": "hdf5"})
+    hdf5_storage = get_storage(storage_config, file_manager.grid_config, file_manager.hash_str)
+    starting_query_limit = load_runtime_config(file_manager).tunable.starting_query_limit
+
+    for variable in file_manager.dataset_constraints.dataset_variables:
+        series_var_dir = file_manager.get_variable_paths(variable).dirs.series_var_dir
+        dims = file_manager.dataset_constraints.variable_components[variable]
+        chunks = storage_config.chunk_shape(file_manager.grid_config, dims, starting_query_limit)
+
+        converted = 0
+        for time_index in range(file_manager.grid_config.nt):
+            if not memmap_storage.snapshot_exists(series_var_dir, variable, time_index):
+                continue
+            memmap_storage.convert_to_hdf5(series_var_dir, variable, time_index, hdf5_storage, chunks=chunks)
+            if args.remove_memmap:
+                memmap_storage.remove_snapshot(series_var_dir, variable, time_index)
+            converted += 1
+
+        print(f"Converted {converted} snapshots of {variable} in {series_var_dir}")
+
+    file_manager.set_storage_config(storage_config)
+    return 0
+
+
+def verify_series(args):
+    "Checks every variable (or one shard of each) against its state file. Returns 1 if anything was missing."
+    file_manager = FileManager.load_from_hash_log(args.data_dir, args.hash)
+
+    shard = None
+    if args.shard:
+        gc = file_manager.grid_config
+        shard = ShardSpec.parse(args.shard, gc.nx * gc.ny * gc.nz, gc.nt, split_by=args.shard_by)
+
+    found = False
+    for variable in args.variable or file_manager.dataset_constraints.dataset_variables:
+        verifier = SeriesVerifier(file_manager, variable, shard=shard)
+        if not Path(verifier.state_path).exists():
+            continue
+
+        problems = verifier.verify(checksums=args.checksums)
+        for time_index, start, end, reason in problems:
+            print(f"{variable}: points {start}-{end} of snapshot {time_index + 1} are {reason}")
+        if problems and not args.report_only:
+            verifier.requeue(problems)
+            print(f"Re-queued {len(problems)} ranges of {variable}. Run the series again to query them.")
+        elif not problems:
+            print(f"{variable}: every saved range is present{' and intact' if args.checksums else ''}")
+        found = found or bool(problems)
+
+    return 1 if found else 0
+
+
+def import_export_catalog(args):
+    "Imports a hash_log.json into the series catalog and/or exports the catalog as hash_log.json"
+    catalog = SeriesCatalog(args.data_dir)
+
+    if args.import_hash_log is not None:
+        if not args.import_hash_log.is_file():
+            print(f"{args.import_hash_log} does not exist", file=sys.stderr)
+            return 1
+        num_entries = catalog.import_hash_log(args.import_hash_log, replace=True)
+        print(f"Imported {num_entries} series into {catalog.path}")
+
+    if args.export_hash_log is not None:
+        path = catalog.export_hash_log(None if args.export_hash_log is True else args.export_hash_log)
+        print(f"Exported {len(catalog)} series to {path}")
+
+    return 0
+
+
+def build_series_datasets(args):
+    "Maps every complete snapshot file of each variable into its series dataset, e.g. for series downloaded earlier"
+    file_manager = FileManager.load_from_hash_log(args.data_dir, args.hash)
+    if file_manager.storage_config.backend != "hdf5":
+        print(f"The {file_manager.storage_config.backend} storage backend keeps one array per variable already, "
+              f"series datasets only map HDF5 snapshot files")
+        return 0
+
+    for variable in args.variable or file_manager.dataset_constraints.dataset_variables:
+        paths = file_manager.get_variable_paths(variable)
+        if not paths.dirs.series_var_dir.is_dir():
+            continue
+
+        series = SeriesDataset(paths.dirs.series_var_dir, variable, file_manager.grid_config,
+                               file_manager.dataset_constraints.variable_components[variable], file_manager.hash_str)
+        complete = series.scan_snapshots()
+        series.write(complete)
+        print(f"{series.path}: {len(complete)} of {file_manager.grid_config.nt} snapshots")
+
+    return 0
+
+
+def run_shard_processes(args):
+    "Runs every shard of an N-way split as a child process of this runner, then merges them"
+    env = dict(os.environ, JHTDB_AUTH_TOKEN=args.token)  # Keeps the token off the child command lines
+
+    children = []
+    for i in range(1, args.processes + 1):
+        command = [sys.executable, "-m", "main_v2.run_headless", "--data-dir", str(args.data_dir), "--hash", args.hash,
+                   "--shard", f"{i}/{args.processes}", "--shard-by", args.shard_by,
+                   "--progress-interval", str(args.progress_interval)]
+        if args.variable:
+            command += ["--variable", *args.variable]
+        if args.mock_backend is not None:
+            command += ["--mock-backend", args.mock_backend]
+        if args.verbose:
+            command.append("--verbose")
+        children.append(subprocess.Popen(command, env=env))
+
+    # SIGINT reaches the children through the process group. SIGTERM is forwarded.
+    signal.signal(signal.SIGINT, lambda *_: None)
+    signal.signal(signal.SIGTERM, lambda *_: [child.terminate() for child in children])
+
+    exit_codes = [child.wait() for child in children]
+    if any(exit_codes):
+        print(f"Shard processes exited with {exit_codes}. Rerun to resume, then merge.", file=sys.stderr)
+        return 1
+
+    file_manager = FileManager.load_from_hash_log(args.data_dir, args.hash,
+                                                  variable=args.variable[0] if args.variable else None)
+    return merge_shards(file_manager, args.variable or [file_manager.selected_variable], args.keep_shards)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,389 @@
+from datetime import datetime
+from pathlib import Path
+import sqlite3
+import json
+import os
+
+
+class SeriesCatalog:
+    """
+    SQLite catalog of the series of a data directory, turb_data/series_catalog.sqlite. Replaces hash_log.json.
+
+    Every series is one row of the series table holding its hash_log.json entry as JSON, next to indexed columns of
+    the fields it is looked up by (dataset, custom tag, grid size, creation date). The per-variable completed and
+    last_loaded fields live in the series_variables table, so marking a variable complete is a single-row update.
+    Every change is one transaction, so concurrent runners (e.g. shards in separate processes) never overwrite each
+    other's entries.
+
+    The first time a catalog is opened it imports the data directory's hash_log.json, if there is one. The JSON file
+    itself is left as it is. export_hash_log() writes the catalog back out in the hash_log.json format.
+
+        Usage:
+                catalog = SeriesCatalog(data_dir)
+                catalog.add(hash_str, file_manager.get_new_hash_log_entry())
+                entry = catalog.get(hash_str)                              # None if there is no such series
+                rows = catalog.find(dataset="channel", variable="velocity", created_from="2025-01-01")
+                catalog.set_completed(hash_str, "velocity")
+                catalog.export_hash_log(data_dir / "turb_data" / "hash_log.json")
+    """
+    FILENAME = "series_catalog.sqlite"
+    SCHEMA_VERSION = 1
+    DATE_FORMAT = "%m/%d/%Y"  # of the created and last_loaded fields of hash_log.json entries
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS series (
+            hash TEXT PRIMARY KEY,
+            dataset TEXT NOT NULL DEFAULT '',
+            custom_tag TEXT NOT NULL DEFAULT '',
+            created TEXT NOT NULL DEFAULT '',
+            created_date TEXT,
+            nx INTEGER, ny INTEGER, nz INTEGER, nt INTEGER,
+            entry TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS series_variables (
+            hash TEXT NOT NULL REFERENCES series(hash) ON DELETE CASCADE,
+            variable TEXT NOT NULL,
+            completed INTEGER NOT NULL DEFAULT 0,
+            last_loaded TEXT NOT NULL DEFAULT '',
+            last_loaded_date TEXT,
+            PRIMARY KEY (hash, variable)
+        );
+        CREATE INDEX IF NOT EXISTS series_dataset ON series (dataset);
+        CREATE INDEX IF NOT EXISTS series_custom_tag ON series (custom_tag);
+        CREATE INDEX IF NOT EXISTS series_created_date ON series (created_date);
+        CREATE INDEX IF NOT EXISTS series_grid ON series (nx, ny, nz, nt);
+        CREATE INDEX IF NOT EXISTS series_variables_variable ON series_variables (variable);
+        CREATE INDEX IF NOT EXISTS series_variables_last_loaded_date ON series_variables (last_loaded_date);
+    """
+
+    def __init__(self, data_dir, timeout=30.0):
+        """
+        :param data_dir: data directory holding turb_data/
+        :param timeout: seconds to wait for another process's transaction before raising sqlite3.OperationalError
+        """
+        self.data_dir = Path(data_dir)
+        self.timeout = timeout
+        self._init_db()
+
+    @property
+    def path(self):
+        return self.data_dir / "turb_data" / self.FILENAME
+
+    @property
+    def hash_log_path(self):
+        return self.data_dir / "turb_data" / "hash_log.json"
+
+
+    """
+    Lookups ------------------------------------------------------------------------------------------------------------
+    """
+    def __contains__(self, hash_str):
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM series WHERE hash = ?", (hash_str,)).fetchone() is not None
+
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM series").fetchone()[0]
+
+
+    def get(self, hash_str):
+        "The hash_log.json entry of a series, None if the catalog has none"
+        with self._connect() as conn:
+            row = conn.execute("SELECT entry FROM series WHERE hash = ?", (hash_str,)).fetchone()
+            if row is None:
+                return None
+            return self._with_variables(conn, hash_str, json.loads(row[0]))
+
+
+    def match_hash(self, hash_prefix):
+        "Full hashes of the series starting with hash_prefix, e.g. the 8 characters in a series directory name"
+        with self._connect() as conn:
+            rows = conn.execute("SELECT hash FROM series WHERE hash >= ? AND hash < ? ORDER BY hash",
+                                (hash_prefix, hash_prefix + "\uffff")).fetchall()
+        return [row[0] for row in rows]
+
+
+    def entries(self):
+        "Every entry keyed by hash, i.e. the contents of hash_log.json"
+        return dict(self.iter_entries())
+
+
+    def iter_entries(self, batch_size=1000):
+        """
+        Every (hash, entry) pair, reading batch_size series at a time, so a reader on a slow (e.g. network-mounted)
+        data directory can stop partway, as the load dialog does when its data directory changes
+        """
+        with self._connect() as conn:
+            variables = {}
+            for hash_, variable, completed, last_loaded in conn.execute(
+                    "SELECT hash, variable, completed, last_loaded FROM series_variables ORDER BY rowid"):
+                variables.setdefault(hash_, []).append((variable, bool(completed), last_loaded))
+
+            cursor = conn.execute("SELECT hash, entry FROM series ORDER BY rowid")
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                for hash_, entry in batch:
+                    entry = json.loads(entry)
+                    for variable, completed, last_loaded in variables.get(hash_, ()):
+                        entry.setdefault("completed", {})[variable] = completed
+                        entry.setdefault("last_loaded", {})[variable] = last_loaded
+                    yield hash_, entry
+
+
+    def find(self, hash_prefix=None, dataset=None, custom_tag=None, variable=None, grid=None, created_from=None,
+             created_to=None, last_loaded_from=None, last_loaded_to=None):
+        """
+        One row per (series, variable) matching every given filter, using the indexed columns only.
+
+        :param hash_prefix: start of the hash
+        :param dataset, custom_tag, variable: exact values
+        :param grid: (nx, ny, nz, nt), None for any of them matches every value
+        :param created_from, created_to, last_loaded_from, last_loaded_to: inclusive ISO dates (YYYY-MM-DD)
+        :return: list of dicts with the keys hash, variable, dataset, custom_tag, created, last_loaded, completed,
+                 nx, ny, nz, nt and entry (the series' hash_log.json entry)
+        """
+        clauses, params = [], []
+        if hash_prefix:
+            clauses.append("s.hash >= ? AND s.hash < ?")
+            params += [hash_prefix, hash_prefix + "\uffff"]
+        for column, value in (("s.dataset", dataset), ("s.custom_tag", custom_tag), ("v.variable", variable)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        for column, value in zip(("s.nx", "s.ny", "s.nz", "s.nt"), grid or ()):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(int(value))
+        for column, low, high in (("s.created_date", created_from, created_to),
+                                  ("v.last_loaded_date", last_loaded_from, last_loaded_to)):
+            if low is not None:
+                clauses.append(f"{column} >= ?")
+                params.append(low)
+            if high is not None:
+                clauses.append(f"{column} <= ?")
+                params.append(high)
+
+        query = ("SELECT s.hash, v.variable, s.dataset, s.custom_tag, s.created, v.last_loaded, v.completed, "
+                 "s.nx, s.ny, s.nz, s.nt, s.entry FROM series s JOIN series_variables v ON v.hash = s.hash")
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY s.rowid, v.rowid"
+
+        keys = ("hash", "variable", "dataset", "custom_tag", "created", "last_loaded", "completed", "nx", "ny", "nz",
+                "nt", "entry")
+        with self._connect() as conn:
+            rows = [dict(zip(keys, row)) for row in conn.execute(query, params)]
+        for row in rows:
+            row["completed"] = bool(row["completed"])
+            row["entry"] = json.loads(row["entry"])
+        return rows
+
+
+    """
+    Updates ------------------------------------------------------------------------------------------------------------
+    """
+    def add(self, hash_str, entry, replace=True):
+        """
+        Adds the hash_log.json entry of a series
+
+        :param replace: replace an existing entry of the hash. Otherwise the existing entry is kept.
+        :return: True if the entry was written
+        """
+        with self._transaction() as conn:
+            return self._add(conn, hash_str, entry, replace)
+
+
+    def remove(self, hash_str):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM series WHERE hash = ?", (hash_str,))
+
+
+    def set_completed(self, hash_str, variable, completed=True):
+        "Sets completed[variable] of a series, or clears it if completed is False. Unknown series are ignored."
+        with self._transaction() as conn:
+            self._update_variable(conn, hash_str, variable, "completed", int(bool(completed)))
+
+
+    def set_last_loaded(self, hash_str, variable, date=None):
+        "Sets last_loaded[variable] of a series to date (default: today)"
+        date = date or datetime.now()
+        with self._transaction() as conn:
+            self._update_variable(conn, hash_str, variable, "last_loaded", date.strftime(self.DATE_FORMAT))
+
+
+    def update_config(self, hash_str, key, config):
+        "Replaces config[key] of a series' entry, e.g. its storage_config after a backend conversion"
+        with self._transaction() as conn:
+            row = conn.execute("SELECT entry FROM series WHERE hash = ?", (hash_str,)).fetchone()
+            if row is None:
+                raise KeyError(f"No series {hash_str} in {self.path}")
+            entry = json.loads(row[0])
+            entry.setdefault("config", {})[key] = config
+            conn.execute("UPDATE series SET entry = ? WHERE hash = ?", (json.dumps(entry), hash_str))
+
+
+    """
+    hash_log.json ------------------------------------------------------------------------------------------------------
+    """
+    def import_hash_log(self, hash_log_path=None, replace=False):
+        """
+        Adds the entries of a hash_log.json file in one transaction
+
+        :param replace: replace entries of hashes already in the catalog. Otherwise they are kept.
+        :return: number of entries written
+        """
+        hash_log = self.read_hash_log(hash_log_path or self.hash_log_path)
+        with self._transaction() as conn:
+            return sum(self._add(conn, hash_, entry, replace) for hash_, entry in hash_log.items())
+
+
+    def export_hash_log(self, hash_log_path=None):
+        "Writes every entry in the hash_log.json format, for tools that still read it. Returns the path."
+        hash_log_path = Path(hash_log_path or self.hash_log_path)
+        tmp_path = hash_log_path.with_name(hash_log_path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries(), f, indent=4)
+        os.replace(tmp_path, hash_log_path)
+        return hash_log_path
+
+
+    @staticmethod
+    def read_hash_log(hash_log_path):
+        "Entries of a hash_log.json file, {} if it is missing, empty or unreadable"
+        hash_log_path = Path(hash_log_path)
+        if not hash_log_path.exists():
+            return {}
+        try:
+            with open(hash_log_path, "r") as f:
+                content = f.read().strip()
+            return json.loads(content) if content else {}
+        except (json.JSONDecodeError, OSError):
+            return {}
+
+
+    """
+    Internals ----------------------------------------------------------------------------------------------------------
+    """
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        conn.execute("PRAGMA foreign_keys = ON")
+        return _ClosingConnection(conn)
+
+
+    def _transaction(self):
+        "Connection holding the write lock from the start, so read-modify-write updates cannot interleave"
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+
+    def _init_db(self):
+        "Creates the catalog on first use and imports hash_log.json into it"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Most catalogs are current already. Checking without the write lock keeps lookups from queueing behind
+        # writers, e.g. the shard runners of the same series.
+        with self._connect() as conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= self.SCHEMA_VERSION:
+                return
+
+        with self._transaction() as conn:
+            # Another process may have created the schema while this one waited for the lock
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= self.SCHEMA_VERSION:
+                return
+            conn.executescript_in_transaction(self._SCHEMA)
+            for hash_, entry in self.read_hash_log(self.hash_log_path).items():
+                self._add(conn, hash_, entry, replace=False)
+            conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+        # Readers no longer block the writer, and the other way around
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode = WAL")
+
+
+    def _add(self, conn, hash_str, entry, replace):
+        if not replace and conn.execute("SELECT 1 FROM series WHERE hash = ?", (hash_str,)).fetchone():
+            return False
+
+        entry = dict(entry)
+        completed = entry.pop("completed", {}) or {}
+        last_loaded = entry.pop("last_loaded", {}) or {}
+        grid = entry.get("config", {}).get("grid_config", {})
+        conn.execute("DELETE FROM series WHERE hash = ?", (hash_str,))
+        conn.execute("INSERT INTO series (hash, dataset, custom_tag, created, created_date, nx, ny, nz, nt, entry) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     (hash_str, entry.get("dataset") or "", entry.get("custom_tag") or "", entry.get("created") or "",
+                      self._iso_date(entry.get("created")), grid.get("nx"), grid.get("ny"), grid.get("nz"),
+                      grid.get("nt"), json.dumps(entry)))
+        for variable in list(completed) + [v for v in last_loaded if v not in completed]:
+            conn.execute("INSERT INTO series_variables (hash, variable, completed, last_loaded, last_loaded_date) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         (hash_str, variable, int(bool(completed.get(variable, False))),
+                          last_loaded.get(variable) or "", self._iso_date(last_loaded.get(variable))))
+        return True
+
+
+    def _update_variable(self, conn, hash_str, variable, column, value):
+        if conn.execute("SELECT 1 FROM series WHERE hash = ?", (hash_str,)).fetchone() is None:
+            return
+        conn.execute("INSERT OR IGNORE INTO series_variables (hash, variable) VALUES (?, ?)", (hash_str, variable))
+        conn.execute(f"UPDATE series_variables SET {column} = ? WHERE hash = ? AND variable = ?",
+                     (value, hash_str, variable))
+        if column == "last_loaded":
+            conn.execute("UPDATE series_variables SET last_loaded_date = ? WHERE hash = ? AND variable = ?",
+                         (self._iso_date(value), hash_str, variable))
+
+
+    @staticmethod
+    def _with_variables(conn, hash_str, entry):
+        "Adds the completed and last_loaded fields of the series' variables to its entry"
+        entry["completed"], entry["last_loaded"] = {}, {}
+        for variable, completed, last_loaded in conn.execute(
+                "SELECT variable, completed, last_loaded FROM series_variables WHERE hash = ? ORDER BY rowid",
+                (hash_str,)):
+            entry["completed"][variable] = bool(completed)
+            entry["last_loaded"][variable] = last_loaded
+        return entry
+
+
+    @classmethod
+    def _iso_date(cls, date_str):
+        "YYYY-MM-DD of an entry's date string, None if it is empty or not in DATE_FORMAT"
+        try:
+            return datetime.strptime(date_str, cls.DATE_FORMAT).strftime("%Y-%m-%d")
+        except (TypeError, ValueError):
+            return None
+
+
+class _ClosingConnection:
+    """
+    sqlite3 connection used as a context manager that commits (or rolls back on an exception) and then closes, unlike
+    sqlite3.Connection itself, which leaves the connection open
+    """
+    def __init__(self, conn):
+        self._conn = conn
+
+    def execute(self, *args):
+        return self._conn.execute(*args)
+
+    def executescript_in_transaction(self, script):
+        "Runs the ;-separated statements of script without committing the open transaction, unlike executescript"
+        for statement in script.split(";"):
+            if statement.strip():
+                self._conn.execute(statement)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self._conn.commit()
+            else:
+                self._conn.rollback()
+        finally:
+            self._conn.close()
+        return False
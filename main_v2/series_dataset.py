@@ -0,0 +1,130 @@
+from main_v2.query_session_v2 import QuerySession
+from main_v2.streaming_stats import series_stats_path, read_series_stats
+from pathlib import Path
+import numpy as np
+import h5py
+import os
+
+
+class SeriesDataset:
+    """
+    One HDF5 file per variable holding a virtual dataset of shape (nt, nx, ny, nz, dims) that maps onto the
+    per-snapshot files. No data is copied, so the file is only a few KB and is cheap to rewrite whenever a snapshot
+    completes. Only complete snapshots are mapped, every other time index reads as NaN.
+
+    Snapshot points are ordered z fastest, then y, then x, so each flat (n_points, dims) snapshot maps onto its
+    (nx, ny, nz, dims) slab in order. Grid shaped snapshots (StorageConfig.snapshot_shape) map onto it as they are. Source files are referenced relative to the series file, so the series
+    directory can be moved as a whole. The statistics of the mapped snapshots (main_v2.streaming_stats) are copied
+    into the series attributes.
+
+        Usage:
+                series = SeriesDataset(series_var_dir, variable, grid_config, dims, hash_str)
+                series.add_snapshots([time_index])
+                with h5py.File(series.path, "r") as h5:
+                    time_series = h5[variable][:, ix, iy, iz, :]       # one dataset access for every time index
+    """
+    def __init__(self, h5_dir, variable, grid_config, dims, hash_str, coordinates=None):
+        """
+        :param coordinates: Optional dict of 1D arrays stored next to the virtual dataset, e.g. {"t": time_vector,
+                            "x": x_points, "y": y_points, "z": z_points}
+        """
+        self.h5_dir = Path(h5_dir)
+        self.variable = variable
+        self.grid_config = grid_config
+        self.dims = int(dims)
+        self.hash_str = hash_str
+        self.coordinates = coordinates or {}
+        self._source_shape = None
+
+    @property
+    def path(self):
+        return self.h5_dir / f"series__hash={self.hash_str[:8]}.h5"
+
+    @property
+    def shape(self):
+        gc = self.grid_config
+        return gc.nt, gc.nx, gc.ny, gc.nz, self.dims
+
+
+    def get_complete_time_indices(self):
+        "Time indices mapped by the current series file, [] if there is none yet"
+        if not self.path.exists():
+            return []
+        with h5py.File(self.path, "r") as h5:
+            return [int(t) for t in h5.attrs.get("complete_time_indices", [])]
+
+
+    def add_snapshots(self, time_indices):
+        "Maps the snapshots of time_indices in addition to those already mapped"
+        complete = set(self.get_complete_time_indices()) | {int(t) for t in time_indices}
+        self.write(complete)
+
+
+    def scan_snapshots(self):
+        "Time indices whose snapshot file exists and is marked complete. Opens every snapshot file."
+        complete = []
+        for time_index in range(self.grid_config.nt):
+            h5_path = self._snapshot_path(time_index)
+            if not h5_path.is_file():
+                continue
+            with h5py.File(h5_path, "r") as h5:
+                if h5.attrs.get("is_complete", False):
+                    complete.append(time_index)
+        return complete
+
+
+    def write(self, complete_time_indices):
+        "Writes the series file mapping complete_time_indices, replacing the previous one"
+        gc = self.grid_config
+        coordinates = self.coordinates or self._read_coordinates()
+        complete = sorted({int(t) for t in complete_time_indices if 0 <= int(t) < gc.nt})
+        series_stats, stats_time_indices = read_series_stats(series_stats_path(self.h5_dir, self.hash_str))
+
+        layout = h5py.VirtualLayout(shape=self.shape, dtype=np.float32)
+        for time_index in complete:
+            source_name = QuerySession.get_snapshot_h5_filename(time_index, gc.nt, self.hash_str)
+            layout[time_index] = h5py.VirtualSource("./" + source_name, self.variable,
+                                                    shape=self._get_source_shape(time_index))
+
+        # Written under a temporary name first, so readers never see a partially written file
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        try:
+            with h5py.File(tmp_path, "w") as h5:
+                h5.create_virtual_dataset(self.variable, layout, fillvalue=np.nan)
+                for name, values in coordinates.items():
+                    h5.create_dataset(name, data=np.asarray(values, dtype=np.float64))
+
+                h5.attrs["variable"] = self.variable
+                h5.attrs["axes"] = ["t", "x", "y", "z", "component"]
+                h5.attrs["shape"] = self.shape
+                h5.attrs["complete_time_indices"] = np.asarray(complete, dtype=np.int64)
+                h5.attrs["is_complete"] = len(complete) == gc.nt
+                if series_stats is not None:
+                    for key, val in series_stats.to_attrs().items():
+                        h5.attrs[key] = val
+                    h5.attrs["stats_time_indices"] = np.asarray(stats_time_indices, dtype=np.int64)
+
+            os.replace(tmp_path, self.path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+
+    def _get_source_shape(self, time_index):
+        "Dataset shape of the snapshots, read from the first one mapped. Every snapshot of a series has the same."
+        if self._source_shape is None:
+            with h5py.File(self._snapshot_path(time_index), "r") as h5:
+                self._source_shape = tuple(h5[self.variable].shape)
+        return self._source_shape
+
+
+    def _read_coordinates(self):
+        "Coordinate arrays of the current series file, kept when it is rewritten without them"
+        if not self.path.exists():
+            return {}
+        with h5py.File(self.path, "r") as h5:
+            return {name: h5[name][:] for name in h5.keys() if name != self.variable}
+
+
+    def _snapshot_path(self, time_index):
+        return self.h5_dir / QuerySession.get_snapshot_h5_filename(time_index, self.grid_config.nt, self.hash_str)
@@ -0,0 +1,327 @@
+from bisect import bisect_left, bisect_right
+from datetime import date
+
+
+class SeriesSearchIndex:
+    """
+    In-memory index of the (series, variable) rows of the load dialog, built once per catalog load and updated
+    per series afterwards, so a search only touches the rows its filters select instead of scanning every row.
+
+    Index per search field:
+        - hash, custom_tag:  TextIndex, substring matches through a trigram index of the distinct values
+        - dataset, variable: TextIndex as well (few distinct values, so matches are a short scan)
+        - created, last_loaded: DateIndex, sorted (date, row id) pairs for day and range lookups
+        - nx, ny, nz, nt:    ExactIndex, value -> row ids
+    search() intersects the candidate row ids of the given filters, smallest set first, and returns the rows in the
+    order they were added. sorted_ids() orders every row by one field, for sorting the results of later searches.
+    version counts the changes to the rows, so an order computed before a sync can be told apart.
+
+        Usage:
+                index = SeriesSearchIndex()
+                index.add_series(hash_str, entry)           # a catalog / hash_log.json entry
+                rows = index.search({"custom_tag": "re550", "nx": "128", "created": "2025-03-14"})
+                index.update_series(hash_str, new_entry)    # or remove_series(hash_str)
+                order = index.sorted_ids("created", descending=True)
+    """
+    TEXT_FIELDS = ("hash", "custom_tag", "dataset", "variable")
+    DATE_FIELDS = ("created", "last_loaded")
+    GRID_FIELDS = ("nx", "ny", "nz", "nt")
+    SORT_FIELDS = TEXT_FIELDS + DATE_FIELDS + GRID_FIELDS + ("grid",)
+
+    def __init__(self):
+        self.rows = {}
+        self._row_ids = {}  # hash -> row ids of its variables
+        self._entries = {}  # hash -> entry the rows were built from
+        self._next_id = 0
+        self.version = 0  # Bumped whenever rows are added or removed
+
+        self.indexes = {field: TextIndex() for field in self.TEXT_FIELDS}
+        self.indexes.update({field: DateIndex() for field in self.DATE_FIELDS})
+        self.indexes.update({field: ExactIndex() for field in self.GRID_FIELDS})
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    @staticmethod
+    def format_rows(hash_str, entry):
+        "One search row per variable of a catalog entry"
+        grid = entry["config"]["grid_config"]
+        rows = []
+        for variable, last_loaded in entry["last_loaded"].items():
+            rows.append({
+                "data_dir": entry["data_directory"],
+                "hash": hash_str,
+                "custom_tag": entry["custom_tag"].lower(),
+                "dataset": entry["dataset"].lower(),
+                "variable": variable.lower(),
+                "last_loaded": last_loaded,
+                "created": entry["created"],
+                "nx": grid["nx"],
+                "ny": grid["ny"],
+                "nz": grid["nz"],
+                "nt": grid["nt"],
+                "series_dir": entry["series_directory"],
+                "configs": entry["config"],
+                "dataset_metadata_filepath": entry.get("dataset_metadata_filepath"),
+            })
+        return rows
+
+
+    def add_series(self, hash_str, entry):
+        "Indexes the rows of a series. A series that is indexed already is updated instead."
+        if hash_str in self._row_ids:
+            return self.update_series(hash_str, entry)
+
+        self._entries[hash_str] = entry
+        self._row_ids[hash_str] = []
+        self.version += 1
+        for row in self.format_rows(hash_str, entry):
+            row_id = self._next_id
+            self._next_id += 1
+            self.rows[row_id] = row
+            self._row_ids[hash_str].append(row_id)
+            for field, index in self.indexes.items():
+                index.add(self._key(field, row[field]), row_id)
+
+
+    def remove_series(self, hash_str):
+        if hash_str in self._row_ids:
+            self.version += 1
+        for row_id in self._row_ids.pop(hash_str, []):
+            row = self.rows.pop(row_id)
+            for field, index in self.indexes.items():
+                index.remove(self._key(field, row[field]), row_id)
+        self._entries.pop(hash_str, None)
+
+
+    def update_series(self, hash_str, entry):
+        "Re-indexes a series whose entry changed. Unchanged entries cost one comparison."
+        if self._entries.get(hash_str) == entry:
+            return
+        self.remove_series(hash_str)
+        self.add_series(hash_str, entry)
+
+
+    def sync(self, entries, cancelled=None):
+        """
+        Brings the index in line with the current entries of the catalog, only touching series that were added,
+        changed or removed
+
+        :param entries: dict of hash -> entry, or an iterable of (hash, entry) pairs such as
+                        SeriesCatalog.iter_entries()
+        :param cancelled: optional callable, checked before each series. Once it returns True the sync stops, leaving
+                          the series synced so far indexed and none removed.
+        :return: False if the sync was cancelled, True otherwise
+        """
+        if isinstance(entries, dict):
+            entries = entries.items()
+
+        seen = set()
+        for hash_str, entry in entries:
+            if cancelled is not None and cancelled():
+                return False
+            self.add_series(hash_str, entry)
+            seen.add(hash_str)
+
+        for hash_str in [h for h in self._row_ids if h not in seen]:
+            self.remove_series(hash_str)
+        return True
+
+
+    def search(self, search_params=None):
+        """
+        Rows matching every non-empty search parameter, in the order they were added
+
+        :param search_params: dict of field -> query. Text fields match substrings. Dates are ISO (YYYY-MM-DD) days,
+                              or (first, last) tuples of ISO days. Grid sizes match exactly, or as substrings of the
+                              number if the query is not an integer. Other keys are ignored.
+        """
+        return [self.rows[row_id] for row_id in self.search_ids(search_params)]
+
+
+    def search_ids(self, search_params=None):
+        "Row ids of search(), ascending"
+        candidate_sets = []
+        for field, query in (search_params or {}).items():
+            if field not in self.indexes or query in (None, ""):
+                continue
+
+            if field in self.DATE_FIELDS:
+                first, last = query if isinstance(query, (tuple, list)) else (query, query)
+                row_ids = self.indexes[field].between(self._parse_date(first), self._parse_date(last))
+            else:
+                row_ids = self.indexes[field].search(str(query).lower())
+
+            if not row_ids:
+                return []
+            candidate_sets.append(row_ids)
+
+        if not candidate_sets:
+            return sorted(self.rows)
+
+        candidate_sets.sort(key=len)
+        return sorted(set(candidate_sets[0]).intersection(*candidate_sets[1:]))
+
+
+    def sorted_ids(self, field, descending=False):
+        """
+        Every row id, ordered by a field. Dates sort by day, with the rows that have none (never loaded) first, and
+        "grid" sorts by (nx, ny, nz, nt). Equal values keep the order the rows were added in.
+
+        :param field: one of SORT_FIELDS
+        """
+        if field == "grid":
+            def sort_key(row_id):
+                row = self.rows[row_id]
+                return row["nx"], row["ny"], row["nz"], row["nt"]
+        elif field in self.DATE_FIELDS:
+            def sort_key(row_id):
+                day = self._key(field, self.rows[row_id][field])
+                return day is not None, day or date.min
+        elif field in self.SORT_FIELDS:
+            def sort_key(row_id):
+                return self._key(field, self.rows[row_id][field])
+        else:
+            raise ValueError(f"Cannot sort by {field!r}, expected one of {self.SORT_FIELDS}")
+
+        return sorted(sorted(self.rows), key=sort_key, reverse=descending)
+
+
+    def _key(self, field, value):
+        "Value of a row as stored in the field's index"
+        if field in self.DATE_FIELDS:
+            # mm/dd/yyyy, as FileManager writes them. Split by hand, strptime would dominate building the index.
+            try:
+                month, day, year = value.split("/")
+                return date(int(year), int(month), int(day))
+            except (AttributeError, ValueError):
+                return None  # Never loaded, or not a date
+        if field in self.GRID_FIELDS:
+            return int(value)
+        return str(value).lower()
+
+    @staticmethod
+    def _parse_date(value):
+        if value is None or isinstance(value, date):
+            return value
+        return date.fromisoformat(value)
+
+
+class TextIndex:
+    """
+    Substring index of string values. Each distinct value maps to its row ids, and each trigram to the distinct
+    values containing it, so a query of three or more characters only checks the values holding all its trigrams.
+    Typing usually extends the previous query, whose matching values are then the only ones left to check.
+    """
+    def __init__(self):
+        self.values = {}
+        self.grams = {}
+        self._last = None  # (query, matching values) of the previous search
+
+    @staticmethod
+    def _trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+    def add(self, value, row_id):
+        if value not in self.values:
+            self.values[value] = set()
+            for gram in self._trigrams(value):
+                self.grams.setdefault(gram, set()).add(value)
+        self.values[value].add(row_id)
+        self._last = None
+
+
+    def remove(self, value, row_id):
+        row_ids = self.values.get(value)
+        if row_ids is None:
+            return
+        row_ids.discard(row_id)
+        if not row_ids:
+            del self.values[value]
+            for gram in self._trigrams(value):
+                self.grams[gram].discard(value)
+                if not self.grams[gram]:
+                    del self.grams[gram]
+        self._last = None
+
+
+    def search(self, query):
+        "Row ids of the values containing query"
+        if self._last is not None and self._last[0] in query:
+            candidates = self._last[1]
+        elif len(query) >= 3:
+            gram_sets = sorted((self.grams.get(gram, set()) for gram in self._trigrams(query)), key=len)
+            candidates = gram_sets[0].intersection(*gram_sets[1:])
+        else:
+            candidates = self.values.keys()
+
+        matches = [value for value in candidates if query in value]
+        self._last = (query, matches)
+
+        row_ids = set()
+        for value in matches:
+            row_ids |= self.values[value]
+        return row_ids
+
+
+class DateIndex:
+    """
+    Sorted (date, row id) pairs. Rows without a date are not indexed and never match a date filter.
+    Added pairs are appended and sorted on the next lookup, so indexing a whole catalog sorts once.
+    """
+    def __init__(self):
+        self.pairs = []
+        self._sorted = True
+
+    def add(self, value, row_id):
+        if value is not None:
+            self.pairs.append((value, row_id))
+            self._sorted = False
+
+    def _sort(self):
+        if not self._sorted:
+            self.pairs.sort()
+            self._sorted = True
+
+    def remove(self, value, row_id):
+        if value is None:
+            return
+        self._sort()
+        i = bisect_left(self.pairs, (value, row_id))
+        if i < len(self.pairs) and self.pairs[i] == (value, row_id):
+            del self.pairs[i]
+
+    def between(self, first=None, last=None):
+        "Row ids of the dates in [first, last], either bound None for open"
+        self._sort()
+        lo = bisect_left(self.pairs, (first, -1)) if first is not None else 0
+        hi = bisect_right(self.pairs, (last, float("inf"))) if last is not None else len(self.pairs)
+        return {row_id for _, row_id in self.pairs[lo:hi]}
+
+
+class ExactIndex:
+    "Map of integer values to their row ids. Non-integer queries match the values whose digits contain them."
+    def __init__(self):
+        self.values = {}
+
+    def add(self, value, row_id):
+        self.values.setdefault(value, set()).add(row_id)
+
+    def remove(self, value, row_id):
+        row_ids = self.values.get(value)
+        if row_ids is not None:
+            row_ids.discard(row_id)
+            if not row_ids:
+                del self.values[value]
+
+    def search(self, query):
+        try:
+            return set(self.values.get(int(query), ()))
+        except ValueError:
+            row_ids = set()
+            for value, value_row_ids in self.values.items():
+                if query in str(value):
+                    row_ids |= value_row_ids
+            return row_ids
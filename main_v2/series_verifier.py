@@ -0,0 +1,189 @@
+from main_v2.supplementary_classes import State
+from main_v2.progress_journal import ProgressJournal
+from main_v2.series_dataset import SeriesDataset
+from main_v2.storage_backends import get_storage
+from main_v2.streaming_stats import StatsAccumulator, series_stats_path, write_series_stats
+from pathlib import Path
+import json
+import os
+
+
+class SeriesVerifier:
+    """
+    Checks the snapshots of one variable (or of one shard of it) against its state file and re-queues the ranges the
+    state records as saved that are missing or corrupt, so the next run queries only those again.
+
+    verify() only reads the completion index of every snapshot (main_v2.completion_index), not the data. With
+    checksums=True it also reads every range the state records as saved and compares it with the checksum it was
+    written with. Snapshots written before the completion index existed are checked against their allocated HDF5
+    chunks or directory store chunk files, without checksums.
+
+        Usage:
+                verifier = SeriesVerifier(file_manager, variable)           # shard=ShardSpec for one shard
+                problems = verifier.verify(checksums=False)                 # [(time_index, start, end, reason), ...]
+                verifier.requeue(problems)
+    """
+    MISSING = "missing"
+    CORRUPT = "corrupt"
+
+    def __init__(self, file_manager, variable, shard=None):
+        self.fm = file_manager
+        self.variable = variable
+        self.shard = shard
+        self.storage = get_storage(file_manager.storage_config, file_manager.grid_config, file_manager.hash_str)
+
+        gc = file_manager.grid_config
+        self.num_points = gc.nx * gc.ny * gc.nz
+        self.point_range = tuple(shard.point_range) if shard is not None else (0, self.num_points)
+        self.time_range = tuple(shard.time_range) if shard is not None else (0, gc.nt)
+
+        # Shards write their own snapshot files, except into the series' files of a parallel-writer backend
+        if shard is not None:
+            self.paths = file_manager.get_shard_paths(variable, shard)
+        else:
+            self.paths = file_manager.get_variable_paths(variable)
+        if shard is not None and self.storage.supports_parallel_writers:
+            self.data_dir = file_manager.get_variable_paths(variable).dirs.series_var_dir
+        else:
+            self.data_dir = self.paths.dirs.series_var_dir
+
+    @property
+    def state_path(self):
+        return self.paths.files.state_path
+
+    @property
+    def storage_point_range(self):
+        "point_range of the writers of this volume, None if it is the whole volume"
+        return None if self.point_range == (0, self.num_points) else self.point_range
+
+
+    def verify(self, checksums=False, state=None, time_indices=None):
+        """
+        :param checksums: also read every saved range and compare it with its checksum
+        :param state: Optional State to check, e.g. the one of a running session. Defaults to the state file.
+        :param time_indices: Optional snapshots to check. Defaults to every snapshot of the time range.
+
+        :return: list of (time_index, start, end, reason) with reason SeriesVerifier.MISSING or .CORRUPT
+        """
+        state = state if state is not None else State.load_from_json(self.state_path)
+        time_indices = time_indices if time_indices is not None else range(*self.time_range)
+
+        problems = []
+        for time_index in time_indices:
+            saved = self._saved_ranges(state, time_index)
+            if not saved:
+                continue
+
+            index = self.storage.read_completion_index(self.data_dir, self.variable, time_index)
+            if index is None:
+                if not self.storage.snapshot_exists(self.data_dir, self.variable, time_index):
+                    problems += [(time_index, start, end, self.MISSING) for start, end in saved]
+                continue  # Nothing to check against
+
+            for start, end in index.missing_ranges(saved):
+                problems.append((time_index, start, end, self.MISSING))
+
+            if checksums:
+                read_rows = lambda start, end: self.storage.read_rows(self.data_dir, self.variable, time_index,
+                                                                      start, end)
+                for start, end in index.corrupt_ranges(read_rows, saved):
+                    problems.append((time_index, start, end, self.CORRUPT))
+
+        return problems
+
+
+    def requeue(self, problems, state=None, stats=None):
+        """
+        Marks the ranges of problems as not saved and their snapshots as incomplete. Statistics of the affected
+        snapshots are dropped, the series statistics are rebuilt without them.
+
+        :param state: Optional State to update in place, e.g. the one of a running session, which the caller saves.
+                      Defaults to the state file, which is then saved.
+        :param stats: Optional StatsAccumulator to update along with state
+        :return: the updated State
+        """
+        save = state is None
+        state = state if state is not None else State.load_from_json(self.state_path)
+        if not problems:
+            return state
+
+        gc = self.fm.grid_config
+        if stats is None:
+            stats = StatsAccumulator(self.fm.dataset_constraints.variable_components[self.variable], gc.ny, gc.nz,
+                                     state.stats)
+
+        ranges = {}
+        for time_index, start, end, _ in problems:
+            ranges.setdefault(time_index, []).append([start, end])
+
+        # Snapshots between the earliest affected one and the current one are completed again on the way. Their
+        # statistics are taken from their attributes instead of being read back from the data.
+        previous_index = state.resume_temporal_index
+        state.requeue_ranges(ranges, self.point_range)
+        stats.discard_snapshots(ranges, self._read_stats_json)
+        for time_index in range(state.resume_temporal_index, min(previous_index, self.time_range[1])):
+            stats_json = self._read_stats_json(time_index) if time_index not in ranges else None
+            if stats_json is not None:
+                stats.restore_snapshot(time_index, stats_json)
+
+        for time_index in ranges:
+            self.storage.mark_incomplete(self.data_dir, self.variable, time_index,
+                                         point_range=self.storage_point_range)
+
+        if self.shard is None:
+            stats_path = series_stats_path(Path(self.data_dir), self.fm.hash_str)
+            if stats_path.is_file():
+                write_series_stats(stats_path, stats.series, stats.series_time_indices, gc.nt)
+            if self.storage.supports_series_dataset:
+                series = SeriesDataset(self.data_dir, self.variable, gc,
+                                       self.fm.dataset_constraints.variable_components[self.variable],
+                                       self.fm.hash_str)
+                if series.path.exists():
+                    series.write(set(series.get_complete_time_indices()) - set(ranges))
+            self.fm.mark_variable_complete(self.variable, completed=False)
+
+        if save:
+            state.stats = stats.to_dict()
+            self._save_state(state)
+        return state
+
+
+    def _saved_ranges(self, state, time_index):
+        "[start, end) ranges of point_range the state records as saved in the snapshot"
+        if time_index < state.resume_temporal_index:
+            return [list(self.point_range)]
+
+        saved = []
+        for start, end in state.get_occupied_ranges(time_index):
+            start, end = max(start, self.point_range[0]), min(end, self.point_range[1])
+            if start < end:
+                saved.append([start, end])
+        return saved
+
+
+    def _read_stats_json(self, time_index):
+        "Statistics this volume wrote into a completed snapshot, None if there are none"
+        try:
+            if self.storage_point_range is not None and self.storage.supports_parallel_writers:
+                for start, end, attrs in self.storage.range_attrs(self.data_dir, self.variable, time_index):
+                    if (start, end) == self.point_range:
+                        return attrs.get("stats")
+                return None
+            if not self.storage.snapshot_exists(self.data_dir, self.variable, time_index):
+                return None
+            return self.storage.read_attrs(self.data_dir, self.variable, time_index).get("stats")
+        except (OSError, KeyError, ValueError):
+            return None
+
+
+    def _save_state(self, state):
+        "Replaces the state file and drops its journal, whose records the loaded state already holds"
+        state_path = Path(self.state_path)
+        tmp_path = state_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(state.to_dict(), f, indent=4)
+        os.replace(tmp_path, state_path)
+
+        journal = ProgressJournal(ProgressJournal.path_for_state(state_path))
+        journal.truncate()
+        journal.close()
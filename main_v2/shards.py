@@ -0,0 +1,324 @@
+from main_v2.query_set_exceptions import ShardCoverageError
+from main_v2.query_session_v2 import QuerySession
+from main_v2.snapshot_writer import SnapshotWriter, read_flat_rows
+from main_v2.supplementary_classes import State
+from main_v2.progress_journal import ProgressJournal
+from main_v2.compression import filter_kwargs_of
+from main_v2.series_dataset import SeriesDataset
+from main_v2.storage_backends import get_storage
+from main_v2.streaming_stats import StreamingStats, series_stats_path, write_series_stats
+import numpy as np
+import h5py
+import json
+import os
+import shutil
+
+
+class ShardSpec:
+    """
+    One shard of a series: a [start, end) range of flat spatial indices over a [start, end) range of time indices.
+
+    Shards of a plan are disjoint and together cover the whole series, so independent processes or nodes can each
+    run one of them (QueryRunner(..., shard=spec)). The plan only depends on the grid and the number of shards, so
+    every node can compute its own shard without coordination.
+
+        Usage:
+                shards = ShardSpec.plan(num_points, nt, count=8, split_by="space")
+                runner = QueryRunner(file_manager, runtime_config, auth_token, variable, shard=shards[2])
+    """
+    SPLIT_MODES = ("space", "time")
+
+    def __init__(self, index, count, point_range, time_range):
+        self.index = int(index)
+        self.count = int(count)
+        self.point_range = (int(point_range[0]), int(point_range[1]))
+        self.time_range = (int(time_range[0]), int(time_range[1]))
+
+    @property
+    def name(self):
+        return f"shard={self.index + 1}_of_{self.count}"
+
+    def __repr__(self):
+        return f"ShardSpec({self.name}, points={list(self.point_range)}, times={list(self.time_range)})"
+
+
+    @classmethod
+    def plan(cls, num_points, nt, count, split_by="space"):
+        """
+        Splits a series into count shards of (nearly) equal size
+
+        :param split_by: 'space' splits the flat index range and gives every shard all time indices,
+                         'time' splits the time indices and gives every shard the whole volume
+        :return: list of ShardSpec, ordered by index
+        """
+        if split_by not in cls.SPLIT_MODES:
+            raise ValueError(f"Unknown shard split '{split_by}'. Choose from {cls.SPLIT_MODES}")
+
+        extent = num_points if split_by == "space" else nt
+        if not 1 <= count <= extent:
+            raise ValueError(f"Cannot split {extent} {'points' if split_by == 'space' else 'snapshots'} "
+                             f"into {count} shards")
+
+        bounds = np.linspace(0, extent, count + 1).round().astype(int)
+
+        shards = []
+        for i in range(count):
+            if split_by == "space":
+                shards.append(cls(i, count, (bounds[i], bounds[i + 1]), (0, nt)))
+            else:
+                shards.append(cls(i, count, (0, num_points), (bounds[i], bounds[i + 1])))
+        return shards
+
+
+    @classmethod
+    def parse(cls, text, num_points, nt, split_by="space"):
+        "Looks up shard 'I/N' (1-based, as in the shard directory names) of the plan for num_points and nt"
+        try:
+            index, count = (int(v) for v in text.split("/"))
+        except ValueError:
+            raise ValueError(f"Shard must be given as I/N, e.g. 2/8, not '{text}'")
+
+        if not 1 <= index <= count:
+            raise ValueError(f"Shard index {index} is not in 1..{count}")
+
+        return cls.plan(num_points, nt, count, split_by)[index - 1]
+
+
+    def to_dict(self):
+        return {"index": self.index, "count": self.count,
+                "point_range": list(self.point_range), "time_range": list(self.time_range)}
+
+    @classmethod
+    def from_dict(cls, shard_dict):
+        return cls(shard_dict["index"], shard_dict["count"], shard_dict["point_range"], shard_dict["time_range"])
+
+
+class ShardMerger:
+    """
+    Verifies that the shards of one variable cover the whole series and assembles their snapshot files into the
+    regular per-snapshot files in series_var_dir. Afterwards the series looks like a single-process run: the
+    variable's state file reports it complete, its series catalog entry is marked completed and its series dataset
+    maps every snapshot (without the coordinate arrays, which need the grid).
+
+    With the directory store backend the shards already wrote into the series' store, so merging only consolidates
+    the chunks split between shards and marks the variable complete.
+
+    The statistics each shard accumulated over its part of a snapshot are merged into the snapshot's attributes, and
+    those of every snapshot into the series statistics, without reading the data again.
+
+        Usage:
+                merger = ShardMerger(file_manager, variable)
+                problems = merger.verify()         # [] if every shard is complete and together they cover the series
+                merger.merge()                     # raises ShardCoverageError instead of merging a partial series
+    """
+    def __init__(self, file_manager, variable, block_size=1_000_000):
+        self.fm = file_manager
+        self.variable = variable
+        self.paths = file_manager.get_variable_paths(variable)
+        self.block_size = int(block_size)  # Rows copied at a time, bounds memory use on large volumes
+        self.storage = get_storage(file_manager.storage_config, file_manager.grid_config, file_manager.hash_str)
+
+        gc = file_manager.grid_config
+        self.num_points = gc.nx * gc.ny * gc.nz
+        self.nt = gc.nt
+
+    @property
+    def shards_dir(self):
+        return self.paths.dirs.series_var_dir / "shards"
+
+
+    def find_shards(self):
+        "Every ShardSpec with a directory under shards_dir, ordered by index"
+        shards = []
+        for spec_path in sorted(self.shards_dir.glob("*/shard.json")):
+            with open(spec_path, "r") as f:
+                shards.append(ShardSpec.from_dict(json.load(f)))
+        return sorted(shards, key=lambda shard: shard.index)
+
+
+    def verify(self):
+        """
+        :return: list of problems, empty if the shards are complete and tile [0, num_points) x [0, nt) exactly
+        """
+        shards = self.find_shards()
+        if not shards:
+            return [f"No shards found in {self.shards_dir}"]
+
+        problems = []
+        counts = {shard.count for shard in shards}
+        if len(counts) > 1:
+            problems.append(f"Shards of different plans found: counts {sorted(counts)}")
+
+        for time_index in range(self.nt):
+            ranges = sorted(shard.point_range for shard in shards if shard.time_range[0] <= time_index <
+                            shard.time_range[1])
+            covered = 0
+            for start, end in ranges:
+                if start != covered:
+                    kind = "Gap" if start > covered else "Overlap"
+                    problems.append(f"{kind} at points {min(start, covered)}-{max(start, covered)} of snapshot "
+                                    f"{time_index + 1}")
+                covered = max(covered, end)
+            if covered < self.num_points:
+                problems.append(f"Gap at points {covered}-{self.num_points} of snapshot {time_index + 1}")
+
+        for shard in shards:
+            state = self._load_shard_state(shard)
+            if state.resume_temporal_index < shard.time_range[1] and not state.flags.series_is_complete:
+                problems.append(f"{shard.name} is not complete: snapshot {state.resume_temporal_index + 1}, "
+                                f"point {state.resume_volume_index} of {list(shard.point_range)}")
+                continue
+
+            if self.storage.supports_parallel_writers:
+                for time_index in range(*shard.time_range):
+                    if not self.storage.is_snapshot_complete(self.paths.dirs.series_var_dir, self.variable,
+                                                             time_index, point_range=shard.point_range):
+                        problems.append(f"{shard.name}: points {list(shard.point_range)} of snapshot "
+                                        f"{time_index + 1} are not marked complete")
+                continue
+
+            for time_index in range(*shard.time_range):
+                h5_path = self._shard_h5_path(shard, time_index)
+                if not h5_path.exists():
+                    problems.append(f"{shard.name} is missing {h5_path.name}")
+                    continue
+                with h5py.File(h5_path, "r") as h5:
+                    if not h5.attrs.get("is_complete", False):
+                        problems.append(f"{shard.name}: {h5_path.name} is not marked complete")
+
+        return problems
+
+
+    def merge(self, keep_shards=False):
+        """
+        Assembles every snapshot from the shards, then marks the variable complete
+
+        :param keep_shards: keep series_var_dir/shards after a successful merge
+        :return: list of the merged snapshot file paths (the store's path for every snapshot of a directory store)
+        :raises: ShardCoverageError if verify() finds any problem
+        """
+        problems = self.verify()
+        if problems:
+            raise ShardCoverageError(f"Cannot merge the shards of {self.variable}:\n" + "\n".join(problems))
+
+        shards = self.find_shards()
+        series_var_dir = self.paths.dirs.series_var_dir
+        merged_paths = []
+        snapshot_stats = []
+        for time_index in range(self.nt):
+            if self.storage.supports_parallel_writers:
+                # Read the shards' statistics from their completion markers before consolidating drops them. Shards
+                # split by time wrote whole snapshots, and with them the statistics, themselves.
+                stats = self._merge_stats([attrs.get("stats") for _, _, attrs in
+                                           self.storage.range_attrs(series_var_dir, self.variable, time_index)])
+                self.storage.consolidate(series_var_dir, self.variable, time_index)
+                if stats is not None:
+                    self.storage.update_attrs(series_var_dir, self.variable, time_index, stats.to_attrs())
+                else:
+                    stats = self._merge_stats([self.storage.read_attrs(series_var_dir, self.variable,
+                                                                       time_index).get("stats")])
+                merged_paths.append(self.storage.snapshot_path(series_var_dir, self.variable, time_index))
+                snapshot_stats.append(stats)
+                continue
+
+            sources = sorted((shard for shard in shards if shard.time_range[0] <= time_index < shard.time_range[1]),
+                             key=lambda shard: shard.point_range[0])
+            h5_path, stats = self._merge_snapshot(time_index, sources)
+            merged_paths.append(h5_path)
+            snapshot_stats.append(stats)
+
+        if all(stats is not None for stats in snapshot_stats):
+            series_stats = StreamingStats(snapshot_stats[0].dims, snapshot_stats[0].ny, snapshot_stats[0].nz)
+            for stats in snapshot_stats:
+                stats.covered = []  # Point ranges repeat across snapshots
+                series_stats.merge(stats)
+            write_series_stats(series_stats_path(series_var_dir, self.fm.hash_str), series_stats, range(self.nt),
+                               self.nt)
+
+        self._mark_complete()
+        if self.storage.supports_series_dataset:
+            SeriesDataset(self.paths.dirs.series_var_dir, self.variable, self.fm.grid_config,
+                          self.fm.dataset_constraints.variable_components[self.variable], self.fm.hash_str
+                          ).write(range(self.nt))
+
+        if not keep_shards:
+            shutil.rmtree(self.shards_dir)
+
+        return merged_paths
+
+
+    def _merge_snapshot(self, time_index, sources):
+        """
+        Copies every source shard's point range into a new snapshot file, written under a temporary name first
+
+        :return: (path of the snapshot file, its merged StreamingStats or None if a shard has no statistics)
+        """
+        h5_name = QuerySession.get_snapshot_h5_filename(time_index, self.nt, self.fm.hash_str)
+        h5_path = self.paths.dirs.series_var_dir / h5_name
+        tmp_path = h5_path.with_name(h5_name + ".merging")
+
+        writer = SnapshotWriter(tmp_path, self.variable, time_index)
+        shard_stats = []
+        try:
+            for i, shard in enumerate(sources):
+                with h5py.File(self._shard_h5_path(shard, time_index), "r") as h5:
+                    dset = h5[self.variable]
+                    shard_stats.append(h5.attrs.get("stats"))
+
+                    # The shard holding point 0 wrote the attributes a single-process run would have written
+                    if i == 0:
+                        attrs = {key: val for key, val in h5.attrs.items()}
+                        writer.create(shape=dset.shape, attrs=attrs, dtype=dset.dtype, chunks=dset.chunks or True,
+                                      **filter_kwargs_of(dset))
+
+                    for start in range(shard.point_range[0], shard.point_range[1], self.block_size):
+                        end = min(start + self.block_size, shard.point_range[1])
+                        writer.write((start, end), read_flat_rows(dset, start, end))
+
+            stats = self._merge_stats(shard_stats)
+            writer.close(final_attrs={"is_complete": True, **(stats.to_attrs() if stats is not None else {})})
+        except Exception:
+            writer.close()
+            if tmp_path.exists():
+                tmp_path.unlink()
+            raise
+
+        os.replace(tmp_path, h5_path)
+        return h5_path, stats
+
+
+    @staticmethod
+    def _merge_stats(stats_jsons):
+        "Merged StreamingStats of the shards' JSON statistics, None if any shard has none (e.g. an older run)"
+        if not stats_jsons or any(stats_json is None for stats_json in stats_jsons):
+            return None
+
+        parts = [StreamingStats.from_json(stats_json) for stats_json in stats_jsons]
+        for part in parts[1:]:
+            parts[0].merge(part)
+        return parts[0]
+
+
+    def _mark_complete(self):
+        "Leaves the variable's state and hash log entry as a completed single-process run would"
+        state = State()
+        state.resume_temporal_index = self.nt
+        state.flags.series_is_complete = True
+        state.flags.is_new_series = False
+
+        state_path = self.paths.files.state_path
+        with open(state_path, "w") as f:
+            json.dump(state.to_dict(), f, indent=4)
+        journal = ProgressJournal(ProgressJournal.path_for_state(state_path))
+        journal.truncate()
+        journal.close()
+
+        self.fm.mark_variable_complete(self.variable)
+
+
+    def _load_shard_state(self, shard):
+        return State.load_from_json(self.fm.get_shard_paths(self.variable, shard).files.state_path)
+
+    def _shard_h5_path(self, shard, time_index):
+        h5_dir = self.fm.get_shard_paths(self.variable, shard).dirs.series_var_dir
+        return h5_dir / QuerySession.get_snapshot_h5_filename(time_index, self.nt, self.fm.hash_str)
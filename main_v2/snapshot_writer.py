@@ -0,0 +1,211 @@
+import h5py
+import numpy as np
+from main_v2.completion_index import CompletionIndex
+
+
+def grid_hyperslabs(start, end, ny, nz):
+    """
+    Splits the flat point range [start, end) of an (nx, ny, nz) grid, ordered z fastest, then y, then x, into at most
+    five boxes: the rest of a z-line, the rest of an x-plane, whole x-planes, whole z-lines and the start of a z-line.
+
+    :return: list of (box_start, box_end, np.s_[ix0:ix1, iy0:iy1, iz0:iz1]) with [box_start, box_end) flat ranges
+    """
+    plane = ny * nz
+    boxes = []
+    i = start
+    while i < end:
+        ix, rest = divmod(i, plane)
+        iy, iz = divmod(rest, nz)
+        if iz > 0 or end - i < nz:
+            iz_end = min(nz, iz + end - i)
+            box = np.s_[ix:ix + 1, iy:iy + 1, iz:iz_end]
+            n = iz_end - iz
+        elif iy > 0 or end - i < plane:
+            iy_end = min(ny, iy + (end - i) // nz)
+            box = np.s_[ix:ix + 1, iy:iy_end, 0:nz]
+            n = (iy_end - iy) * nz
+        else:
+            ix_end = ix + (end - i) // plane
+            box = np.s_[ix:ix_end, 0:ny, 0:nz]
+            n = (ix_end - ix) * plane
+        boxes.append((i, i + n, box))
+        i += n
+    return boxes
+
+
+def read_flat_rows(dset, start, end):
+    "Values of points [start, end) of a flat (n_points, dims) or grid (nx, ny, nz, dims) snapshot dataset"
+    if dset.ndim == 2:
+        return dset[start:end, :]
+
+    data = np.empty((end - start, dset.shape[-1]), dtype=dset.dtype)
+    for box_start, box_end, box in grid_hyperslabs(start, end, dset.shape[1], dset.shape[2]):
+        dset.read_direct(data[box_start - start:box_end - start].reshape(_box_shape(box, dset.shape[-1])),
+                         source_sel=box + (slice(None),))
+    return data
+
+
+def _box_shape(box, dims):
+    return tuple(s.stop - s.start for s in box) + (dims,)
+
+
+class SnapshotWriter:
+    """
+    Keeps a single snapshot file open while its chunks are written, instead of reopening it for every chunk.
+
+    Data written through write() is only guaranteed to be on disk after flush() or close(). Callers must flush
+    before persisting any state that claims the written ranges are complete.
+
+    Every write is recorded in the file's CompletionIndex (written range and checksum), which is flushed with the
+    data. Files created before the index existed are written without one.
+
+    Writes and reads always address flat point ranges. Datasets created with a grid shape (nx, ny, nz, dims), see
+    StorageConfig.snapshot_shape, get each range as up to five hyperslab writes (grid_hyperslabs).
+
+        Usage:
+                writer = SnapshotWriter(h5_path, variable, time_index)
+                writer.create(shape=(n_points, dims), attrs=attrs)    # or writer.open() for an existing file
+                writer.write((start, end), data_array)
+                writer.flush()
+                writer.close(final_attrs={"is_complete": True})
+    """
+    def __init__(self, h5_path, variable, time_index, chunk_cache=None):
+        """
+        :param chunk_cache: Optional chunk cache settings passed to h5py.File (rdcc_nbytes, rdcc_nslots, rdcc_w0)
+        """
+        self.h5_path = h5_path
+        self.variable = variable
+        self.time_index = time_index
+        self.chunk_cache = chunk_cache or {}
+
+        self._h5 = None
+        self._dset = None
+        self.index = None
+
+    @property
+    def path(self):
+        return self.h5_path
+
+    @property
+    def is_open(self):
+        return self._h5 is not None
+
+
+    def create(self, shape, attrs, dtype=np.float32, compression="gzip", chunks=True, compression_opts=None,
+               shuffle=False):
+        """
+        Creates a new snapshot file holding an empty dataset and leaves it open.
+        compression, compression_opts and shuffle are passed to create_dataset, e.g. from StorageConfig.filter_kwargs().
+
+        :param shape: (n_points, dims) or (nx, ny, nz, dims)
+        """
+        try:
+            self._h5 = h5py.File(self.h5_path, "w", **self.chunk_cache)
+            self._dset = self._h5.create_dataset(
+                self.variable,
+                shape=shape,
+                dtype=dtype,
+                compression=compression,
+                compression_opts=compression_opts,
+                shuffle=shuffle,
+                chunks=chunks
+            )
+
+            for key, val in attrs.items():
+                self._h5.attrs[key] = val
+
+            # Grid chunks are not contiguous point ranges, their index uses the default block size
+            if self._dset.chunks and self._dset.ndim == 2:
+                block_size = self._dset.chunks[0]
+            else:
+                block_size = CompletionIndex.DEFAULT_BLOCK_SIZE
+            self.index = CompletionIndex(int(np.prod(shape[:-1])), block_size)
+            self.index.write_h5(self._h5)
+
+            self._h5.flush()
+
+        except OSError as e:
+            self._release()
+            raise OSError(f"Failed to create {self.h5_path}\n{e}")
+
+
+    def open(self):
+        "Opens an existing snapshot file for further writes"
+        try:
+            self._h5 = h5py.File(self.h5_path, "a", **self.chunk_cache)
+            self._dset = self._h5[self.variable]
+            self.index = CompletionIndex.read_h5(self._h5)
+
+        except (OSError, KeyError) as e:
+            self._release()
+            raise OSError(f"Failed to open {self.h5_path}\n{e}")
+
+
+    def write(self, chunk_indices, data_array):
+        try:
+            start, end = chunk_indices[0], chunk_indices[1]
+            if self._dset.ndim == 4:
+                self._write_grid(start, end, data_array)
+            # Pooled float32 buffers match the dataset, so they go to HDF5 without a conversion copy
+            elif data_array.dtype == self._dset.dtype and data_array.flags.c_contiguous:
+                self._dset.write_direct(data_array, dest_sel=np.s_[start:end, :])
+            else:
+                self._dset[start:end, :] = data_array
+
+            if self.index is not None:
+                self.index.add(chunk_indices, data_array)
+
+        except OSError as e:
+            raise OSError(f"Failed to write points {chunk_indices[0]}-{chunk_indices[1]} to {self.h5_path}\n{e}")
+
+
+    def _write_grid(self, start, end, data_array):
+        "Writes points [start, end) of a grid dataset as one hyperslab per box of the range"
+        data_array = np.ascontiguousarray(data_array, dtype=self._dset.dtype)
+        dims = self._dset.shape[-1]
+        for box_start, box_end, box in grid_hyperslabs(start, end, self._dset.shape[1], self._dset.shape[2]):
+            self._dset.write_direct(data_array[box_start - start:box_end - start].reshape(_box_shape(box, dims)),
+                                    dest_sel=box + (slice(None),))
+
+
+    def read(self, chunk_indices):
+        "Values of points [start, end) written so far, as (end - start, dims)"
+        return read_flat_rows(self._dset, chunk_indices[0], chunk_indices[1])
+
+
+    def flush(self):
+        "Flushes buffered chunks and metadata to disk. Marks a point that state checkpoints may refer to."
+        if self._h5 is not None:
+            self._write_index()
+            self._h5.flush()
+
+
+    def close(self, final_attrs=None):
+        "Optionally writes final attributes, then flushes and closes the file"
+        if self._h5 is None:
+            return
+
+        try:
+            if final_attrs:
+                for key, val in final_attrs.items():
+                    self._h5.attrs[key] = val
+            self._write_index(compact=True)
+            self._h5.close()
+        finally:
+            self._release()
+
+
+    def _write_index(self, compact=False):
+        if self.index is not None and (self.index.is_dirty or compact):
+            self.index.write_h5(self._h5, compact=compact)
+
+
+    def _release(self):
+        if self._h5 is not None:
+            try:
+                self._h5.close()
+            except Exception:
+                pass
+        self._h5 = None
+        self._dset = None
+        self.index = None
@@ -0,0 +1,1003 @@
+"""
+Storage backends of the snapshot data, selected by StorageConfig.backend.
+
+    - "hdf5" (default): one HDF5 file per snapshot, written through SnapshotWriter
+    - "directory":      one Zarr-style directory store per variable holding a single (nt, n_points, dims) array. Every
+                        chunk is a separate compressed file, so independent threads or processes (e.g. shards) can
+                        write different index ranges of the same snapshot without any locking
+    - "memmap":         one raw, memory mapped (nx, ny, nz, dims) .npy file per snapshot plus a sidecar JSON of its
+                        attributes, for the highest write throughput on fast local disks. Converted to HDF5 later.
+
+Every backend builds writers with the SnapshotWriter interface (create/open/write/flush/close) and reads snapshots
+back as (n_points, dims) float32 arrays, whatever their shape on disk (StorageConfig.snapshot_shape). Writers record every written range and its checksum in the snapshot's
+CompletionIndex (main_v2.completion_index), which read_completion_index returns without reading any data.
+
+    Usage:
+            storage = get_storage(storage_config, grid_config, hash_str)
+            writer = storage.create_writer(data_dir, variable, time_index)
+            writer.create(shape=(n_points, dims), attrs=attrs, chunks=chunks, **storage.filter_kwargs())
+            writer.write((start, end), data_array)
+            writer.close(final_attrs={"is_complete": True})
+            data = storage.read_snapshot(data_dir, variable, time_index)
+"""
+from main_v2.snapshot_writer import SnapshotWriter, read_flat_rows
+from main_v2.completion_index import CompletionIndex, CompletionLog
+from pathlib import Path
+import numpy as np
+import threading
+import json
+import zlib
+import os
+import h5py
+
+try:
+    import numcodecs
+except ImportError:
+    numcodecs = None
+
+
+def get_storage(storage_config, grid_config, hash_str):
+    "Storage backend of storage_config.backend"
+    if storage_config.backend == "directory":
+        return DirectoryStorage(storage_config, grid_config, hash_str)
+    if storage_config.backend == "memmap":
+        return MemmapStorage(storage_config, grid_config, hash_str)
+    return HDF5Storage(storage_config, grid_config, hash_str)
+
+
+def _to_json(val):
+    "Snapshot attributes hold numpy scalars and tuples, which json cannot encode on its own"
+    if isinstance(val, np.generic):
+        return val.item()
+    if isinstance(val, np.ndarray):
+        return val.tolist()
+    raise TypeError(f"Cannot encode {type(val)} as JSON")
+
+
+def _write_atomic(path, data):
+    "Writes bytes under a temporary name, then renames, so readers and other writers never see partial files"
+    tmp_path = path.with_name(f".{path.name}.tmp{os.getpid()}_{threading.get_ident()}")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class HDF5Storage:
+    "One HDF5 file per snapshot, named t=<i>_of_nt=<nt>__hash=<hash>.h5"
+    name = "hdf5"
+    supports_parallel_writers = False
+    supports_series_dataset = True
+
+    def __init__(self, storage_config, grid_config, hash_str):
+        self.storage_config = storage_config
+        self.grid_config = grid_config
+        self.hash_str = hash_str
+
+    @staticmethod
+    def snapshot_filename(time_index, nt, hash_str):
+        return f"t={time_index + 1}_of_nt={nt}__hash={hash_str[:8]}.h5"
+
+    def snapshot_path(self, data_dir, variable, time_index):
+        return Path(data_dir) / self.snapshot_filename(time_index, self.grid_config.nt, self.hash_str)
+
+
+    def filter_kwargs(self):
+        "Compression keyword arguments of the writers' create()"
+        return self.storage_config.filter_kwargs()
+
+    def create_writer(self, data_dir, variable, time_index, chunk_cache=None, point_range=None):
+        return SnapshotWriter(h5_path=self.snapshot_path(data_dir, variable, time_index), variable=variable,
+                              time_index=time_index, chunk_cache=chunk_cache)
+
+
+    def snapshot_exists(self, data_dir, variable, time_index):
+        h5_path = self.snapshot_path(data_dir, variable, time_index)
+        if h5_path.exists() and h5_path.is_dir():
+            raise IsADirectoryError(f"Expected file but found directory at: {h5_path}")
+        return h5_path.exists()
+
+    def is_snapshot_complete(self, data_dir, variable, time_index, point_range=None):
+        h5_path = self.snapshot_path(data_dir, variable, time_index)
+        if not h5_path.is_file():
+            return False
+        with h5py.File(h5_path, "r") as h5:
+            return bool(h5.attrs.get("is_complete", False))
+
+    def read_snapshot(self, data_dir, variable, time_index):
+        with h5py.File(self.snapshot_path(data_dir, variable, time_index), "r") as h5:
+            data = h5[variable][:]
+            return data.reshape(-1, data.shape[-1])
+
+    def read_attrs(self, data_dir, variable, time_index):
+        with h5py.File(self.snapshot_path(data_dir, variable, time_index), "r") as h5:
+            return dict(h5.attrs)
+
+    def read_rows(self, data_dir, variable, time_index, start, end):
+        with h5py.File(self.snapshot_path(data_dir, variable, time_index), "r") as h5:
+            return read_flat_rows(h5[variable], start, end)
+
+    def read_completion_index(self, data_dir, variable, time_index):
+        """
+        CompletionIndex of the snapshot, None if there is no snapshot or nothing can be told about it. Files written
+        before the index existed get one of their allocated chunks, without checksums. Only reads metadata.
+        """
+        h5_path = self.snapshot_path(data_dir, variable, time_index)
+        if not h5_path.is_file():
+            return None
+
+        with h5py.File(h5_path, "r") as h5:
+            index = CompletionIndex.read_h5(h5)
+            if index is not None:
+                return index
+
+            dset = h5[variable]
+            if dset.chunks is None or dset.ndim != 2:
+                return None
+            rows = dset.chunks[0]
+            index = CompletionIndex(dset.shape[0], rows, has_checksums=False)
+            for i in range(dset.id.get_num_chunks()):
+                start = dset.id.get_chunk_info(i).chunk_offset[0]
+                index.add_record(start, min(start + rows, dset.shape[0]), 0)
+            return index
+
+    def mark_incomplete(self, data_dir, variable, time_index, point_range=None):
+        "Clears is_complete, e.g. after ranges of the snapshot were found missing or corrupt"
+        h5_path = self.snapshot_path(data_dir, variable, time_index)
+        if h5_path.is_file():
+            self.update_attrs(data_dir, variable, time_index, {"is_complete": False})
+
+    def consolidate(self, data_dir, variable, time_index):
+        "Nothing to do, HDF5 snapshots are written in place"
+        pass
+
+    def update_attrs(self, data_dir, variable, time_index, attrs):
+        with h5py.File(self.snapshot_path(data_dir, variable, time_index), "r+") as h5:
+            for key, val in attrs.items():
+                h5.attrs[key] = val
+
+
+class DirectoryStorage:
+    """
+    Zarr (v2) compatible directory store per variable: <data_dir>/<variable>__hash=<hash>.zarr holds one float32 array
+    of shape (nt, n_points, dims) in chunks of (1, chunk_rows, dims), each chunk a separate file named t.c.0.
+
+    Writes never modify a file another writer may touch:
+        - a write covering a whole chunk writes the chunk file (atomically, via rename)
+        - a write covering part of a chunk writes a write-once fragment file .fragments/t.c.0/<start>-<end>
+        - completing a range of a snapshot writes a marker .snapshots/<t>__complete__<start>-<end>
+    Fragments are merged into their chunk files by consolidate(), which only the single owner of a snapshot calls: the
+    writer of a whole snapshot when it completes, or ShardMerger once every shard has finished. Readers of this
+    class overlay any remaining fragments, zarr readers see only consolidated chunks.
+    """
+    name = "directory"
+    supports_parallel_writers = True
+    supports_series_dataset = False
+
+    # numcodecs configs of the codecs, LZ4 and Zstd with the same byte shuffle the HDF5 backend uses
+    NUMCODECS = {
+        "lz4": ({"id": "lz4"}, True),
+        "zstd": ({"id": "zstd"}, True),
+        "blosc_lz4": ({"id": "blosc", "cname": "lz4", "shuffle": 1}, False),
+        "blosc_zstd": ({"id": "blosc", "cname": "zstd", "shuffle": 1}, False),
+    }
+
+    def __init__(self, storage_config, grid_config, hash_str):
+        self.storage_config = storage_config
+        self.grid_config = grid_config
+        self.hash_str = hash_str
+
+    def store_path(self, data_dir, variable):
+        return Path(data_dir) / f"{variable}__hash={self.hash_str[:8]}.zarr"
+
+    def snapshot_path(self, data_dir, variable, time_index):
+        "The store holding the snapshot. Every snapshot of a variable lives in the same store."
+        return self.store_path(data_dir, variable)
+
+
+    def filter_kwargs(self):
+        "Compression keyword arguments of the writers' create(). Raises if the codec cannot be used here."
+        from main_v2.compression import resolve_level
+
+        codec = self.storage_config.compression
+        level = resolve_level(codec, self.storage_config.compression_level)
+
+        if codec == "lzf":
+            raise ValueError("The lzf codec is HDF5-only. Choose another codec for the directory backend.")
+        if codec in self.NUMCODECS and numcodecs is None:
+            raise ImportError(f"Compression codec '{codec}' of the directory backend needs the numcodecs package: "
+                              f"pip install numcodecs")
+
+        return {"codec": codec, "level": level}
+
+    def create_writer(self, data_dir, variable, time_index, chunk_cache=None, point_range=None):
+        return DirectoryStoreWriter(self, self.store_path(data_dir, variable), variable, time_index,
+                                    point_range=point_range)
+
+
+    def open_array(self, data_dir, variable):
+        "The whole (nt, n_points, dims) array of the variable"
+        return DirectoryStoreArray(self.store_path(data_dir, variable))
+
+    def snapshot_exists(self, data_dir, variable, time_index):
+        return (self.store_path(data_dir, variable) / ".snapshots" / f"{time_index}.json").is_file()
+
+    def is_snapshot_complete(self, data_dir, variable, time_index, point_range=None):
+        "True if every index of point_range (default: the whole volume) was marked complete"
+        n_points = self.grid_config.nx * self.grid_config.ny * self.grid_config.nz
+        start, end = point_range if point_range is not None else (0, n_points)
+        covered = start
+        for range_start, range_end in DirectoryStoreArray(self.store_path(data_dir, variable)).complete_ranges(time_index):
+            if range_start > covered:
+                break
+            covered = max(covered, range_end)
+        return covered >= end
+
+    def read_snapshot(self, data_dir, variable, time_index):
+        return self.open_array(data_dir, variable).read_snapshot(time_index)
+
+    def read_attrs(self, data_dir, variable, time_index):
+        return self.open_array(data_dir, variable).snapshot_attrs(time_index)
+
+    def read_rows(self, data_dir, variable, time_index, start, end):
+        return self.open_array(data_dir, variable).read_rows(time_index, start, end)
+
+    @staticmethod
+    def completion_log_path(store_path, time_index, start, end):
+        "Ranges and checksums written by the writer of points [start, end) of the snapshot"
+        return Path(store_path) / ".completion" / f"{time_index}__{start}-{end}"
+
+    def read_completion_index(self, data_dir, variable, time_index):
+        """
+        CompletionIndex of the snapshot, from the logs of all its writers. Snapshots written before the index existed
+        get one of their chunk and fragment files, without checksums. None if there is no snapshot.
+        """
+        if not self.snapshot_exists(data_dir, variable, time_index):
+            return None
+
+        array = self.open_array(data_dir, variable)
+        if not array.snapshot_attrs(time_index).get("completion_index", False):
+            return array.written_ranges_index(time_index)
+
+        completion_dir = self.store_path(data_dir, variable) / ".completion"
+        prefix = f"{time_index}__"
+        log_paths = [completion_dir / name for name in (os.listdir(completion_dir) if completion_dir.is_dir() else [])
+                     if name.startswith(prefix)]
+        return CompletionIndex.from_logs(array.shape[1], array.chunk_rows, log_paths)
+
+    def mark_incomplete(self, data_dir, variable, time_index, point_range=None):
+        "Removes the completion markers overlapping point_range (default: the whole volume)"
+        snapshots_dir = self.store_path(data_dir, variable) / ".snapshots"
+        _remove_markers(snapshots_dir, f"{time_index}__complete__", point_range)
+
+    def consolidate(self, data_dir, variable, time_index):
+        "Merges every fragment of the snapshot into its chunk file. Must only be called by the snapshot's owner."
+        DirectoryStoreArray(self.store_path(data_dir, variable)).consolidate(time_index)
+
+    def range_attrs(self, data_dir, variable, time_index):
+        "Attributes the writers of parts of the volume (shards) recorded when completing their point range"
+        return DirectoryStoreArray(self.store_path(data_dir, variable)).range_attrs(time_index)
+
+    def update_attrs(self, data_dir, variable, time_index, attrs):
+        DirectoryStoreArray(self.store_path(data_dir, variable)).update_snapshot_attrs(time_index, attrs)
+
+
+    @classmethod
+    def compressor_config(cls, codec, level):
+        "Zarr compressor and filters entries of .zarray"
+        if codec == "none":
+            return None, None
+        if codec == "gzip":
+            return {"id": "zlib", "level": level}, None
+
+        config, shuffle = cls.NUMCODECS[codec]
+        config = dict(config)
+        if level is not None:
+            config["clevel" if config["id"] == "blosc" else "level"] = level
+        return config, [{"id": "shuffle", "elementsize": 4}] if shuffle else None
+
+
+class DirectoryStoreArray:
+    "Reads (and consolidates) a directory store written by DirectoryStoreWriter"
+    def __init__(self, store_path):
+        self.store_path = Path(store_path)
+        with open(self.store_path / ".zarray", "r") as f:
+            self.meta = json.load(f)
+
+        self.shape = tuple(self.meta["shape"])
+        self.chunk_rows = self.meta["chunks"][1]
+        self.dtype = np.dtype(self.meta["dtype"])
+        self._compressor = _get_codec(self.meta["compressor"])
+        self._filters = [_get_codec(config) for config in (self.meta["filters"] or [])]
+
+    @property
+    def attrs(self):
+        with open(self.store_path / ".zattrs", "r") as f:
+            return json.load(f)
+
+    def snapshot_attrs(self, time_index):
+        with open(self.store_path / ".snapshots" / f"{time_index}.json", "r") as f:
+            attrs = json.load(f)
+        attrs["is_complete"] = self.complete_ranges(time_index) == [[0, self.shape[1]]]
+        return attrs
+
+    def update_snapshot_attrs(self, time_index, new_attrs):
+        "Only called by the snapshot's owner, see DirectoryStorage"
+        attrs_path = self.store_path / ".snapshots" / f"{time_index}.json"
+        with open(attrs_path, "r") as f:
+            attrs = json.load(f)
+        attrs.update({key: val for key, val in new_attrs.items() if key != "is_complete"})
+        _write_atomic(attrs_path, json.dumps(attrs, default=_to_json).encode())
+
+    def range_attrs(self, time_index):
+        "[start, end, attrs] of every completion marker of the snapshot"
+        ranges = []
+        prefix = f"{time_index}__complete__"
+        snapshots_dir = self.store_path / ".snapshots"
+        for name in os.listdir(snapshots_dir) if snapshots_dir.is_dir() else []:
+            if name.startswith(prefix):
+                start, end = name[len(prefix):].split("-")
+                with open(snapshots_dir / name, "rb") as f:
+                    content = f.read()
+                ranges.append([int(start), int(end), json.loads(content) if content else {}])
+        return sorted(ranges, key=lambda r: r[0])
+
+    def written_ranges_index(self, time_index):
+        "CompletionIndex (without checksums) of the chunk and fragment files of the snapshot, from their names"
+        index = CompletionIndex(self.shape[1], self.chunk_rows, has_checksums=False)
+        prefix = f"{time_index}."
+        for name in os.listdir(self.store_path):
+            if name.startswith(prefix):
+                chunk_start = int(name.split(".")[1]) * self.chunk_rows
+                index.add_record(chunk_start, min(chunk_start + self.chunk_rows, self.shape[1]), 0)
+
+        fragments_dir = self.store_path / ".fragments"
+        for chunk_key in os.listdir(fragments_dir) if fragments_dir.is_dir() else []:
+            if chunk_key.startswith(prefix):
+                chunk_start = int(chunk_key.split(".")[1]) * self.chunk_rows
+                for name in os.listdir(fragments_dir / chunk_key):
+                    if not name.startswith("."):
+                        start, end = (int(v) for v in name.split("-"))
+                        index.add_record(chunk_start + start, chunk_start + end, 0)
+        return index
+
+    def __getitem__(self, key):
+        "Supports arr[t] and arr[t, rows] / arr[t, rows, cols] with an integer t"
+        key = key if isinstance(key, tuple) else (key,)
+        return self.read_snapshot(int(key[0]))[key[1:]] if len(key) > 1 else self.read_snapshot(int(key[0]))
+
+
+    def complete_ranges(self, time_index):
+        "Merged [start, end) ranges marked complete for the snapshot"
+        merged = []
+        for start, end, _ in self.range_attrs(time_index):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
+
+
+    def read_snapshot(self, time_index):
+        "(n_points, dims) array of the snapshot. Indices that were never written read as NaN."
+        return self.read_rows(time_index, 0, self.shape[1])
+
+
+    def read_rows(self, time_index, start, end):
+        "Values of points [start, end) of the snapshot, only decoding the chunks they lie in"
+        data = np.full((end - start, self.shape[2]), np.nan, dtype=self.dtype)
+        first_chunk, last_chunk = start // self.chunk_rows, -(-end // self.chunk_rows)
+
+        for chunk_index in range(first_chunk, last_chunk):
+            chunk = self._read_chunk(time_index, chunk_index)
+            if chunk is not None:
+                self._copy_rows(data, start, end, chunk_index * self.chunk_rows, chunk)
+
+        for chunk_index, fragment_start, fragment_end, fragment in self._iter_fragments(time_index):
+            if first_chunk <= chunk_index < last_chunk:
+                self._copy_rows(data, start, end, chunk_index * self.chunk_rows + fragment_start, fragment)
+
+        return data
+
+
+    def consolidate(self, time_index):
+        fragments_dir = self.store_path / ".fragments"
+        if not fragments_dir.is_dir():
+            return
+
+        by_chunk = {}
+        for chunk_index, fragment_start, fragment_end, fragment in self._iter_fragments(time_index):
+            by_chunk.setdefault(chunk_index, []).append((fragment_start, fragment_end, fragment))
+
+        for chunk_index, fragments in by_chunk.items():
+            chunk = self._read_chunk(time_index, chunk_index)
+            if chunk is None:
+                chunk = np.full((self.chunk_rows, self.shape[2]), np.nan, dtype=self.dtype)
+            for fragment_start, fragment_end, fragment in fragments:
+                chunk[fragment_start:fragment_end] = fragment
+
+            self._write_chunk(time_index, chunk_index, chunk)
+
+            chunk_dir = fragments_dir / self._chunk_key(time_index, chunk_index)
+            for name in os.listdir(chunk_dir):
+                try:
+                    os.remove(chunk_dir / name)
+                except OSError:
+                    pass
+            try:
+                os.rmdir(chunk_dir)
+            except OSError:
+                pass
+
+
+    @staticmethod
+    def _copy_rows(data, start, end, rows_start, rows):
+        "Copies the part of rows (points rows_start ...) that overlaps [start, end) into data (points start ...)"
+        lo, hi = max(start, rows_start), min(end, rows_start + len(rows))
+        if lo < hi:
+            data[lo - start:hi - start] = rows[lo - rows_start:hi - rows_start]
+
+    @staticmethod
+    def _chunk_key(time_index, chunk_index):
+        return f"{time_index}.{chunk_index}.0"
+
+    def _encode(self, array):
+        data = np.ascontiguousarray(array, dtype=self.dtype)
+        for codec in self._filters:
+            data = codec.encode(data)
+        return self._compressor.encode(data) if self._compressor is not None else np.asarray(data).tobytes()
+
+    def _decode(self, data, shape):
+        if self._compressor is not None:
+            data = self._compressor.decode(data)
+        for codec in reversed(self._filters):
+            data = codec.decode(data)
+        return np.frombuffer(data, dtype=self.dtype).reshape(shape).copy()
+
+    def _read_chunk(self, time_index, chunk_index):
+        path = self.store_path / self._chunk_key(time_index, chunk_index)
+        if not path.is_file():
+            return None
+        with open(path, "rb") as f:
+            return self._decode(f.read(), (self.chunk_rows, self.shape[2]))
+
+    def _write_chunk(self, time_index, chunk_index, chunk):
+        _write_atomic(self.store_path / self._chunk_key(time_index, chunk_index), self._encode(chunk))
+
+    def _write_fragment(self, time_index, chunk_index, fragment_start, fragment_end, fragment):
+        chunk_dir = self.store_path / ".fragments" / self._chunk_key(time_index, chunk_index)
+        chunk_dir.mkdir(parents=True, exist_ok=True)
+        _write_atomic(chunk_dir / f"{fragment_start}-{fragment_end}", self._encode(fragment))
+
+    def _iter_fragments(self, time_index):
+        "(chunk_index, start, end, rows) of every fragment of the snapshot, start and end relative to the chunk"
+        fragments_dir = self.store_path / ".fragments"
+        if not fragments_dir.is_dir():
+            return
+
+        for chunk_key in os.listdir(fragments_dir):
+            key_time, chunk_index, _ = chunk_key.split(".")
+            if int(key_time) != time_index:
+                continue
+
+            chunk_dir = fragments_dir / chunk_key
+            for name in sorted(os.listdir(chunk_dir)):
+                if name.startswith("."):
+                    continue  # Temporary file of a write in progress
+                start, end = (int(v) for v in name.split("-"))
+                try:
+                    with open(chunk_dir / name, "rb") as f:
+                        fragment = self._decode(f.read(), (end - start, self.shape[2]))
+                except FileNotFoundError:
+                    continue  # Consolidated meanwhile
+                yield int(chunk_index), start, end, fragment
+
+
+class DirectoryStoreWriter:
+    """
+    SnapshotWriter interface over a directory store, for one snapshot. Writes go straight to their chunk or fragment
+    files, so flush() has nothing to do. If the writer covers the whole volume (point_range None) it owns the
+    snapshot and consolidates the fragments once the snapshot is marked complete.
+    """
+    def __init__(self, storage, store_path, variable, time_index, point_range=None):
+        self.storage = storage
+        self.store_path = Path(store_path)
+        self.variable = variable
+        self.time_index = time_index
+        self.point_range = point_range
+
+        self._array = None
+        self._log = None
+
+    @property
+    def path(self):
+        return self.store_path
+
+    @property
+    def is_open(self):
+        return self._array is not None
+
+
+    def create(self, shape, attrs, dtype=np.float32, chunks=True, codec="none", level=None):
+        """
+        Creates the store on first use, then records the snapshot's attributes and leaves it open. Creating a
+        store that already exists (e.g. from another shard) only adds the snapshot.
+        """
+        n_points, dims = shape
+        gc = self.storage.grid_config
+
+        self.store_path.mkdir(parents=True, exist_ok=True)
+        (self.store_path / ".snapshots").mkdir(exist_ok=True)
+
+        if not (self.store_path / ".zarray").is_file():
+            chunk_rows = chunks[0] if isinstance(chunks, (tuple, list)) else min(4000, n_points)
+            compressor, filters = DirectoryStorage.compressor_config(codec, level)
+            meta = {
+                "zarr_format": 2,
+                "shape": [gc.nt, n_points, dims],
+                "chunks": [1, int(chunk_rows), dims],
+                "dtype": np.dtype(dtype).str,
+                "compressor": compressor,
+                "filters": filters,
+                "fill_value": "NaN",
+                "order": "C",
+                "dimension_separator": ".",
+            }
+            # Series-level attributes, snapshot-level ones (time, min, max) are kept per snapshot below
+            series_attrs = {key: val for key, val in attrs.items()
+                            if key not in ("snapshot_time", "min", "max", "is_complete")}
+
+            _write_atomic(self.store_path / ".zattrs", json.dumps(series_attrs, default=_to_json).encode())
+            _write_atomic(self.store_path / ".zarray", json.dumps(meta, indent=4).encode())
+
+        _write_atomic(self.store_path / ".snapshots" / f"{self.time_index}.json",
+                      json.dumps(dict(attrs, completion_index=True), default=_to_json).encode())
+        self.open()
+
+
+    def open(self):
+        try:
+            self._array = DirectoryStoreArray(self.store_path)
+            is_indexed = self._array.snapshot_attrs(self.time_index).get("completion_index", False)
+        except (OSError, ValueError) as e:
+            raise OSError(f"Failed to open {self.store_path}\n{e}")
+
+        # Snapshots started before the completion index existed are written without one
+        if is_indexed:
+            start, end = self.point_range if self.point_range is not None else (0, self._array.shape[1])
+            self._log = CompletionLog(DirectoryStorage.completion_log_path(self.store_path, self.time_index,
+                                                                           start, end))
+
+
+    def write(self, chunk_indices, data_array):
+        start, end = chunk_indices
+        rows = self._array.chunk_rows
+        n_points = self._array.shape[1]
+
+        try:
+            for chunk_index in range(start // rows, -(-end // rows)):
+                chunk_start = chunk_index * rows
+                chunk_len = min(rows, n_points - chunk_start)
+                local_start = max(start, chunk_start) - chunk_start
+                local_end = min(end, chunk_start + chunk_len) - chunk_start
+                part = data_array[chunk_start + local_start - start:chunk_start + local_end - start]
+
+                if local_start == 0 and local_end == chunk_len:
+                    if chunk_len < rows:
+                        padded = np.full((rows, part.shape[1]), np.nan, dtype=self._array.dtype)
+                        padded[:chunk_len] = part
+                        part = padded
+                    self._array._write_chunk(self.time_index, chunk_index, part)
+                else:
+                    self._array._write_fragment(self.time_index, chunk_index, local_start, local_end, part)
+
+            if self._log is not None:
+                self._log.append(chunk_indices, data_array)
+
+        except OSError as e:
+            raise OSError(f"Failed to write points {start}-{end} to {self.store_path}\n{e}")
+
+
+    def read(self, chunk_indices):
+        return self._array.read_rows(self.time_index, chunk_indices[0], chunk_indices[1])
+
+
+    def flush(self):
+        "Every write is already in its own file"
+        pass
+
+
+    def close(self, final_attrs=None):
+        """
+        Marking the snapshot complete only marks this writer's point range complete. The snapshot is complete once
+        the marked ranges cover the volume. The other final attributes of a writer of part of the volume are kept
+        in its marker, for whoever merges the parts (ShardMerger).
+        """
+        if self._array is None:
+            return
+
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+        final_attrs = dict(final_attrs or {})
+        is_complete = final_attrs.pop("is_complete", False)
+
+        if self.point_range is None and final_attrs:
+            self._array.update_snapshot_attrs(self.time_index, final_attrs)
+
+        if is_complete:
+            start, end = self.point_range if self.point_range is not None else (0, self._array.shape[1])
+            marker = self.store_path / ".snapshots" / f"{self.time_index}__complete__{start}-{end}"
+            content = json.dumps(final_attrs, default=_to_json).encode() if self.point_range is not None else b""
+            _write_atomic(marker, content)
+
+            if self.point_range is None:
+                self._array.consolidate(self.time_index)
+
+        self._array = None
+
+
+class MemmapStorage:
+    """
+    One preallocated .npy file of shape (nx, ny, nz, dims) float32 per snapshot, memory mapped while it is written,
+    next to a sidecar JSON holding the snapshot attributes. Writing a chunk is one copy into the mapped region (the
+    page cache): no compression and no HDF5 metadata. Meant for fast local disks; convert_to_hdf5 writes regular
+    snapshot files afterwards.
+
+    Points are ordered z fastest, then y, then x, so a flat [start, end) range is one contiguous region of the file
+    and shards can write into the same file in parallel. Points that were never written read as 0.
+    """
+    name = "memmap"
+    supports_parallel_writers = True
+    supports_series_dataset = False
+
+    def __init__(self, storage_config, grid_config, hash_str):
+        self.storage_config = storage_config
+        self.grid_config = grid_config
+        self.hash_str = hash_str
+
+    def snapshot_path(self, data_dir, variable, time_index):
+        h5_name = HDF5Storage.snapshot_filename(time_index, self.grid_config.nt, self.hash_str)
+        return Path(data_dir) / (h5_name[:-len(".h5")] + ".npy")
+
+    @staticmethod
+    def sidecar_path(npy_path):
+        return Path(npy_path).with_suffix(".json")
+
+    @staticmethod
+    def markers_dir(npy_path):
+        "Completion markers of the point ranges written by shards"
+        return Path(npy_path).parent / ".memmap_complete"
+
+    @staticmethod
+    def completion_log_path(npy_path, start, end):
+        "Ranges and checksums written by the writer of points [start, end) of the snapshot"
+        npy_path = Path(npy_path)
+        return npy_path.parent / ".completion" / f"{npy_path.name}__{start}-{end}"
+
+    @classmethod
+    def completion_log_paths(cls, npy_path):
+        npy_path = Path(npy_path)
+        completion_dir = npy_path.parent / ".completion"
+        prefix = npy_path.name + "__"
+        return [completion_dir / name for name in (os.listdir(completion_dir) if completion_dir.is_dir() else [])
+                if name.startswith(prefix)]
+
+
+    def filter_kwargs(self):
+        "Raw files are never compressed, the codec of the series is only used by convert_to_hdf5"
+        return {}
+
+    def create_writer(self, data_dir, variable, time_index, chunk_cache=None, point_range=None):
+        return MemmapWriter(self, self.snapshot_path(data_dir, variable, time_index), variable, time_index,
+                            point_range=point_range)
+
+
+    def snapshot_exists(self, data_dir, variable, time_index):
+        npy_path = self.snapshot_path(data_dir, variable, time_index)
+        return npy_path.is_file() and self.sidecar_path(npy_path).is_file()
+
+    def read_attrs(self, data_dir, variable, time_index):
+        with open(self.sidecar_path(self.snapshot_path(data_dir, variable, time_index)), "r") as f:
+            return json.load(f)
+
+    def is_snapshot_complete(self, data_dir, variable, time_index, point_range=None):
+        "True if the snapshot is marked complete, or every index of point_range was marked complete by a shard"
+        if not self.snapshot_exists(data_dir, variable, time_index):
+            return False
+        if self.read_attrs(data_dir, variable, time_index).get("is_complete", False):
+            return True
+
+        gc = self.grid_config
+        start, end = point_range if point_range is not None else (0, gc.nx * gc.ny * gc.nz)
+        covered = start
+        for range_start, range_end in self._complete_ranges(self.snapshot_path(data_dir, variable, time_index)):
+            if range_start > covered:
+                break
+            covered = max(covered, range_end)
+        return covered >= end
+
+    def read_snapshot(self, data_dir, variable, time_index):
+        data = np.load(self.snapshot_path(data_dir, variable, time_index), mmap_mode="r")
+        return np.array(data.reshape(-1, data.shape[-1]))
+
+    def read_rows(self, data_dir, variable, time_index, start, end):
+        data = np.load(self.snapshot_path(data_dir, variable, time_index), mmap_mode="r")
+        return np.array(data.reshape(-1, data.shape[-1])[start:end])
+
+    def read_completion_index(self, data_dir, variable, time_index):
+        "CompletionIndex of the snapshot from the logs of all its writers, None if there is none"
+        if not self.snapshot_exists(data_dir, variable, time_index):
+            return None
+        if not self.read_attrs(data_dir, variable, time_index).get("completion_index", False):
+            return None  # Written before the completion index existed, unwritten points cannot be told apart
+
+        gc = self.grid_config
+        npy_path = self.snapshot_path(data_dir, variable, time_index)
+        return CompletionIndex.from_logs(gc.nx * gc.ny * gc.nz, CompletionIndex.DEFAULT_BLOCK_SIZE,
+                                         self.completion_log_paths(npy_path))
+
+    def mark_incomplete(self, data_dir, variable, time_index, point_range=None):
+        "Clears is_complete and removes the completion markers overlapping point_range (default: the whole volume)"
+        npy_path = self.snapshot_path(data_dir, variable, time_index)
+        if not self.snapshot_exists(data_dir, variable, time_index):
+            return
+        MemmapWriter.update_attrs(npy_path, {"is_complete": False})
+        _remove_markers(self.markers_dir(npy_path), npy_path.name + "__", point_range)
+
+    def consolidate(self, data_dir, variable, time_index):
+        "Marks the snapshot complete once the ranges marked by shards cover the volume"
+        npy_path = self.snapshot_path(data_dir, variable, time_index)
+        if not self.is_snapshot_complete(data_dir, variable, time_index):
+            return
+
+        MemmapWriter.update_attrs(npy_path, {"is_complete": True})
+        prefix = npy_path.name + "__"
+        markers_dir = self.markers_dir(npy_path)
+        for name in os.listdir(markers_dir) if markers_dir.is_dir() else []:
+            if name.startswith(prefix):
+                os.remove(markers_dir / name)
+        try:
+            os.rmdir(markers_dir)
+        except OSError:
+            pass  # Missing, or still holds the markers of other snapshots
+
+
+    def range_attrs(self, data_dir, variable, time_index):
+        "[start, end, attrs] recorded by the writers of parts of the volume (shards) when completing their range"
+        return self._range_attrs_of(self.snapshot_path(data_dir, variable, time_index))
+
+    def update_attrs(self, data_dir, variable, time_index, attrs):
+        MemmapWriter.update_attrs(self.snapshot_path(data_dir, variable, time_index), attrs)
+
+
+    def convert_to_hdf5(self, data_dir, variable, time_index, hdf5_storage, chunks=True, block_size=1_000_000):
+        """
+        Writes the snapshot as a regular HDF5 snapshot file of hdf5_storage, with the attributes of its sidecar
+        and hdf5_storage's compression. Incomplete snapshots stay incomplete, so the series can resume afterwards.
+
+        :return: path of the HDF5 file
+        """
+        npy_path = self.snapshot_path(data_dir, variable, time_index)
+        data = np.load(npy_path, mmap_mode="r")
+        flat = data.reshape(-1, data.shape[-1])
+
+        # Only the written ranges are copied, so the HDF5 file's completion index holds the same ranges
+        index = self.read_completion_index(data_dir, variable, time_index)
+        written_ranges = index.covered_ranges() if index is not None else [[0, flat.shape[0]]]
+
+        attrs = self.read_attrs(data_dir, variable, time_index)
+        is_complete = self.is_snapshot_complete(data_dir, variable, time_index)
+        attrs.pop("storage_backend", None)
+        attrs.pop("completion_index", None)
+        shape = hdf5_storage.storage_config.dataset_shape(self.grid_config, flat.shape[1])
+        attrs.update(hdf5_storage.storage_config.compression_attrs(), is_complete=False, shape=shape,
+                     chunk_layout=hdf5_storage.storage_config.chunk_layout)
+
+        h5_path = hdf5_storage.snapshot_path(data_dir, variable, time_index)
+        tmp_path = h5_path.with_name(h5_path.name + ".converting")
+        writer = SnapshotWriter(tmp_path, variable, time_index)
+        try:
+            writer.create(shape=shape, attrs=attrs, dtype=np.float32, chunks=chunks,
+                          **hdf5_storage.filter_kwargs())
+            for range_start, range_end in written_ranges:
+                for start in range(range_start, range_end, block_size):
+                    end = min(start + block_size, range_end)
+                    writer.write((start, end), np.ascontiguousarray(flat[start:end]))
+            writer.close(final_attrs={"is_complete": True} if is_complete else None)
+        except Exception:
+            writer.close()
+            if tmp_path.exists():
+                tmp_path.unlink()
+            raise
+
+        os.replace(tmp_path, h5_path)
+        return h5_path
+
+    def remove_snapshot(self, data_dir, variable, time_index):
+        npy_path = self.snapshot_path(data_dir, variable, time_index)
+        for path in [npy_path, self.sidecar_path(npy_path)] + self.completion_log_paths(npy_path):
+            if path.exists():
+                path.unlink()
+        try:
+            os.rmdir(npy_path.parent / ".completion")
+        except OSError:
+            pass  # Missing, or still holds the logs of other snapshots
+
+
+    def _complete_ranges(self, npy_path):
+        return [(start, end) for start, end, _ in self._range_attrs_of(npy_path)]
+
+    def _range_attrs_of(self, npy_path):
+        npy_path = Path(npy_path)
+        prefix = npy_path.name + "__"
+        markers_dir = self.markers_dir(npy_path)
+        ranges = []
+        for name in os.listdir(markers_dir) if markers_dir.is_dir() else []:
+            if name.startswith(prefix):
+                start, end = name[len(prefix):].split("-")
+                with open(markers_dir / name, "rb") as f:
+                    content = f.read()
+                ranges.append([int(start), int(end), json.loads(content) if content else {}])
+        return sorted(ranges, key=lambda r: r[0])
+
+
+class MemmapWriter:
+    """
+    SnapshotWriter interface over one memory mapped .npy snapshot. flush() has nothing to do: a crash of this process
+    cannot lose data already copied into the shared mapping, close() writes it out with msync. Marking the snapshot
+    complete only marks this writer's point range if it covers part of the volume (a shard).
+    """
+    def __init__(self, storage, npy_path, variable, time_index, point_range=None):
+        self.storage = storage
+        self.npy_path = Path(npy_path)
+        self.variable = variable
+        self.time_index = time_index
+        self.point_range = point_range
+
+        self._mmap = None
+        self._flat = None
+        self._log = None
+
+    @property
+    def path(self):
+        return self.npy_path
+
+    @property
+    def is_open(self):
+        return self._mmap is not None
+
+
+    def create(self, shape, attrs, dtype=np.float32, chunks=True):
+        """
+        Preallocates the snapshot file, writes the sidecar and leaves the file mapped. Creating a file that already
+        exists (e.g. from another shard) keeps its data.
+
+        :param shape: (n_points, dims) or (nx, ny, nz, dims) of the snapshot, stored as (nx, ny, nz, dims)
+        """
+        gc = self.storage.grid_config
+        dims = shape[-1]
+        self.npy_path.parent.mkdir(parents=True, exist_ok=True)
+
+        attrs = dict(attrs, storage_backend=MemmapStorage.name, compression="none", compression_level=-1,
+                     chunk_layout="none", completion_index=True)
+        _write_atomic(MemmapStorage.sidecar_path(self.npy_path), json.dumps(attrs, default=_to_json).encode())
+
+        if not self.npy_path.exists():
+            # Allocated under a temporary name and linked into place, which fails instead of replacing the file if
+            # another writer got there first
+            tmp_path = self.npy_path.with_name(f".{self.npy_path.name}.tmp{os.getpid()}_{threading.get_ident()}")
+            mmap = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=(gc.nx, gc.ny, gc.nz, dims))
+            del mmap
+            try:
+                os.link(tmp_path, self.npy_path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_path)
+
+        self.open()
+
+
+    def open(self):
+        try:
+            self._mmap = np.load(self.npy_path, mmap_mode="r+")
+        except (OSError, ValueError) as e:
+            raise OSError(f"Failed to open {self.npy_path}\n{e}")
+        self._flat = self._mmap.reshape(-1, self._mmap.shape[-1])
+
+        # Snapshots started before the completion index existed are written without one
+        with open(MemmapStorage.sidecar_path(self.npy_path), "r") as f:
+            is_indexed = json.load(f).get("completion_index", False)
+        if is_indexed:
+            start, end = self.point_range if self.point_range is not None else (0, self._flat.shape[0])
+            self._log = CompletionLog(MemmapStorage.completion_log_path(self.npy_path, start, end))
+
+
+    def write(self, chunk_indices, data_array):
+        start, end = chunk_indices
+        try:
+            self._flat[start:end] = data_array
+            if self._log is not None:
+                self._log.append(chunk_indices, data_array)
+        except (OSError, ValueError) as e:
+            raise OSError(f"Failed to write points {start}-{end} to {self.npy_path}\n{e}")
+
+
+    def read(self, chunk_indices):
+        return np.array(self._flat[chunk_indices[0]:chunk_indices[1]])
+
+
+    def flush(self):
+        pass
+
+
+    def close(self, final_attrs=None):
+        "The final attributes of a writer of part of the volume are kept in its marker, like DirectoryStoreWriter"
+        if self._mmap is None:
+            return
+
+        try:
+            self._mmap.flush()
+        finally:
+            self._mmap = None
+            self._flat = None
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+        if final_attrs and final_attrs.get("is_complete") and self.point_range is not None:
+            start, end = self.point_range
+            markers_dir = MemmapStorage.markers_dir(self.npy_path)
+            markers_dir.mkdir(exist_ok=True)
+            content = {key: val for key, val in final_attrs.items() if key != "is_complete"}
+            _write_atomic(markers_dir / f"{self.npy_path.name}__{start}-{end}",
+                          json.dumps(content, default=_to_json).encode())
+            return
+
+        if final_attrs:
+            self.update_attrs(self.npy_path, final_attrs)
+
+
+    @staticmethod
+    def update_attrs(npy_path, new_attrs):
+        sidecar_path = MemmapStorage.sidecar_path(npy_path)
+        with open(sidecar_path, "r") as f:
+            attrs = json.load(f)
+        attrs.update(new_attrs)
+        _write_atomic(sidecar_path, json.dumps(attrs, default=_to_json).encode())
+
+
+def _remove_markers(markers_dir, prefix, point_range=None):
+    "Removes the <prefix><start>-<end> completion markers whose range overlaps point_range (default: all of them)"
+    for name in os.listdir(markers_dir) if Path(markers_dir).is_dir() else []:
+        if not name.startswith(prefix):
+            continue
+        start, end = (int(v) for v in name[len(prefix):].split("-"))
+        if point_range is None or (start < point_range[1] and end > point_range[0]):
+            try:
+                os.remove(Path(markers_dir) / name)
+            except FileNotFoundError:
+                pass
+
+
+class _ZlibCodec:
+    "numcodecs-compatible zlib codec, so the gzip codec works without numcodecs"
+    def __init__(self, level):
+        self.level = level
+
+    def encode(self, buf):
+        return zlib.compress(np.ascontiguousarray(buf).tobytes(), self.level)
+
+    def decode(self, buf):
+        return zlib.decompress(buf)
+
+
+def _get_codec(config):
+    if config is None:
+        return None
+    if config["id"] == "zlib" and numcodecs is None:
+        return _ZlibCodec(config.get("level", 4))
+    if numcodecs is None:
+        raise ImportError(f"Reading a directory store compressed with '{config['id']}' needs the numcodecs package")
+    return numcodecs.get_codec(dict(config))
@@ -0,0 +1,439 @@
+"""
+Statistics of the queried values, accumulated chunk by chunk while a series downloads, so normalization statistics
+need no second pass over the snapshot files.
+
+Per snapshot and per series, for every component: min and max, mean and variance (Welford's method, with Chan's
+update for whole chunks), a histogram and the mean profile over the y-planes.
+
+    Usage:
+            stats = StatsAccumulator(dims=3, ny=ny, nz=nz)
+            stats.add(time_index, (start, end), data)                       # every saved chunk
+            snapshot_stats = stats.complete_snapshot(time_index, (0, n_points), read_rows)
+            writer.close(final_attrs={"is_complete": True, **snapshot_stats.to_attrs()})
+"""
+import threading
+import json
+import math
+import os
+import numpy as np
+
+
+class Histogram:
+    """
+    Histogram of one component with bins [i * width, (i + 1) * width) for i = start .. start + len(counts) - 1.
+
+    The width is always a power of two and bins are aligned to 0, so histograms of different chunks, snapshots or
+    shards can be merged exactly: the finer one is coarsened to the width of the other. Whenever the values span more
+    than max_bins bins, the width is doubled.
+    """
+    def __init__(self, max_bins=128, width=None, start=0, counts=None):
+        self.max_bins = int(max_bins)
+        self.width = width
+        self.start = int(start)
+        self.counts = np.asarray(counts if counts is not None else [], dtype=np.int64)
+
+
+    def add(self, values):
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return
+
+        other = Histogram(self.max_bins, width=self._initial_width(values))
+        indices = np.floor(values / other.width).astype(np.int64)
+        other.start = int(indices.min())
+        other.counts = np.bincount(indices - other.start)
+        while len(other.counts) > self.max_bins:
+            other._coarsen(2)
+
+        self.merge(other)
+
+
+    def merge(self, other):
+        if other.width is None:
+            return
+        if self.width is None:
+            self.width, self.start, self.counts = other.width, other.start, other.counts.copy()
+            return
+
+        other = Histogram(other.max_bins, other.width, other.start, other.counts)
+        if other.width > self.width:
+            self._coarsen(int(round(other.width / self.width)))
+        elif other.width < self.width:
+            other._coarsen(int(round(self.width / other.width)))
+
+        # Coarsen both to the first width at which their combined span fits max_bins, before allocating it. Two narrow
+        # histograms far apart would otherwise allocate every empty bin between them at the fine width.
+        start = min(self.start, other.start)
+        end = max(self.start + len(self.counts), other.start + len(other.counts))
+        factor = 1
+        while (end - 1) // factor - start // factor + 1 > self.max_bins:
+            factor *= 2
+        self._coarsen(factor)
+        other._coarsen(factor)
+
+        start = min(self.start, other.start)
+        end = max(self.start + len(self.counts), other.start + len(other.counts))
+        counts = np.zeros(end - start, dtype=np.int64)
+        counts[self.start - start:self.start - start + len(self.counts)] += self.counts
+        counts[other.start - start:other.start - start + len(other.counts)] += other.counts
+        self.start, self.counts = start, counts
+
+
+    def edges(self):
+        return (self.start + np.arange(len(self.counts) + 1)) * self.width
+
+
+    def to_dict(self):
+        return {"width": self.width, "start": self.start, "counts": self.counts.tolist()}
+
+    @classmethod
+    def from_dict(cls, hist_dict, max_bins=128):
+        return cls(max_bins, hist_dict["width"], hist_dict["start"], hist_dict["counts"])
+
+
+    def _initial_width(self, values):
+        "Largest power of two that still spreads values over at least half of max_bins"
+        span = float(values.max() - values.min())
+        if span == 0:
+            span = abs(float(values[0])) or 1.0
+        return 2.0 ** math.floor(math.log2(span / self.max_bins))
+
+    def _coarsen(self, factor):
+        "Merges every factor bins into one. factor must be a power of two."
+        if factor <= 1:
+            return
+        indices = (self.start + np.arange(len(self.counts))) // factor
+        self.start = int(indices[0])
+        self.counts = np.bincount(indices - self.start, weights=self.counts).astype(np.int64)
+        self.width *= factor
+
+
+class StreamingStats:
+    """
+    Running statistics of the (n_points, dims) values of one snapshot, or of several snapshots once merged.
+
+    Chunks are added by their [start, end) point range. Ranges already covered are skipped, so a chunk that is
+    queried again after a resume is never counted twice, and fill_missing() reads back whatever was saved but not
+    added (e.g. chunks saved after the last state save before a crash).
+    """
+    def __init__(self, dims, ny, nz, max_bins=128):
+        self.dims = int(dims)
+        self.ny = int(ny)
+        self.nz = int(nz)
+        self.max_bins = int(max_bins)
+
+        self.count = 0
+        self.min = np.full(self.dims, np.inf)
+        self.max = np.full(self.dims, -np.inf)
+        self.mean = np.zeros(self.dims)
+        self.m2 = np.zeros(self.dims)  # Sum of squared deviations from the mean
+        self.histograms = [Histogram(self.max_bins) for _ in range(self.dims)]
+        self.y_sum = np.zeros((self.ny, self.dims))
+        self.y_count = np.zeros(self.ny, dtype=np.int64)
+
+        self.covered = []  # Merged [start, end) point ranges added so far
+
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else np.full(self.dims, np.nan)
+
+    @property
+    def y_mean(self):
+        "(ny, dims) mean of every y-plane, NaN for planes without values"
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.y_sum / self.y_count[:, None]
+
+
+    def add(self, chunk_indices, data):
+        "Adds the rows of data, the values of points [start, end), skipping any part already added"
+        start, end = chunk_indices
+        for sub_start, sub_end in _subtract_ranges((start, end), self.covered):
+            self._add_values(sub_start, np.asarray(data[sub_start - start:sub_end - start], dtype=np.float64))
+            self.covered = _merge_ranges(self.covered + [[sub_start, sub_end]])
+
+
+    def fill_missing(self, point_range, read_rows, block_size=1_000_000):
+        """
+        Adds every part of point_range not added yet
+
+        :param read_rows: function (start, end) -> (end - start, dims) array of the saved values
+        """
+        for start, end in _subtract_ranges(point_range, self.covered):
+            for block_start in range(start, end, block_size):
+                block_end = min(block_start + block_size, end)
+                self.add((block_start, block_end), read_rows(block_start, block_end))
+
+
+    def merge(self, other):
+        "Adds the statistics of other, which must cover points (or snapshots) this one does not"
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.mean, self.m2 = other.mean.copy(), other.m2.copy()
+        else:
+            self.mean, self.m2 = _combine_moments(self.count, self.mean, self.m2, other.count, other.mean, other.m2)
+        self.count += other.count
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        for hist, other_hist in zip(self.histograms, other.histograms):
+            hist.merge(other_hist)
+        self.y_sum += other.y_sum
+        self.y_count += other.y_count
+        self.covered = _merge_ranges(self.covered + other.covered)
+
+
+    def to_dict(self):
+        return {
+            "dims": self.dims,
+            "ny": self.ny,
+            "nz": self.nz,
+            "max_bins": self.max_bins,
+            "count": int(self.count),
+            "min": self.min.tolist(),
+            "max": self.max.tolist(),
+            "mean": self.mean.tolist(),
+            "m2": self.m2.tolist(),
+            "histograms": [hist.to_dict() for hist in self.histograms],
+            "y_sum": self.y_sum.tolist(),
+            "y_count": self.y_count.tolist(),
+            "covered": self.covered,
+        }
+
+    @classmethod
+    def from_dict(cls, stats_dict):
+        self = cls(stats_dict["dims"], stats_dict["ny"], stats_dict["nz"], stats_dict.get("max_bins", 128))
+        self.count = int(stats_dict["count"])
+        self.min = np.asarray(stats_dict["min"], dtype=np.float64)
+        self.max = np.asarray(stats_dict["max"], dtype=np.float64)
+        self.mean = np.asarray(stats_dict["mean"], dtype=np.float64)
+        self.m2 = np.asarray(stats_dict["m2"], dtype=np.float64)
+        self.histograms = [Histogram.from_dict(h, self.max_bins) for h in stats_dict["histograms"]]
+        self.y_sum = np.asarray(stats_dict["y_sum"], dtype=np.float64).reshape(self.ny, self.dims)
+        self.y_count = np.asarray(stats_dict["y_count"], dtype=np.int64)
+        self.covered = [list(r) for r in stats_dict.get("covered", [])]
+        return self
+
+    @classmethod
+    def from_json(cls, text):
+        return cls.from_dict(json.loads(text))
+
+
+    def summary(self):
+        "Per-component results, as stored in the attributes"
+        return {
+            "count": int(self.count),
+            "min": self.min.tolist(),
+            "max": self.max.tolist(),
+            "mean": self.mean.tolist(),
+            "var": self.variance.tolist(),
+            "std": np.sqrt(self.variance).tolist(),
+            "histograms": [{"edges": hist.edges().tolist(), "counts": hist.counts.tolist()}
+                           for hist in self.histograms],
+            "y_mean": self.y_mean.tolist(),
+        }
+
+
+    def to_attrs(self):
+        """
+        Snapshot (or series) attributes: min and max over every component, replacing the first-chunk values written
+        when the snapshot was created, per-component mean and std, and every statistic as JSON under "stats"
+        """
+        return {
+            "min": float(self.min.min()),
+            "max": float(self.max.max()),
+            "mean": self.mean,
+            "std": np.sqrt(self.variance),
+            "stats_count": int(self.count),
+            "stats": json.dumps(self.to_dict()),
+        }
+
+
+    def _add_values(self, start, values):
+        if len(values) == 0:
+            return
+
+        # Welford's update for a whole chunk at once (Chan et al.): combine the running moments with the chunk's
+        batch_mean = values.mean(axis=0)
+        batch_m2 = ((values - batch_mean) ** 2).sum(axis=0)
+        if self.count == 0:
+            self.mean, self.m2 = batch_mean, batch_m2
+        else:
+            self.mean, self.m2 = _combine_moments(self.count, self.mean, self.m2, len(values), batch_mean, batch_m2)
+        self.count += len(values)
+
+        self.min = np.minimum(self.min, values.min(axis=0))
+        self.max = np.maximum(self.max, values.max(axis=0))
+        for component, hist in enumerate(self.histograms):
+            hist.add(values[:, component])
+
+        # Points are ordered z fastest, then y, then x
+        y_index = (np.arange(start, start + len(values)) // self.nz) % self.ny
+        self.y_count += np.bincount(y_index, minlength=self.ny)
+        for component in range(self.dims):
+            self.y_sum[:, component] += np.bincount(y_index, weights=values[:, component], minlength=self.ny)
+
+
+class StatsAccumulator:
+    """
+    Statistics of every snapshot a session is writing plus those of its completed snapshots (the series). add() is
+    called from the ChunkWriter thread, to_dict() from the query loop when the state is saved.
+    """
+    def __init__(self, dims, ny, nz, stats_dict=None):
+        self.dims = int(dims)
+        self.ny = int(ny)
+        self.nz = int(nz)
+
+        stats_dict = stats_dict or {}
+        self.snapshots = {int(t): StreamingStats.from_dict(s) for t, s in stats_dict.get("snapshots", {}).items()}
+        self.series = (StreamingStats.from_dict(stats_dict["series"]) if "series" in stats_dict
+                       else self._new_stats())
+        self.series_time_indices = set(stats_dict.get("series_time_indices", []))
+
+        self._lock = threading.Lock()
+
+
+    def add(self, time_index, chunk_indices, data):
+        with self._lock:
+            stats = self.snapshots.get(time_index)
+            if stats is None:
+                stats = self.snapshots[time_index] = self._new_stats()
+            stats.add(chunk_indices, data)
+
+
+    def complete_snapshot(self, time_index, point_range, read_rows):
+        """
+        Final statistics of a snapshot: adds whatever part of point_range was saved without being added, then
+        merges the snapshot into the series (once)
+
+        :param read_rows: function (start, end) -> values of points [start, end) saved in the snapshot
+        :return: StreamingStats of the snapshot
+        """
+        with self._lock:
+            stats = self.snapshots.get(time_index) or self._new_stats()
+
+        stats.fill_missing(point_range, read_rows)
+
+        with self._lock:
+            self.snapshots.pop(time_index, None)
+            if time_index not in self.series_time_indices:
+                snapshot_part = StreamingStats.from_dict(stats.to_dict())
+                snapshot_part.covered = []  # Point ranges repeat across snapshots
+                self.series.merge(snapshot_part)
+                self.series_time_indices.add(time_index)
+
+        return stats
+
+
+    def discard_snapshots(self, time_indices, read_stats_json=None):
+        """
+        Forgets the statistics of snapshots whose ranges are queried again. Their statistics are rebuilt when they
+        complete. If any of them was already merged into the series statistics, those are rebuilt from the remaining
+        completed snapshots.
+
+        :param read_stats_json: Optional function time_index -> JSON statistics of a completed snapshot (its 'stats'
+                                attribute) or None. Without it, or if any is None, the series statistics start over.
+        """
+        time_indices = {int(t) for t in time_indices}
+        with self._lock:
+            for time_index in time_indices:
+                self.snapshots.pop(time_index, None)
+
+            if not time_indices & self.series_time_indices:
+                return
+
+            remaining = sorted(self.series_time_indices - time_indices)
+            stats_jsons = [read_stats_json(t) if read_stats_json is not None else None for t in remaining]
+            self.series = self._new_stats()
+            self.series_time_indices = set()
+            if any(stats_json is None for stats_json in stats_jsons):
+                print(f"[WARNING] Series statistics restart, snapshots {remaining} have no statistics to rebuild "
+                      f"them from")
+                return
+
+            for time_index, stats_json in zip(remaining, stats_jsons):
+                snapshot_part = StreamingStats.from_json(stats_json)
+                snapshot_part.covered = []
+                self.series.merge(snapshot_part)
+                self.series_time_indices.add(time_index)
+
+
+    def restore_snapshot(self, time_index, stats_json):
+        "Takes the statistics of a completed snapshot from its 'stats' attribute, so completing it again reads nothing"
+        with self._lock:
+            self.snapshots[int(time_index)] = StreamingStats.from_json(stats_json)
+
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "snapshots": {str(t): stats.to_dict() for t, stats in self.snapshots.items()},
+                "series": self.series.to_dict(),
+                "series_time_indices": sorted(self.series_time_indices),
+            }
+
+
+    def _new_stats(self):
+        return StreamingStats(self.dims, self.ny, self.nz)
+
+
+def series_stats_path(h5_dir, hash_str):
+    "Statistics of every completed snapshot of a variable, kept next to its snapshots"
+    return h5_dir / f"stats__hash={hash_str[:8]}.json"
+
+
+def write_series_stats(path, stats, time_indices, nt):
+    series_dict = {
+        "time_indices": sorted(int(t) for t in time_indices),
+        "is_complete": len(set(time_indices)) == nt,
+        "summary": stats.summary(),
+        "stats": stats.to_dict(),
+    }
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(series_dict, f)
+    os.replace(tmp_path, path)
+
+
+def read_series_stats(path):
+    "(StreamingStats, time_indices) of a series stats file, or (None, []) if there is none"
+    if not path.is_file():
+        return None, []
+    with open(path, "r") as f:
+        series_dict = json.load(f)
+    return StreamingStats.from_dict(series_dict["stats"]), series_dict["time_indices"]
+
+
+def _combine_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (count_b / count)
+    m2 = m2_a + m2_b + delta ** 2 * (count_a * count_b / count)
+    return mean, m2
+
+
+def _merge_ranges(ranges):
+    merged = []
+    for range_start, range_end in sorted([list(r) for r in ranges]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_end)
+        else:
+            merged.append([range_start, range_end])
+    return merged
+
+
+def _subtract_ranges(point_range, covered):
+    "Parts of point_range [start, end) outside the merged ranges of covered"
+    start, end = point_range
+    parts = []
+    for covered_start, covered_end in covered:
+        if covered_end <= start:
+            continue
+        if covered_start >= end:
+            break
+        if covered_start > start:
+            parts.append((start, covered_start))
+        start = max(start, covered_end)
+    if start < end:
+        parts.append((start, end))
+    return parts
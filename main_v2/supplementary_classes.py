@@ -1,9 +1,10 @@
 
 # dataset_constraints, runtime_config, query_method_config, grid_config
 
-from PyQt6.QtGui import QIntValidator, QDoubleValidator
-from PyQt6.QtWidgets import QSpinBox, QDoubleSpinBox, QLineEdit, QComboBox, QLabel
 import json
+import math
+from main_v2.progress_journal import ProgressJournal
+from main_v2 import compression as snapshot_compression
 
 
 # For now instantiate with dictionaries. Later, UI will directly instantiate attributes for config classes.
@@ -44,6 +45,155 @@ class GridConfig:
         self.z_bounds = grid_config["z_bounds"]
 
 
+class StorageConfig:
+    """
+    On-disk layout of the snapshot datasets. Stored with the other configs of a series, but not part of its hash:
+    it changes how the snapshot files are written, not what they contain.
+
+    snapshot_shape: shape of the HDF5 snapshot datasets
+        - "flat": (nx * ny * nz, dims), points ordered z fastest, then y, then x. Series created before this option.
+        - "grid": (nx, ny, nz, dims), so slices and blocks of the volume are read as hyperslabs touching only the
+                  chunks they overlap. Query chunks are still flat point ranges, each is written as up to five
+                  hyperslabs. Not supported by the directory backend; memmap snapshots are always grid shaped and
+                  this decides the shape of their HDF5 conversion.
+    chunk_layout:
+        - "auto":    h5py guesses the chunk shape (chunks=True). Series created before this option use it.
+        - "query":   chunks of chunk_rows points, defaulting to the runtime config's starting_query_limit, so queries
+                     of that size fill whole chunks instead of rewriting partially written ones. For grid snapshots,
+                     blocks of about as many points with edges as equal as the grid allows, for block-wise reads.
+        - "y_plane": chunks of one z-line, i.e. the nz points at a fixed x and y index. Points are ordered z fastest,
+                     then y, then x, so every chunk lies within one y-plane and reading a plane touches no other plane.
+                     For grid snapshots, (cx, 1, nz) blocks of about chunk_rows points with a single y index.
+    chunk_cache_mb: HDF5 chunk cache of each open snapshot file. None sizes it to hold the chunks of the largest query.
+    compression, compression_level: codec of the snapshot datasets, see main_v2.compression.CODECS. A level of None
+                                    uses the codec's default.
+    backend: storage backend of the snapshots, see main_v2.storage_backends
+        - "hdf5":      one HDF5 file per snapshot
+        - "directory": one Zarr-style directory store per variable, one file per chunk, so shards write into the
+                       same array in parallel without locking
+        - "memmap":    one uncompressed, memory mapped .npy file of shape (nx, ny, nz, dims) per snapshot, converted
+                       to HDF5 afterwards (run_headless --convert-to-hdf5)
+
+        Usage:
+                storage_config = StorageConfig({"chunk_layout": "y_plane"})
+                shape = storage_config.dataset_shape(grid_config, dims)
+                chunks = storage_config.chunk_shape(grid_config, dims, starting_query_limit)
+                cache = storage_config.chunk_cache(chunks, max_query_rows, grid_config=grid_config)  # h5py.File kwargs
+                filters = storage_config.filter_kwargs()                     # kwargs of create_dataset
+    """
+    CHUNK_LAYOUTS = ("auto", "query", "y_plane")
+    BACKENDS = ("hdf5", "directory", "memmap")
+    SNAPSHOT_SHAPES = ("flat", "grid")
+
+    # Series whose config predates StorageConfig
+    LEGACY = {"chunk_layout": "auto", "compression": "gzip", "backend": "hdf5", "snapshot_shape": "flat"}
+
+    def __init__(self, storage_config=None):
+        storage_config = storage_config or {}
+        self.chunk_layout = storage_config.get("chunk_layout", "query")
+        self.chunk_rows = storage_config.get("chunk_rows", None)
+        self.chunk_cache_mb = storage_config.get("chunk_cache_mb", None)
+        self.compression = storage_config.get("compression", "gzip")
+        self.compression_level = storage_config.get("compression_level", None)
+        self.backend = storage_config.get("backend", "hdf5")
+        self.snapshot_shape = storage_config.get("snapshot_shape", "flat")
+
+        if self.backend not in self.BACKENDS:
+            raise ValueError(f"Unknown storage backend '{self.backend}'. Choose from {self.BACKENDS}")
+        if self.chunk_layout not in self.CHUNK_LAYOUTS:
+            raise ValueError(f"Unknown chunk layout '{self.chunk_layout}'. Choose from {self.CHUNK_LAYOUTS}")
+        if self.snapshot_shape not in self.SNAPSHOT_SHAPES:
+            raise ValueError(f"Unknown snapshot shape '{self.snapshot_shape}'. Choose from {self.SNAPSHOT_SHAPES}")
+        if self.snapshot_shape == "grid" and self.backend == "directory":
+            raise ValueError("Grid shaped snapshots are not supported by the directory backend")
+        # Only the name is checked here. Plugin codecs are checked when a file is written, so the config of a series
+        # can still be loaded where hdf5plugin is not installed.
+        snapshot_compression.get_codec(self.compression)
+
+
+    def filter_kwargs(self):
+        "Compression filter keyword arguments of h5py create_dataset"
+        return snapshot_compression.filter_kwargs(self.compression, self.compression_level)
+
+
+    def compression_attrs(self):
+        "Codec and resolved level as recorded in the snapshot attributes (level -1 for codecs without levels)"
+        level = snapshot_compression.resolve_level(self.compression, self.compression_level)
+        return {"compression": self.compression, "compression_level": -1 if level is None else level}
+
+
+    def dataset_shape(self, grid_config, dims):
+        "Shape of a snapshot dataset: (nx * ny * nz, dims) or (nx, ny, nz, dims)"
+        if self.snapshot_shape == "grid":
+            return grid_config.nx, grid_config.ny, grid_config.nz, int(dims)
+        return grid_config.nx * grid_config.ny * grid_config.nz, int(dims)
+
+
+    def chunk_shape(self, grid_config, dims, starting_query_limit):
+        "HDF5 chunk shape of a snapshot dataset of dataset_shape(), or True to let h5py choose"
+        if self.chunk_layout == "auto":
+            return True
+
+        nx, ny, nz = grid_config.nx, grid_config.ny, grid_config.nz
+        if self.snapshot_shape == "grid":
+            rows = max(int(self.chunk_rows or starting_query_limit), 1)
+            if self.chunk_layout == "y_plane":
+                return min(max(rows // nz, 1), nx), 1, nz, int(dims)
+
+            # Edges as equal as possible, filling the remaining points into the axes the grid leaves room in
+            cz = min(nz, max(round(rows ** (1 / 3)), 1))
+            cy = min(ny, max(round((rows / cz) ** (1 / 2)), 1))
+            cx = min(nx, max(rows // (cy * cz), 1))
+            return cx, cy, cz, int(dims)
+
+        if self.chunk_layout == "query":
+            rows = self.chunk_rows or starting_query_limit
+        else:
+            rows = nz
+
+        rows = min(max(int(rows), 1), nx * ny * nz)
+        return rows, int(dims)
+
+
+    def chunk_cache(self, chunk_shape, max_query_rows, itemsize=4, grid_config=None):
+        """
+        Chunk cache settings as keyword arguments of h5py.File. Empty (the h5py defaults) for the auto layout unless
+        chunk_cache_mb is set.
+
+        The automatic size holds every chunk a query of max_query_rows can touch, plus one, so a chunk that is only
+        partially written by one query is still cached when the next query completes it. Chunks are written once,
+        so fully written chunks are evicted first (rdcc_w0=1).
+
+        Grid chunks (nx, ny, nz, dims chunk shape, needs grid_config) are only complete once the queries reach the
+        end of their x-slab, so the automatic size holds every chunk of the x-slabs a query can touch, plus one slab.
+
+        :param grid_config: GridConfig of the series, required for grid chunk shapes
+        """
+        if chunk_shape is not True:
+            chunk_bytes = math.prod(chunk_shape) * itemsize
+
+        if self.chunk_cache_mb is not None:
+            nbytes = int(self.chunk_cache_mb * 1024**2)
+        elif chunk_shape is True:
+            return {}
+        elif len(chunk_shape) == 4:
+            cx, cy, cz = chunk_shape[:3]
+            slab_points = cx * grid_config.ny * grid_config.nz
+            chunks_per_slab = -(-grid_config.ny // cy) * -(-grid_config.nz // cz)
+            slabs_per_query = -(-int(max_query_rows) // slab_points) + 1
+            nbytes = max(slabs_per_query * chunks_per_slab * chunk_bytes, 1024**2)
+        else:
+            chunks_per_query = -(-int(max_query_rows) // chunk_shape[0]) + 1
+            nbytes = max(chunks_per_query * chunk_bytes, 1024**2)
+
+        if chunk_shape is True:
+            num_slots = 521
+        else:
+            num_slots = max(521, 100 * (nbytes // max(chunk_bytes, 1)) + 1)
+
+        return {"rdcc_nbytes": nbytes, "rdcc_nslots": int(num_slots), "rdcc_w0": 1.0}
+
+
 
 
 class State:
@@ -57,11 +207,22 @@ class State:
         self.flags.is_last_snapshot = False
         self.flags.is_new_series = True
 
+        # resume_volume_index is a watermark: every spatial index below it is saved. Ranges completed above the
+        # watermark (out of order) are kept in completed_ranges as [start, end) pairs
         self.resume_volume_index = 0
+        self.completed_ranges = []
+        # First spatial index of the volume this state tracks. Non-zero for shards of a series
+        self.volume_start_index = 0
+        # Completed ranges of snapshots after resume_temporal_index, keyed by str(time_index). Only used when
+        # snapshot_lookahead lets chunks of the next snapshots be queried before the current one is finished
+        self.lookahead_ranges = {}
         self.current_query_limit = 4000
         self.query_history = []
         self.num_consecutive_fails = 0
         self.resume_temporal_index = 0
+        # Running statistics of the snapshots being written and of the completed ones, see
+        # main_v2.streaming_stats.StatsAccumulator
+        self.stats = {}
 
     def to_dict(self):
         def recurse(obj):
@@ -79,6 +240,100 @@ class State:
         return recurse(self)
 
 
+    def add_completed_range(self, chunk_indices, time_index=None):
+        """
+        Merges a saved [start, end) range into the completed ranges of time_index (default: current snapshot).
+        For the current snapshot, resume_volume_index is advanced over it.
+        """
+        if time_index is not None and time_index != self.resume_temporal_index:
+            if time_index > self.resume_temporal_index:
+                key = str(time_index)
+                self.lookahead_ranges[key] = State._merge_ranges(self.lookahead_ranges.get(key, []) + [chunk_indices])
+            return
+
+        merged = State._merge_ranges(self.completed_ranges + [chunk_indices])
+
+        # Advance the watermark over the range touching it and drop everything below it
+        while merged and merged[0][0] <= self.resume_volume_index:
+            self.resume_volume_index = max(self.resume_volume_index, merged[0][1])
+            merged.pop(0)
+
+        self.completed_ranges = merged
+
+
+    def get_occupied_ranges(self, time_index):
+        "Completed [start, end) ranges of any snapshot, including [0, resume_volume_index) for the current one"
+        if time_index == self.resume_temporal_index:
+            return [[0, self.resume_volume_index]] + [list(r) for r in self.completed_ranges]
+        return [list(r) for r in self.lookahead_ranges.get(str(time_index), [])]
+
+
+    def advance_snapshot(self):
+        "Moves to the next snapshot, carrying over any ranges of it that were completed ahead of time"
+        self.resume_temporal_index += 1
+        self.resume_volume_index = self.volume_start_index
+        self.completed_ranges = []
+
+        for chunk_indices in self.lookahead_ranges.pop(str(self.resume_temporal_index), []):
+            self.add_completed_range(chunk_indices)
+
+
+    def requeue_ranges(self, ranges, point_range):
+        """
+        Marks ranges as not completed, so they are queried again, e.g. after they were found missing from their
+        snapshot files. Snapshots before resume_temporal_index count as completed over point_range, so requeueing
+        one of them moves resume_temporal_index back to it and keeps the snapshots in between as lookahead ranges.
+
+        :param ranges: dict of time_index -> list of [start, end) ranges to query again
+        :param point_range: [start, end) of the volume this state tracks
+        """
+        ranges = {int(t): r for t, r in ranges.items() if r}
+        if not ranges:
+            return
+
+        first = min(min(ranges), self.resume_temporal_index)
+        completed = {t: [list(point_range)] for t in range(first, self.resume_temporal_index)}
+        completed[self.resume_temporal_index] = self.get_occupied_ranges(self.resume_temporal_index)
+        for key, lookahead in self.lookahead_ranges.items():
+            completed[int(key)] = lookahead
+
+        for time_index, completed_ranges in completed.items():
+            kept = []
+            for start, end in State._merge_ranges(completed_ranges):
+                start, end = max(start, point_range[0]), min(end, point_range[1])
+                for bad_start, bad_end in State._merge_ranges(ranges.get(time_index, [])):
+                    if bad_end <= start or bad_start >= end:
+                        continue
+                    if bad_start > start:
+                        kept.append([start, bad_start])
+                    start = max(start, bad_end)
+                if start < end:
+                    kept.append([start, end])
+            completed[time_index] = kept
+
+        self.resume_temporal_index = first
+        self.resume_volume_index = self.volume_start_index
+        self.completed_ranges = []
+        self.lookahead_ranges = {str(t): r for t, r in sorted(completed.items()) if t > first and r}
+        for chunk_indices in completed[first]:
+            self.add_completed_range(chunk_indices)
+
+        self.flags.snapshot_is_complete = False
+        self.flags.series_is_complete = False
+        self.flags.is_first_chunk = self.resume_volume_index == self.volume_start_index and not self.completed_ranges
+
+
+    @staticmethod
+    def _merge_ranges(ranges):
+        merged = []
+        for range_start, range_end in sorted([list(r) for r in ranges]):
+            if merged and range_start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], range_end)
+            else:
+                merged.append([range_start, range_end])
+        return merged
+
+
     @classmethod
     def load_from_json(cls, state_path):
         with open(state_path, "r") as f:
@@ -93,6 +348,16 @@ class State:
             else:
                 setattr(self, key, val)
 
+        # Replay chunks saved since the json was last written. Records from an earlier snapshot are already covered.
+        journal_path = ProgressJournal.path_for_state(state_path)
+        for time_index, start, end, query_limit in ProgressJournal.read_records(journal_path):
+            if time_index < self.resume_temporal_index:
+                continue
+            self.add_completed_range((start, end), time_index=time_index)
+            self.current_query_limit = query_limit
+            if time_index == self.resume_temporal_index:
+                self.flags.is_first_chunk = False
+
         self.num_consecutive_fails = 0
         return self
 
@@ -106,27 +371,43 @@ class RuntimeConfig:
             self.query_history_length = 10
             self.query_limit_update_factor = 0.3
             self.starting_query_limit = 4000
+            self.query_limit_algorithm = "pass_fail"
 
             self.wait_update_factor = 1.5
             self.wait_range = [1, 3600]
             self.wait_update_padding = 3
+            self.wait_jitter = 0.5
 
             self.max_consecutive_fails = 20
 
+            self.max_in_flight_queries = 1  # Concurrent requests per run are opt-in
+            self.snapshot_lookahead = 0
+            self.writer_queue_size = 8
+            self.writer_flush_interval = 16
+            self.journal_compaction_interval = 500
+
     class Absolute:
         def __init__(self):
             self.query_min_size_limits = [1, 3999999]
             self.query_max_size_limits = [2, 4000000]
             self.query_limit_update_factor_limits = [0.2, 0.6]
             self.query_history_length_limits = [3, 10]
+            self.query_limit_algorithms = ["pass_fail", "throughput"]
 
             self.wait_max_limits = [2, 43200]
             self.wait_min_limits = [1, 42199]
             self.wait_update_padding_limits = [1, 5]
             self.wait_time_update_factor_limits = [1.5, 3]
+            self.wait_jitter_limits = [0, 1]
 
             self.max_consecutive_fails_limits = [1, 100]
 
+            self.max_in_flight_queries_limits = [1, 16]
+            self.snapshot_lookahead_limits = [0, 8]
+            self.writer_queue_size_limits = [1, 64]
+            self.writer_flush_interval_limits = [1, 256]
+            self.journal_compaction_interval_limits = [1, 100000]
+
     def __init__(self):
         self.tunable = self.Tunable()
         self.absolute = self.Absolute()
@@ -164,6 +445,8 @@ class RuntimeConfig:
     INPUT MANAGER ------------------------------------------------------------------------------------------------------
     """
 
+# InputManager imports PyQt6 inside its methods so the config and state classes above can be used without Qt,
+# e.g. by the headless runner
 class InputManager:
     def __init__(self, **kwargs):
         """
@@ -182,6 +465,9 @@ class InputManager:
 
     def attach_validators(self):
         "Attaches QValidator objects to widgets"
+        from PyQt6.QtGui import QIntValidator, QDoubleValidator
+        from PyQt6.QtWidgets import QLabel
+
         for ent in self._fields.values():
             widget = ent["widget"]
 
@@ -204,6 +490,8 @@ class InputManager:
 
     def force_within_range(self):
         "Auto corrects inputs to remain within range for QSpinBoxes, QDoubleSpinBoxes"
+        from PyQt6.QtWidgets import QSpinBox, QDoubleSpinBox
+
         for ent in self._fields.values():
             widget = ent["widget"]
 
@@ -242,6 +530,8 @@ class InputManager:
 
     def all_fields_filled(self):
         "Generic check if all fields are filled"
+        from PyQt6.QtWidgets import QLineEdit, QComboBox
+
         for ent in self._fields.values():
             widget = ent["widget"]
             # Check if line edit is empty
@@ -254,6 +544,8 @@ class InputManager:
 
 
     def get_field_value(self, key):
+        from PyQt6.QtWidgets import QSpinBox, QDoubleSpinBox, QLineEdit, QComboBox
+
         widget = self._fields[key]["widget"]
         if isinstance(widget, (QSpinBox, QDoubleSpinBox)):
             return widget.value()
@@ -0,0 +1,107 @@
+"""
+Incremental updates of the load dialog's series search: a catalog entry that is added, edited or removed reaches an
+existing index through sync(), without re-indexing the series that did not change.
+
+    Usage:
+            python -m pytest tests
+            python -m unittest discover tests
+"""
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from datetime import datetime
+import tempfile
+import unittest
+
+from main_v2.series_catalog import SeriesCatalog
+from main_v2.series_search_index import SeriesSearchIndex
+
+try:
+    from Controllers.LoadSessionDialog import SearchManager
+except ImportError:
+    SearchManager = None  # PyQt6 is not installed
+
+
+def make_entry(data_dir, custom_tag, nx=64):
+    "Catalog entry in the hash_log.json format"
+    return {
+        "dataset": "channel",
+        "custom_tag": custom_tag,
+        "created": "03/14/2025",
+        "completed": {"velocity": False, "pressure": False},
+        "last_loaded": {"velocity": "", "pressure": ""},
+        "series_directory": str(Path(data_dir) / "turb_data" / "channel" / custom_tag),
+        "data_directory": str(data_dir),
+        "dataset_metadata_filepath": str(Path(data_dir) / "metadata.json"),
+        "config": {"grid_config": {"nx": nx, "ny": 32, "nz": 32, "nt": 10}},
+    }
+
+
+class SeriesSearchIndexSyncTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.data_dir = Path(self._tmp.name)
+        self.catalog = SeriesCatalog(self.data_dir)
+        for i in range(3):
+            self.catalog.add(f"{i:032x}", make_entry(self.data_dir, f"series_{i}"))
+
+        self.index = SeriesSearchIndex()
+        self.index.sync(self.catalog.iter_entries())
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+
+    def test_added_and_edited_entries_reach_the_existing_index(self):
+        unchanged = {row_id: row for row_id, row in self.index.rows.items() if row["hash"] != f"{1:032x}"}
+
+        new_hash = "f" * 32
+        self.catalog.add(new_hash, make_entry(self.data_dir, "re550_new", nx=128))
+        self.catalog.set_last_loaded(f"{1:032x}", "velocity", datetime(2025, 6, 1))
+        self.index.sync(self.catalog.iter_entries())
+
+        self.assertEqual({row["hash"] for row in self.index.search({"custom_tag": "re550"})}, {new_hash})
+        self.assertEqual(len(self.index.search({"nx": "128"})), 2)
+        self.assertEqual([row["hash"] for row in self.index.search({"last_loaded": "2025-06-01"})], [f"{1:032x}"])
+
+        # The other series keep their rows, they were not indexed again
+        for row_id, row in unchanged.items():
+            self.assertIs(self.index.rows[row_id], row)
+
+
+    def test_removed_entries_leave_the_existing_index(self):
+        version = self.index.version
+        self.catalog.remove(f"{0:032x}")
+        self.index.sync(self.catalog.iter_entries())
+
+        self.assertEqual(self.index.search({"hash": f"{0:032x}"}), [])
+        self.assertEqual(len(self.index), 4)
+        self.assertGreater(self.index.version, version)
+
+
+    def test_unchanged_catalog_changes_nothing(self):
+        version = self.index.version
+        self.index.sync(self.catalog.iter_entries())
+        self.assertEqual(self.index.version, version)
+
+
+    @unittest.skipIf(SearchManager is None, "PyQt6 is not installed")
+    def test_search_manager_refresh_syncs_its_index(self):
+        search_manager = SearchManager(self.data_dir)
+        search_manager.refresh()
+        index = search_manager.index
+        search_manager.set_sort_order(index.sorted_ids("custom_tag", descending=True), index.version)
+
+        self.catalog.add("e" * 32, make_entry(self.data_dir, "wall_resolved"))
+        search_manager.refresh()
+
+        self.assertIs(search_manager.index, index)
+        self.assertEqual(len(search_manager.filter_search_results({"custom_tag": "wall"})), 2)
+        # The sort order held the old row ids, so it is dropped until the rows are sorted again
+        self.assertIsNone(search_manager.sort_order)
+
+
+if __name__ == "__main__":
+    unittest.main()